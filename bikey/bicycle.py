@@ -1,30 +1,10 @@
 import gym
+from bikey import robot
+from bikey.robot import maxonEC90, maxonF2140, transmission_ratios
 from bikey.spacar import SpacarEnv
-from math import inf, pi
 import numpy as np
 import os
 
-# Properties of the motors/servos used in the bicycle robot, torques in
-# Newton-meters
-
-maxonEC90 = {
-    "stall_torque": 4.940,
-    "nominal_torque": 0.44,
-    "limited_torque": 0.4
-}
-
-maxonF2140 = {
-    "stall_torque": 0.031,
-    "nominal_torque": 0.012,
-    "limited_torque": 0.01
-}
-
-transmission_ratios = {
-    "steering": 1,
-    "body_leaning": 30,
-    "propulsion": 1
-}
-
 # only settings supported by SpacarEnv.change_settings will have an effect
 _default_sim_config = {
     "initial_action": np.zeros((3,)),
@@ -38,68 +18,31 @@ class BicycleEnv(SpacarEnv):
     def __init__(self, simulink_file, working_dir=os.getcwd(), template_dir=
                  None, copy_simulink=False, copy_spacar=False,
                  simulink_config=_default_sim_config, matlab_params=
-                 '-desktop'):
+                 None, **kwargs):
         """
         This environment wraps the physics simulation of a scaled down bicycle.
 
         Arguments:
         Arguments are equal to those of bikey.base.SpacarEnv.__init__, consult
-            its documentation instead.
+            its documentation instead. Any keyword arguments that are not
+            listed here are passed on to SpacarEnv.__init__.
         """
 
-        # define actions
-
-        torque_limit_propulsion = \
-            maxonEC90["limited_torque"] * transmission_ratios["propulsion"]
-        torque_limit_steering = \
-            maxonEC90["limited_torque"] * transmission_ratios["steering"]
-        torque_limit_leaning = \
-            maxonF2140["limited_torque"] * transmission_ratios["body_leaning"]
-
-        torque_limits = np.array([
-            torque_limit_steering,
-            torque_limit_leaning,
-            torque_limit_propulsion],
-            dtype=np.float32) / 5
-
-        action_space = gym.spaces.Box(
-            low=-torque_limits,
-            high=torque_limits,
-            shape=(3,),
-            dtype=np.float32)
-
-        # define observations
-
-        infinity = np.array([inf, inf, inf, inf, inf, inf],
-                            dtype=np.float32)
-
-        # TODO: give a better description of the observations?
-        observation_space = gym.spaces.Box(
-            low=-infinity,
-            high=infinity,
-            shape=(6,),
-            dtype=np.float32)
+        self.action_space = robot.action_space()
+        self.observation_space = robot.observation_space()
 
         config = _default_sim_config.copy()
         config.update(simulink_config)
 
-        self.action_space = action_space
-        self.observation_space = observation_space
-
         # define rewards
         # TODO: self.reward_range = (-inf, inf)
 
         super().__init__(simulink_file, working_dir, template_dir,
-                         copy_simulink, copy_spacar, config, matlab_params)
-
-        # limits / at what point should the episode terminate?
-        deg_to_rad = 2 * pi / 360
-        leaning_limit = 20 * deg_to_rad  # leaning angle of bicycle
-        steering_limit = 40 * deg_to_rad  # steering angle
-        ub_leaning_limit = 20 * deg_to_rad  # leaning angle of upper body
+                         copy_simulink, copy_spacar, config, matlab_params,
+                         **kwargs)
 
-        self.limits = \
-            np.array([steering_limit, leaning_limit, ub_leaning_limit])
+        # at what point should the episode terminate?
+        self.limits = robot.limits.copy()
 
     def process_step(self, observations):
         """
@@ -118,13 +61,22 @@ class BicycleEnv(SpacarEnv):
         """
         reward = 1
 
-        angles = abs(observations.flatten()[1:4])
-        done = np.any(angles > self.limits)
+        done = robot.exceeds_limits(observations.flatten(), self.limits)
 
         info = {}
 
         return reward, done, info
 
+    def process_steps(self, observation_batch):
+        """
+        Vectorised version of process_step(), see
+        SpacarEnv.process_steps().
+        """
+        rewards = np.ones(len(observation_batch))
+        dones = robot.exceeds_limits(observation_batch, self.limits)
+
+        return rewards, dones, None
+
 
 gym.envs.register(
     id="BicycleEnv-v0",
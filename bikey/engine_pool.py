@@ -0,0 +1,186 @@
+import threading
+
+
+class EnginePool:
+    """
+    Leases Matlab sessions to environments, so sessions can be reused.
+
+    Starting Matlab is by far the slowest part of creating a SpacarEnv, and
+    every session takes up a lot of memory. Environments created with an
+    engine_pool borrow a session from the pool instead, and hand it back when
+    they are closed. The next environment can then use it without starting
+    Matlab again.
+
+    A session is only leased to one environment at a time. Simulink models and
+    the 'out' variable live in the global workspace of a session, so two
+    environments sharing a session simultaneously would overwrite each other's
+    simulation. To isolate environments, a session's workspace is cleared and
+    all of its models are closed every time it changes hands.
+
+    Besides starting sessions itself, the pool can connect to shared sessions
+    that are already running, e.g. sessions started by another process that
+    ran matlab.engine.shareEngine. These are never shut down by the pool.
+
+    The pool is safe to use from several threads. Without Matlab installed, a
+    pool can be tested using bikey.fake_matlab as its engine_module.
+    """
+
+    def __init__(self, max_sessions=None, matlab_params='-desktop',
+                 shared_names=(), engine_module=None):
+        """
+        Creates an empty pool, sessions are started once they are needed.
+
+        Arguments:
+        max_sessions -- The maximum number of sessions. When all of them are
+            leased, lease() waits until one is released. None means no limit.
+        matlab_params -- Parameters passed to Matlab when starting a session.
+        shared_names -- Names of shared Matlab sessions. The pool connects to
+            these (with connect_matlab) before it starts any sessions itself.
+        engine_module -- The module used to start and connect to sessions, by
+            default matlab.engine.
+        """
+        if engine_module is None:
+            # imported here, so a pool can be used without Matlab installed
+            import matlab.engine
+            engine_module = matlab.engine
+
+        self.engine_module = engine_module
+        self.max_sessions = max_sessions
+        self.matlab_params = matlab_params
+        self.shared_names = list(shared_names)
+
+        self.idle = []
+        self.leased = set()
+        self.starting = 0
+        self.owned = set()  # sessions started by the pool itself
+
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def lease(self, working_dir=None):
+        """
+        Borrow a session, starting or connecting to one if none are idle.
+
+        Arguments:
+        working_dir -- If not None, the current directory of the session is
+            changed to this directory.
+
+        Returns:
+        A Matlab session with an empty workspace and no open models.
+        """
+        with self.condition:
+            while not self.idle and not self._can_grow():
+                self.condition.wait()
+
+            if self.closed:
+                raise RuntimeError("Cannot lease a session from a closed pool")
+
+            if self.idle:
+                session = self.idle.pop()
+                self.leased.add(session)
+            else:
+                # reserve a spot, Matlab is started without holding the lock
+                session = None
+                self.starting += 1
+
+        if session is None:
+            try:
+                session = self._new_session()
+            finally:
+                with self.condition:
+                    self.starting -= 1
+                    if session is not None:
+                        self.leased.add(session)
+                    self.condition.notify()
+
+        if working_dir is not None:
+            session.cd(working_dir, nargout=0)
+
+        return session
+
+    def release(self, session):
+        """
+        Hand a session back to the pool.
+
+        All models in the session are closed without saving, and its workspace
+        is cleared.
+
+        Arguments:
+        session -- A session obtained with lease().
+        """
+        self._clean(session)
+
+        with self.condition:
+            self.leased.discard(session)
+            closed = self.closed
+
+            if not closed:
+                self.idle.append(session)
+
+            self.condition.notify()
+
+        if closed:
+            self._shut_down(session)
+
+    def close(self):
+        """
+        Shut down all idle sessions started by the pool.
+
+        Leased sessions are shut down once they are released. Shared sessions
+        are left running.
+        """
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+
+            self.condition.notify_all()
+
+        for session in idle:
+            self._shut_down(session)
+
+    @property
+    def size(self):
+        """
+        The number of sessions in the pool, both idle and leased.
+        """
+        with self.condition:
+            return len(self.idle) + len(self.leased)
+
+    def _can_grow(self):
+        # must be called while holding the condition's lock
+        if self.closed:
+            return True  # let lease() raise the error
+
+        return self.max_sessions is None or \
+            len(self.idle) + len(self.leased) + self.starting < \
+            self.max_sessions
+
+    def _new_session(self):
+        with self.condition:
+            shared_name = self.shared_names.pop(0) if self.shared_names \
+                else None
+
+        if shared_name is not None:
+            return self.engine_module.connect_matlab(shared_name)
+
+        session = self.engine_module.start_matlab(self.matlab_params)
+
+        with self.condition:
+            self.owned.add(session)
+
+        # disable matlab's notification sound
+        session.eval('beep off', nargout=0)
+
+        return session
+
+    def _clean(self, session):
+        session.eval('bdclose all', nargout=0)
+        session.eval('clear', nargout=0)
+
+    def _shut_down(self, session):
+        with self.condition:
+            owned = session in self.owned
+            self.owned.discard(session)
+
+        if owned:
+            session.quit()
@@ -0,0 +1,499 @@
+import array
+import os
+import sys
+import time
+import types
+
+# An in-process stand-in for the matlab.engine module, so code that talks to
+# Matlab can be run and tested on machines without a Matlab licence. Only the
+# parts of the engine API that bikey uses are emulated.
+#
+# It can be passed explicitly where an engine module is expected (e.g. to
+# bikey.engine_pool.EnginePool), or installed in place of the real module with
+# install(), after which 'import matlab.engine' returns this module.
+#
+# Simulink is emulated as well, as far as bikey.spacar.SpacarEnv needs it: a
+# model can be opened, its block parameters can be set and read, and the
+# simulation can be started, continued, updated and stopped. Every time the
+# simulation takes a step, the observations are computed from the actions by
+# a simple stand-in for the bicycle (see bicycle_dynamics()), and stored in
+# 'out.observations' in the workspace, like the template model does. The
+# bikey_step function from the template directory is emulated too, once the
+# template directory has been added to the path.
+#
+# Real engine calls take a while, since every call crosses a process boundary.
+# To make timings realistic, every call can be given a latency, see
+# configure().
+
+_shared_engines = {}
+
+# see configure()
+_settings = {
+    'latency': 0.0,
+    'step_size': 0.01,
+    'stop_time': 10.0,
+    'dynamics': None,
+}
+
+
+class EngineError(Exception):
+    """
+    Raised when a session is used after it has been shut down.
+    """
+    pass
+
+
+class MatlabExecutionError(Exception):
+    """
+    Raised when Matlab code cannot be executed.
+    """
+    pass
+
+
+class double:
+    """
+    Stand-in for matlab.double, a two-dimensional array of doubles.
+
+    Like older versions of the real engine, the elements are stored in
+    column-major order in an array.array, and the shape is stored in size.
+    Numpy reads it through its sequence protocol, row by row.
+    """
+
+    def __init__(self, initializer=None):
+        """
+        Arguments:
+        initializer -- A list of numbers, which becomes a row vector, or a list
+            of rows.
+        """
+        if initializer is None:
+            initializer = []
+
+        rows = [list(row) if isinstance(row, (list, tuple)) else None
+                for row in initializer]
+
+        if rows and all(row is not None for row in rows):
+            self.size = (len(rows), len(rows[0]))
+            elements = [row[j] for j in range(self.size[1]) for row in rows]
+        elif initializer:
+            self.size = (1, len(initializer))
+            elements = list(initializer)
+        else:
+            self.size = (0, 0)
+            elements = []
+
+        self._data = array.array('d', elements)
+
+    def __len__(self):
+        return self.size[0]
+
+    def __getitem__(self, row):
+        """
+        Returns a row as a list, like indexing the real matlab.double does.
+        """
+        if not 0 <= row < self.size[0]:
+            raise IndexError("Index exceeds the number of rows")
+
+        return list(self._data[row::self.size[0]])
+
+    def __repr__(self):
+        return f"fake_matlab.double(size={self.size})"
+
+
+class FakeMatlabEngine:
+    """
+    Stand-in for a matlab.engine.MatlabEngine session.
+
+    The session keeps a workspace (a dictionary of variables), a current
+    directory, a search path and the Simulink models that are loaded. Every
+    call that would cross the engine boundary is counted in calls, and takes
+    at least as long as the latency given to configure().
+    """
+
+    def __init__(self, option='-desktop'):
+        self.option = option
+        self.workspace = {}
+        self.current_dir = os.getcwd()
+        self.path = []
+        self.loaded_models = {}  # maps model names to _SimulinkModels
+        self.root_model = None  # the model opened last, see bdroot
+        self.running = True
+        self.calls = 0
+
+    def cd(self, directory, nargout=1):
+        self._call()
+        self.current_dir = directory
+
+    def eval(self, code, nargout=1):
+        """
+        Executes a small subset of Matlab statements.
+
+        Supported are 'clear', 'clear <names>', 'bdclose all', 'beep off',
+        'close_system(<model>, 0)', 'matlab.engine.shareEngine('<name>')'
+        and '<variable>.<field>', possibly separated by semicolons. The value
+        of the last statement is returned.
+        """
+        self._call()
+        result = None
+
+        for statement in code.split(';'):
+            words = statement.split()
+
+            if not words:
+                continue
+
+            elif words[0] == 'clear':
+                self._clear(words[1:])
+
+            elif words == ['bdclose', 'all']:
+                self.loaded_models.clear()
+                self.root_model = None
+
+            elif statement.strip().startswith('close_system('):
+                model = statement.split('(')[1].split(',')[0].strip()
+                self._close_system(model.strip("'"))
+
+            elif words[0] == 'beep':
+                pass
+
+            elif statement.strip().startswith('matlab.engine.shareEngine('):
+                name = statement.split("'")[1]
+                _shared_engines[name] = self
+
+            elif len(words) == 1 and words[0].count('.') == 1:
+                name, field = words[0].split('.')
+
+                if name not in self.workspace:
+                    raise MatlabExecutionError(
+                        f"Unrecognized function or variable '{name}'")
+
+                result = getattr(self.workspace[name], field)
+
+            else:
+                raise MatlabExecutionError(
+                    f"The fake engine cannot evaluate '{statement.strip()}'")
+
+        return result
+
+    def clear(self, *names, nargout=1):
+        self._call()
+        self._clear(names)
+
+    def assignin(self, workspace, name, value, nargout=1):
+        self._call()
+        self.workspace[name] = value
+
+    def exist(self, name, nargout=1):
+        self._call()
+        return 1 if name in self.workspace else 0
+
+    def addpath(self, directory, nargout=1):
+        self._call()
+        self.path.insert(0, directory)
+
+    def open_system(self, model, nargout=1):
+        self._call()
+        self._load_system(model)
+        self.root_model = model
+
+    def load_system(self, model, nargout=1):
+        self._call()
+        self._load_system(model)
+
+    def set_param(self, block, parameter, value, nargout=1):
+        """
+        Sets a parameter of a block, or of the model itself.
+
+        Setting the SimulationCommand of a model controls its simulation, see
+        _SimulinkModel.command().
+        """
+        self._call()
+        model = self._model(block)
+
+        if block == model.name and parameter == 'SimulationCommand':
+            model.command(value, self.workspace)
+        else:
+            model.parameters[(block, parameter.lower())] = value
+
+    def get_param(self, block, parameter, nargout=1):
+        """
+        Returns a parameter of a block, or the SimulationStatus or
+        SimulationTime of a model.
+        """
+        self._call()
+        model = self._model(block)
+
+        if block == model.name and parameter == 'SimulationStatus':
+            return model.status
+
+        if block == model.name and parameter == 'SimulationTime':
+            return model.time
+
+        key = (block, parameter.lower())
+
+        if key not in model.parameters:
+            raise MatlabExecutionError(
+                f"'{block}' does not have a parameter named '{parameter}'")
+
+        return model.parameters[key]
+
+    def bikey_step(self, model, actions, repeat=1.0, nargout=4):
+        """
+        Emulates the bikey_step Matlab function from the template directory.
+
+        Like the real function, it must be on the path.
+        """
+        self._call()
+
+        if not any(os.path.exists(os.path.join(directory, 'bikey_step.m'))
+                   for directory in self.path):
+            raise MatlabExecutionError(
+                "Unrecognized function or variable 'bikey_step'")
+
+        model = self._model(model)
+        rows = []
+
+        if model.status != 'paused':
+            return False, double(), model.status, model.time
+
+        if isinstance(actions, str):
+            model.parameters[(f'{model.name}/actions', 'value')] = actions
+        else:
+            self.workspace['bikey_actions'] = actions
+            model.command('update', self.workspace)
+
+        for _ in range(int(repeat)):
+            model.command('continue', self.workspace)
+            rows.append(list(self.workspace['out'].observations._data))
+
+            if model.status != 'paused':
+                break
+
+        return True, double(rows), model.status, model.time
+
+    def quit(self):
+        self.running = False
+
+        for name, engine in list(_shared_engines.items()):
+            if engine is self:
+                del _shared_engines[name]
+
+    def _load_system(self, model):
+        if model in self.loaded_models:
+            return
+
+        if not os.path.exists(os.path.join(self.current_dir,
+                                           model + '.slx')):
+            raise MatlabExecutionError(
+                f"'{model}' is not a model in the current directory")
+
+        self.loaded_models[model] = _SimulinkModel(model)
+
+    def _close_system(self, model):
+        if model == 'bdroot':
+            model = self.root_model
+
+        if self.loaded_models.pop(model, None) is None:
+            raise MatlabExecutionError(f"Invalid Simulink object name: {model}")
+
+        if model == self.root_model:
+            self.root_model = None
+
+    def _model(self, block):
+        name = block.split('/')[0]
+
+        if name not in self.loaded_models:
+            raise MatlabExecutionError(
+                f"Invalid Simulink object name: {block}")
+
+        return self.loaded_models[name]
+
+    def _clear(self, names):
+        if names:
+            for name in names:
+                self.workspace.pop(name, None)
+        else:
+            self.workspace.clear()
+
+    def _call(self):
+        if not self.running:
+            raise EngineError("Session has been shut down")
+
+        self.calls += 1
+
+        if _settings['latency'] > 0:
+            time.sleep(_settings['latency'])
+
+
+class _SimulationOutput:
+    """
+    Stand-in for the 'out' variable that Simulink stores in the workspace.
+    """
+
+    def __init__(self, observations):
+        self.observations = observations
+
+
+class _SimulinkModel:
+    """
+    A loaded Simulink model and the state of its simulation.
+
+    The simulation pauses after every step, like the template model does when
+    it is controlled by a SpacarEnv, and stops once its stop time is reached.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.parameters = {}  # maps (block, parameter) to values
+        self.status = 'stopped'
+        self.time = 0.0
+        self.observations = None
+        self.actions = None
+
+    def command(self, command, workspace):
+        """
+        Executes a SimulationCommand.
+
+        Arguments:
+        command -- 'start', 'continue', 'update', 'pause' or 'stop'
+        workspace -- The workspace in which 'out' is stored
+        """
+        if command == 'start' and self.status == 'stopped':
+            self.time = 0.0
+            self.observations = [0.0] * 6
+            self.actions = self._read_actions(workspace)
+            self._step(workspace)
+
+        elif command == 'continue' and self.status == 'paused':
+            self.actions = self._read_actions(workspace)
+            self._step(workspace)
+
+        elif command == 'update' and self.status == 'paused':
+            self.actions = self._read_actions(workspace)
+
+        elif command == 'stop':
+            self.status = 'stopped'
+
+        elif command not in ('start', 'continue', 'update', 'pause'):
+            raise MatlabExecutionError(
+                f"Invalid simulation command '{command}'")
+
+    def _step(self, workspace):
+        dynamics = _settings['dynamics'] or bicycle_dynamics
+        step_size = _settings['step_size']
+
+        self.observations = list(dynamics(self.observations, self.actions,
+                                          step_size))
+        self.time += step_size
+        self.status = 'paused' if self.time < _settings['stop_time'] \
+            else 'stopped'
+
+        workspace['out'] = _SimulationOutput(double(self.observations))
+
+    def _read_actions(self, workspace):
+        """
+        Reads the value of the actions block, which is either the text of a
+        vector, or the name of a variable in the workspace.
+        """
+        value = self.parameters.get((f'{self.name}/actions', 'value'), '0')
+
+        if value in workspace:
+            return list(workspace[value]._data)
+
+        return [float(number) for number in
+                value.replace('[', ' ').replace(']', ' ').split()]
+
+
+def bicycle_dynamics(observations, actions, step_size):
+    """
+    A very rough stand-in for the bicycle model, to drive the emulated
+    simulation.
+
+    The bicycle rides straight ahead at a constant speed, and the steering
+    angle, leaning angle and upper body angle slowly follow the three actions.
+    Observations are ordered like those of bikey.robot.observation_space().
+
+    Returns:
+    The observations after one step.
+    """
+    observations = list(observations)
+    actions = list(actions) + [0.0] * (3 - len(actions))
+
+    observations[0] += 10 * step_size  # the rear wheel turns
+    for i in range(3):
+        observations[i + 1] += step_size * (actions[i] - observations[i + 1])
+    observations[4] += 3 * step_size  # the bicycle moves forward
+
+    return observations
+
+
+MatlabEngine = FakeMatlabEngine
+
+
+def start_matlab(option='-desktop'):
+    """
+    Starts a new fake session.
+    """
+    return FakeMatlabEngine(option)
+
+
+def connect_matlab(name=None):
+    """
+    Connects to a fake session that was shared with shareEngine.
+
+    If name is None the first shared session is used, or a new session is
+    started if there are none, like matlab.engine.connect_matlab does.
+    """
+    if name is None:
+        if _shared_engines:
+            return next(iter(_shared_engines.values()))
+
+        return start_matlab()
+
+    if name not in _shared_engines:
+        raise EngineError(f"Unable to connect to Matlab session '{name}'")
+
+    return _shared_engines[name]
+
+
+def find_matlab():
+    """
+    Returns the names of all shared fake sessions.
+    """
+    return tuple(_shared_engines)
+
+
+def configure(latency=None, step_size=None, stop_time=None,
+              dynamics=None):
+    """
+    Changes how the fake engine behaves, for all sessions.
+
+    Settings that are None are left as they are. Processes started after this
+    call inherit the settings, as long as they are forked.
+
+    Arguments:
+    latency -- The number of seconds every engine call takes, 0 by default.
+    step_size -- The simulation time of one Simulink step, 0.01 by default.
+    stop_time -- The simulation time at which simulations stop, 10 by default.
+    dynamics -- A function that computes the observations of the next
+        Simulink step from the observations, the actions and the step size,
+        by default bicycle_dynamics().
+    """
+    for name, value in (('latency', latency), ('step_size', step_size),
+                        ('stop_time', stop_time), ('dynamics', dynamics)):
+        if value is not None:
+            _settings[name] = value
+
+
+def install():
+    """
+    Make 'import matlab.engine' return this module.
+
+    Must be called before importing modules that import matlab.engine, such as
+    bikey.spacar and bikey.bicycle.
+    """
+    matlab = types.ModuleType('matlab')
+    matlab.engine = sys.modules[__name__]
+    matlab.double = double
+
+    sys.modules['matlab'] = matlab
+    sys.modules['matlab.engine'] = sys.modules[__name__]
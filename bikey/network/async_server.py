@@ -0,0 +1,444 @@
+import asyncio
+
+from . import metrics as server_metrics
+from . import protocol
+from . import server_utils
+from . import tracing
+from .env_process import PipeEnvProcess, EnvProcessPool, \
+    SharedMemoryEnvProcess
+from .scheduler import StepScheduler
+from .sessions import DEFAULT_TIMEOUT, SessionRegistry
+
+
+def start_server(host, port, server_dir, max_connections, pool_size=0,
+                 matlab_params=None, shared_memory=False, local_socket=True,
+                 session_timeout=DEFAULT_TIMEOUT, envs_per_worker=0,
+                 trace=False, metrics_port=None):
+    """
+    Start an asyncio-based environment server on the specified interface and
+    port.
+
+    This server does the same job as bikey.network.server.start_server(), but
+    all connections are handled by coroutines on a single event loop instead
+    of a thread per connection. The environment processes are reached through
+    pipes that the event loop watches, so waiting for an environment does not
+    block anything else.
+
+    Every connection is accepted right away. Once the connection limit is
+    reached, new connections wait in line for the next free slot, and they are
+    served in the order in which they arrived.
+
+    The environment processes can be started in advance, see
+    bikey.network.env_process.EnvProcessPool. Processes from the pool are
+    reused when their client leaves.
+
+    Arguments:
+    host -- The interface to listen on
+    port -- The port to listen on
+    server_dir -- The directory where the server can store its files (this is
+        only used with SpacarEnv's)
+    max_connections -- The maximum number of connections that are served
+        simultaneously.
+    pool_size -- The number of environment processes that are kept ready.
+    matlab_params -- If not None, the processes in the pool start a Matlab
+        session with these parameters in advance.
+    shared_memory -- If True, environment processes exchange actions and
+        observations with the server through shared memory.
+    local_socket -- If True, the server also listens on a Unix domain socket
+        for clients on the same machine, see protocol.local_socket_path().
+    session_timeout -- The number of seconds the environments of a
+        disconnected client with a session are kept, see
+        bikey.network.sessions.
+    envs_per_worker -- If above 0, environments are hosted together in worker
+        processes, see bikey.network.scheduler.StepScheduler. pool_size and
+        shared_memory are then ignored.
+    trace -- If True, every request is traced, see bikey.network.tracing.
+    metrics_port -- If not None, the port on which the server's metrics are
+        served at /metrics, see bikey.network.metrics.
+    """
+    asyncio.run(serve(host, port, server_dir, max_connections, pool_size,
+                      matlab_params, shared_memory, local_socket,
+                      session_timeout, envs_per_worker, trace, metrics_port))
+
+
+async def serve(host, port, server_dir, max_connections, pool_size=0,
+                matlab_params=None, shared_memory=False, local_socket=True,
+                session_timeout=DEFAULT_TIMEOUT, envs_per_worker=0,
+                trace=False, metrics_port=None):
+    """
+    Runs the environment server until a shutdown is requested.
+
+    Arguments are the same as those of start_server().
+    """
+    # bind first, if the port is taken nothing has been started that would
+    # have to be stopped again
+    tcp_socket = server_utils.bind_socket(host, port)
+
+    dir_thread, stop_dir_generator, name_queue = \
+        server_utils.setup_name_queue(server_dir)
+
+    stop_server = asyncio.Event()
+
+    if envs_per_worker > 0:
+        pool = StepScheduler(name_queue, envs_per_worker, matlab_params)
+    else:
+        process_class = SharedMemoryEnvProcess if shared_memory \
+            else PipeEnvProcess
+        pool = EnvProcessPool(name_queue, pool_size, process_class,
+                              matlab_params)
+    sessions = SessionRegistry(session_timeout)
+    stats = tracing.StageHistograms()
+    metrics = server_metrics.ServerMetrics(pool, stats, name_queue,
+                                           matlab_params)
+    slots = asyncio.Semaphore(max_connections)
+    clients = {}  # maps the task of every connection to its writer
+
+    async def on_connect(reader, writer):
+        address = writer.get_extra_info('peername')
+        print("Incoming connection from: ", address)
+
+        # determine if the client is running on this machine as well
+        from_server = server_utils.is_local_connection(
+            writer.get_extra_info('socket'), host, address)
+
+        task = asyncio.current_task()
+        clients[task] = writer
+
+        try:
+            await handle_client(reader, writer, from_server, slots,
+                                stop_server, pool, sessions, stats, metrics,
+                                trace)
+        finally:
+            del clients[task]
+
+    servers = [await asyncio.start_server(on_connect, sock=tcp_socket)]
+
+    unix_socket = server_utils.open_local_socket(port) if local_socket \
+        else None
+    if unix_socket is not None:
+        servers.append(await asyncio.start_unix_server(
+            on_connect, sock=unix_socket))
+
+    # the HTTP server runs on a thread of its own, so scrapes never wait for
+    # the event loop
+    httpd = None
+    if metrics_port is not None:
+        httpd = server_metrics.start_http_server(metrics, host, metrics_port)
+        print(f"Serving metrics at http://{host}:{metrics_port}/metrics")
+
+    reaper = asyncio.create_task(reap_sessions(sessions, pool, stop_server))
+
+    print("Waiting for new connections")
+
+    await stop_server.wait()
+    await reaper
+
+    # stop accepting connections and shut down the ones that are still open,
+    # closing a connection makes its handler think the client has left
+    for server in servers:
+        server.close()
+
+    for writer in clients.values():
+        writer.close()
+
+    await asyncio.gather(*clients, return_exceptions=True)
+
+    for server in servers:
+        await server.wait_closed()
+
+    server_utils.close_local_socket(unix_socket, port)
+    server_metrics.stop_http_server(httpd)
+
+    # nobody can pick up the parked sessions anymore
+    parked = sessions.close()
+
+    for env_process in parked:
+        env_process.stop()
+
+    for env_process in parked:
+        await env_process.join_async()
+
+    pool.close()
+
+    # stop the thread that generates working directories
+    stop_dir_generator.set()
+    await asyncio.get_running_loop().run_in_executor(None, dir_thread.join)
+    print("Directory gen. thread is definitely dead")
+
+    print("Environment server has shutdown")
+    print("All coroutines or processes are dead")
+
+
+async def handle_client(reader, writer, from_server, slots, stop_server,
+                        pool, sessions, stats, metrics, trace_all=False):
+    """
+    Handles all communications with one client of the server.
+
+    The messages are handled exactly like in bikey.network.server's
+    handle_client(), including the switch to the binary protocol, compression,
+    shared memory observations, sessions, vectors of environments and
+    tracing.
+
+    Arguments:
+    reader -- The asyncio.StreamReader of the connection
+    writer -- The asyncio.StreamWriter of the connection
+    from_server -- Whether the client runs on the same machine as the server
+    slots -- An asyncio.Semaphore that limits the number of clients that are
+        served simultaneously
+    stop_server -- An asyncio.Event that stops the entire server when set
+    pool -- The EnvProcessPool or StepScheduler providing environment
+        processes
+    sessions -- The SessionRegistry holding sessions of disconnected clients
+    stats -- The tracing.StageHistograms of the server
+    metrics -- The metrics.ServerMetrics of the server, the connection and the
+        requests it answers are reported to it
+    trace_all -- Whether to trace every request
+    """
+    wire_protocol = protocol.JSON
+    requested_protocol = protocol.JSON
+    compression = None
+    requested_compression = None
+    observations = None
+    requested_slots = None
+    messages = protocol.MessageReader(wire_protocol)
+
+    env_processes = []
+    shut_down = False
+
+    session = None
+    closed = False  # whether the client has ended its session
+    retired = []  # processes that are no longer needed by anyone
+
+    connection = metrics.opened(waiting=True)
+    env_type = None
+
+    try:
+        # wait in line until one of the slots is available
+        async with slots:
+            if stop_server.is_set():
+                return
+
+            metrics.admitted(connection)
+
+            # more processes are started if the client asks for a vector of
+            # envs
+            env_processes.append(await _blocking(pool.acquire))
+
+            while not stop_server.is_set():
+                data = await reader.read(messages.chunk_size)
+
+                if not data:
+                    # connection is broken, shut down everything
+                    break
+
+                messages.feed(data)
+
+                for raw_message in messages.messages():
+                    received_at = tracing.stamp()
+                    message = server_utils.decode_client_message(
+                        raw_message, wire_protocol)
+                    responses = None
+                    durations = None
+
+                    if message['command'] == 'close':
+                        # no response, the client disconnects right away
+                        closed = True
+                        continue
+
+                    if message['command'] == 'stats':
+                        responses = [(message, {'command': 'confirm',
+                                                'data': stats.snapshot()})]
+
+                    if message['command'] in ('init', 'resume'):
+                        requested_protocol = message['data'].pop(
+                            'protocol', protocol.JSON)
+                        requested_compression = message['data'].pop(
+                            'compression', None)
+
+                        # shared memory is useless to remote clients
+                        requested_slots = message['data'].pop(
+                            'shared_memory', None)
+                        if not from_server:
+                            requested_slots = None
+
+                        num_envs = message['data'].pop('num_envs', 1)
+
+                        session, env_processes, dropped, responses = \
+                            server_utils.open_session(
+                                sessions, message, num_envs, env_processes)
+                        retired.extend(dropped)
+
+                        env_type = session.env if session is not None \
+                            else message['data'].get('env')
+
+                        while responses is None and \
+                                len(env_processes) < num_envs:
+                            env_processes.append(
+                                await _blocking(pool.acquire))
+
+                    if responses is None:
+                        durations = tracing.begin(message, received_at,
+                                                  trace_all)
+
+                        response = await forward_message(message,
+                                                         env_processes)
+                        responses = [(message, response)]
+
+                        if durations is not None and response is not None:
+                            tracing.finish(durations, response, received_at)
+
+                        if session is not None and response is not None:
+                            session.record(message, response)
+
+                    if responses[0][1] is None:
+                        # the processes are shutting down, they are of no use
+                        # to the pool anymore
+                        shut_down = True
+
+                        if from_server:
+                            # the entire server should be shut down (requested
+                            # by client)
+                            print("Request from same machine")
+                            stop_server.set()
+                            print("Server-wide shutdown initiated")
+
+                        return
+
+                    # replayed responses of a resumed session are not counted
+                    metrics.handled(connection, env_type, *responses[0],
+                                    len(env_processes), received_at)
+
+                    for request, response in responses:
+                        observations = server_utils.share_observations(
+                            request, response, observations, requested_slots)
+
+                        encoding_at = tracing.stamp()
+                        raw_response, wire_protocol, compression = \
+                            server_utils.encode_client_response(
+                                request, response, wire_protocol,
+                                requested_protocol, compression,
+                                requested_compression)
+
+                        sending_at = tracing.stamp()
+                        writer.write(raw_response)
+
+                    await writer.drain()
+
+                    if durations is not None:
+                        durations['server_encode'] = sending_at - encoding_at
+                        durations['server_send'] = \
+                            tracing.stamp() - sending_at
+                        stats.record(durations)
+
+                    # the next message may use a different protocol
+                    messages.protocol = wire_protocol
+
+    except ConnectionError:
+        pass
+
+    finally:
+        metrics.closed(connection)
+
+        if session is not None and not shut_down and not closed and \
+                session.confirmation is not None:
+            # keep the environments for when the client comes back
+            session.env_processes = env_processes
+            retired.extend(sessions.park(session))
+            env_processes = []
+
+        elif session is not None:
+            sessions.forget(session)
+
+        retired.extend(sessions.expired())
+
+        # the connection is broken or the server is stopping, processes go
+        # back to the pool, or shut down if the pool does not need them
+        stopped = [env_process for env_process in env_processes + retired
+                   if shut_down or
+                   not await _blocking(pool.release, env_process)]
+
+        for env_process in stopped:
+            await _blocking(env_process.stop)
+
+        for env_process in stopped:
+            await env_process.join_async()
+
+        if observations is not None:
+            observations.close()
+
+        writer.close()
+
+
+async def reap_sessions(sessions, pool, stop_server):
+    """
+    Closes the sessions that have been parked for too long, until the server
+    stops. This is the asyncio counterpart of
+    bikey.network.server.reap_sessions().
+
+    Arguments:
+    sessions -- The SessionRegistry of the server
+    pool -- The EnvProcessPool or StepScheduler of the server
+    stop_server -- An asyncio.Event that is set when the server stops
+    """
+    while True:
+        try:
+            await asyncio.wait_for(stop_server.wait(), sessions.reap_interval)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            # the server is stopping, it closes all sessions itself
+            return
+
+        stopped = [env_process for env_process in sessions.expired()
+                   if not await _blocking(pool.release, env_process)]
+
+        for env_process in stopped:
+            await _blocking(env_process.stop)
+
+        for env_process in stopped:
+            await env_process.join_async()
+
+
+async def forward_message(message, env_processes):
+    """
+    Forwards a message of a client to its environment processes.
+
+    This is the asyncio counterpart of bikey.network.server.forward_message().
+
+    Arguments:
+    message -- The message received from the client, already decoded.
+    env_processes -- A list of PipeEnvProcess instances serving the client.
+
+    Returns:
+    The response for the client, or None if the environment processes have
+    shut down.
+    """
+    if len(env_processes) == 1:
+        return await env_processes[0].request_async(message)
+
+    messages = server_utils.scatter_message(message, len(env_processes))
+
+    for env_process, env_message in zip(env_processes, messages):
+        await env_process.send_async(env_message)
+
+    responses = [await env_process.receive_async()
+                 for env_process in env_processes]
+
+    if any(response is None for response in responses):
+        return None
+
+    # start new episodes for finished environments, so the client can keep
+    # stepping
+    resets = {i: await env_processes[i].request_async({'command': 'reset'})
+              for i in server_utils.finished_envs(message, responses)}
+
+    return server_utils.gather_responses(message, responses, resets)
+
+
+async def _blocking(function, *args):
+    """
+    Calls a function that may block, such as starting a process, in the
+    loop's executor, so the other clients are served in the meantime.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, function, *args)
@@ -1,9 +1,354 @@
 import gym
-import bikey.bicycle
+import bikey.surrogate
+import bikey.replay
+import asyncio
+import multiprocessing as mp
 import os
+import threading
 
+from . import tracing
+from .shared_slots import ProcessChannel, ServerChannel
 
-def run_environment(message_queue, response_queue, name_queue):
+
+class EnvProcess:
+    """
+    The server's handle on a process that runs run_environment().
+
+    Messages are sent to the process with send(), and every message except None
+    results in exactly one response that can be picked up with receive().
+    """
+
+    def __init__(self, name_queue, matlab_params=None):
+        """
+        Starts a new process running run_environment().
+
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments, see run_environment().
+        matlab_params -- If not None, the process starts a Matlab session with
+            these parameters in advance, see run_environment().
+        """
+        self.message_queue = mp.Queue()
+        self.response_queue = mp.Queue()
+
+        self.process = mp.Process(
+            target=run_environment,
+            args=(self.message_queue, self.response_queue, name_queue,
+                  matlab_params))
+
+        self.process.start()
+
+    def send(self, message):
+        """
+        Pass a message on to the environment process.
+        """
+        self.message_queue.put(message)
+
+    def receive(self):
+        """
+        Wait for the next response of the environment process.
+        """
+        return self.response_queue.get()
+
+    def request(self, message):
+        """
+        Send a message and wait for the response to it.
+        """
+        self.send(message)
+        return self.receive()
+
+    def stop(self):
+        """
+        Tell the process to shut down, unless it already has.
+        """
+        if self.process.is_alive():
+            self.message_queue.put(None)
+
+    def join(self):
+        """
+        Wait for the process to exit.
+        """
+        self.process.join()
+
+
+class PipeEnvProcess(EnvProcess):
+    """
+    An EnvProcess that communicates through a pipe instead of two queues.
+
+    Unlike a multiprocessing.Queue, the server's end of the pipe can be watched
+    by an asyncio event loop, so the loop only has to wait for a response once
+    it has started to arrive. See receive_async().
+    """
+
+    def __init__(self, name_queue, matlab_params=None):
+        """
+        Starts a new process running run_environment().
+
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments, see run_environment().
+        matlab_params -- If not None, the process starts a Matlab session with
+            these parameters in advance, see run_environment().
+        """
+        self.connection, child_connection = mp.Pipe()
+
+        # run_environment() gets and puts messages like it does with queues
+        channel = self._child_channel(child_connection)
+
+        self.process = mp.Process(
+            target=run_environment,
+            args=(channel, channel, name_queue, matlab_params))
+
+        self.process.start()
+
+        # the child's end of the pipe is only needed in the child
+        child_connection.close()
+
+    def send(self, message):
+        """
+        Pass a message on to the environment process.
+        """
+        self.connection.send(message)
+
+    def receive(self):
+        """
+        Wait for the next response of the environment process.
+        """
+        try:
+            return self.connection.recv()
+        except EOFError:
+            # the process has died
+            return None
+
+    async def send_async(self, message):
+        """
+        Pass a message on without blocking the running event loop.
+
+        Sending blocks while the pipe is full, so it is done by the loop's
+        executor.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.send, message)
+
+    async def receive_async(self):
+        """
+        Wait for the next response without blocking the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        fileno = self.connection.fileno()
+        loop.add_reader(
+            fileno, lambda: readable.done() or readable.set_result(None))
+
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fileno)
+
+        # the rest of a large response may still be on its way
+        return await loop.run_in_executor(None, self.receive)
+
+    async def request_async(self, message):
+        """
+        Send a message and wait for the response without blocking the loop.
+        """
+        await self.send_async(message)
+        return await self.receive_async()
+
+    async def join_async(self):
+        """
+        Wait for the process to exit without blocking the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+
+        # the sentinel becomes readable once the process has exited
+        sentinel = self.process.sentinel
+        loop.add_reader(
+            sentinel, lambda: exited.done() or exited.set_result(None))
+
+        try:
+            await exited
+        finally:
+            loop.remove_reader(sentinel)
+
+        self.join()
+
+    def stop(self):
+        """
+        Tell the process to shut down, unless it already has.
+        """
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+
+    def join(self):
+        """
+        Wait for the process to exit.
+        """
+        self.process.join()
+        self.connection.close()
+
+    def _child_channel(self, connection):
+        return _PipeChannel(connection)
+
+
+class SharedMemoryEnvProcess(PipeEnvProcess):
+    """
+    A PipeEnvProcess that passes actions and observations through shared
+    memory.
+
+    Pickling messages and pushing them through a pipe takes a lot longer than
+    the step of a fast environment. Once the environment has been initialized,
+    actions and observations are written into preallocated slots in shared
+    memory instead, and only a small control message goes through the pipe,
+    see bikey.network.shared_slots. Other messages are sent as usual.
+
+    Observations received from the process are read-only views on the shared
+    memory. They stay valid until as many further messages as there are slots
+    have been exchanged, so they should be copied (e.g. encoded for the
+    client) before then.
+    """
+
+    def __init__(self, name_queue, matlab_params=None, slots=4):
+        """
+        Starts a new process running run_environment().
+
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments, see run_environment().
+        matlab_params -- If not None, the process starts a Matlab session with
+            these parameters in advance, see run_environment().
+        slots -- The number of slots for actions and for observations.
+        """
+        super().__init__(name_queue, matlab_params)
+
+        # the channel behaves like the server's end of the pipe
+        self.connection = ServerChannel(self.connection, slots)
+
+    def _child_channel(self, connection):
+        return ProcessChannel(connection)
+
+
+class EnvProcessPool:
+    """
+    Keeps a number of environment processes ready for new clients.
+
+    Starting a process, importing gym and bikey, and especially starting Matlab
+    takes a long time. The pool does this in advance, and processes are reused
+    once their client has left: the environment is closed, but the process
+    (and its Matlab session) stays alive.
+
+    The pool is safe to use from several threads.
+    """
+
+    def __init__(self, name_queue, size, process_class=EnvProcess,
+                 matlab_params=None):
+        """
+        Starts the processes of the pool.
+
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments, see run_environment().
+        size -- The number of idle processes kept ready. If no idle process is
+            available when one is needed, a new one is started.
+        process_class -- EnvProcess, or PipeEnvProcess for asyncio servers.
+            SharedMemoryEnvProcess can be used by both.
+        matlab_params -- If not None, every process starts a Matlab session
+            with these parameters in advance, see run_environment().
+        """
+        self.name_queue = name_queue
+        self.size = size
+        self.process_class = process_class
+        self.matlab_params = matlab_params
+
+        self.lock = threading.Lock()
+        self.idle = [self._start_process() for _ in range(size)]
+
+    def acquire(self):
+        """
+        Returns an idle environment process, or a new one if there are none.
+        """
+        with self.lock:
+            while self.idle:
+                env_process = self.idle.pop()
+
+                if env_process.process.is_alive():
+                    return env_process
+
+                env_process.join()
+
+        return self._start_process()
+
+    def release(self, env_process):
+        """
+        Hands a process back to the pool after its client has left.
+
+        The process closes its environment and becomes idle. If the pool
+        already has enough idle processes it is told to shut down instead.
+
+        Arguments:
+        env_process -- A process that was obtained with acquire().
+
+        Returns:
+        True if the process is kept by the pool. If False, the process is
+        shutting down, and the caller should join() it.
+        """
+        if env_process.process.is_alive():
+            env_process.send({'command': 'release'})
+
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(env_process)
+                    return True
+
+        env_process.stop()
+        return False
+
+    def status(self):
+        """
+        Returns the number of idle processes in 'idle'.
+        """
+        with self.lock:
+            return {'idle': len(self.idle)}
+
+    def close(self):
+        """
+        Shuts down all idle processes.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for env_process in idle:
+            env_process.stop()
+
+        for env_process in idle:
+            env_process.join()
+
+    def _start_process(self):
+        return self.process_class(self.name_queue, self.matlab_params)
+
+
+class _PipeChannel:
+    """
+    Gives one end of a pipe the get() and put() methods of a queue.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get(self):
+        return self.connection.recv()
+
+    def put(self, item):
+        self.connection.send(item)
+
+
+def run_environment(message_queue, response_queue, name_queue,
+                    matlab_params=None):
     """
     Sets up an environment and controls it.
 
@@ -12,18 +357,32 @@ def run_environment(message_queue, response_queue, name_queue):
     with the server. When None is received through the message_queue, this
     process will shut down.
 
+    After a 'release' command the environment is closed, but the process stays
+    alive and waits for the next 'init' command. This allows the server to
+    reuse processes, see EnvProcessPool. No response is sent for 'release'.
+
+    If matlab_params is not None a Matlab session is started right away, before
+    any client has connected. It is handed to every BicycleEnv created by this
+    process, which saves the time needed to start Matlab.
+
     Arguments:
     message_queue -- Any requests will come in through this queue
     response_queue -- Once a request is done, a confirmation needs to be put in
         this queue.
     name_queue -- A queue that provides working directories to supported
         environments. Currently only used for BicycleEnv-v0.
+    matlab_params -- If not None, parameters of a Matlab session that is
+        started in advance.
     """
     # print("Initialized new process")
-    initialized = False
-    reset = False
+    session = None
+
+    if matlab_params is not None:
+        # imported here, so processes that do not need Matlab never touch it
+        import matlab.engine
+        session = matlab.engine.start_matlab(matlab_params)
 
-    env = None
+    host = EnvHost(name_queue, {'matlab_session': session})
 
     while True:
         # process incoming messages
@@ -31,8 +390,10 @@ def run_environment(message_queue, response_queue, name_queue):
 
         if message is None:
             # handler thread wants this process to die
-            if initialized:
-                env.close()
+            host.close()
+
+            if session is not None:
+                session.quit()
 
             # note: the associated thread is not waiting for a response, so we
             # can just exit this process
@@ -40,16 +401,167 @@ def run_environment(message_queue, response_queue, name_queue):
 
         command = message['command']
 
+        if command == 'release':
+            # the client has left, get ready for the next one
+            host.close()
+            continue
+
+        if command == 'shut_down_server':
+            # a client has requested the entire server to shut down
+            host.close()
+
+            if session is not None:
+                session.quit()
+
+            # this event needs to be communicated with the rest of the server
+            response_queue.put(None)
+            break  # now let this process die
+
+        response_queue.put(host.handle(message))
+
+
+def run_environments(connection, name_queue, matlab_params=None):
+    """
+    Hosts several environments in one process, see
+    bikey.network.scheduler.StepScheduler.
+
+    Requests arrive in batches: a list of (slot, message) tuples, where the
+    slot identifies the environment. The messages are handled in order, and
+    one list with a response for every message is sent back. A message of
+    None closes the environment in its slot, its response is None. Errors are
+    reported in the response of the message that caused them (see
+    EnvHost.handle()), so the other environments of the process carry on.
+    When None is received instead of a batch, this process will shut down.
+
+    If matlab_params is not None, the BicycleEnvs in this process lease their
+    Matlab sessions from a bikey.engine_pool.EnginePool, so sessions are
+    reused by the environments that come after them.
+
+    Arguments:
+    connection -- The process's end of a pipe to the server
+    name_queue -- A queue that provides working directories to supported
+        environments, see run_environment().
+    matlab_params -- If not None, parameters of the Matlab sessions.
+    """
+    config = {}
+
+    if matlab_params is not None:
+        from bikey.engine_pool import EnginePool
+        config['engine_pool'] = EnginePool(matlab_params=matlab_params)
+
+    hosts = {}
+
+    while True:
+        batch = connection.recv()
+
+        if batch is None:
+            break
+
+        responses = []
+
+        for slot, message in batch:
+            if message is None:
+                host = hosts.pop(slot, None)
+                if host is not None:
+                    host.close()
+
+                responses.append(None)
+                continue
+
+            if slot not in hosts:
+                hosts[slot] = EnvHost(name_queue, config)
+
+            responses.append(hosts[slot].handle(message))
+
+        connection.send(responses)
+
+    for host in hosts.values():
+        host.close()
+
+    if 'engine_pool' in config:
+        config['engine_pool'].close()
+
+
+class EnvHost:
+    """
+    Executes the commands of one client on its environment.
+
+    Used by run_environment() and run_environments(), which deal with the
+    commands that concern the process rather than the environment.
+    """
+
+    def __init__(self, name_queue, bicycle_config=None):
+        """
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments. Currently only used for BicycleEnv-v0.
+        bicycle_config -- Extra parameters for every BicycleEnv, such as a
+            Matlab session. Parameters that are None are left out.
+        """
+        self.name_queue = name_queue
+        self.bicycle_config = {key: value for key, value
+                               in (bicycle_config or {}).items()
+                               if value is not None}
+
+        self.env = None
+        self.reset = False
+
+    def handle(self, message):
+        """
+        Executes a command.
+
+        Commands that cannot be executed, and exceptions raised by the
+        environment, are answered with an error response (see
+        error_response()) instead of taking down the process.
+
+        If the server traces the command, the response gets the times at which
+        the command was received and answered, and the time spent in Matlab,
+        see bikey.network.tracing.
+
+        Returns:
+        The response.
+        """
+        sent_at = message.pop('trace', None)
+
+        if sent_at is None:
+            return self._try_execute(message)
+
+        received_at = tracing.stamp()
+        before = tracing.engine_usage(self.env)
+
+        response = self._try_execute(message)
+
+        engine = tracing.engine_durations(
+            before, tracing.engine_usage(self.env))
+        response['trace'] = tracing.env_trace(sent_at, received_at, engine)
+
+        return response
+
+    def _try_execute(self, message):
+        try:
+            return self._execute(message)
+        except Exception as error:
+            return error_response(
+                f"The '{message['command']}' command failed: {error!r}")
+
+    def _execute(self, message):
+        initialized = self.env is not None
+        command = message['command']
+
         if command == 'init':
             if initialized:
-                # TODO already initialized, command inappropriate
-                continue
+                return error_response(
+                    "The environment has already been initialized")
 
             data = message['data']
 
             if data['env'] == 'BicycleEnv-v0':
+                # imported here, so a server without Matlab installed can
+                # still serve the environments that do not need it
+                import bikey.bicycle
+
                 # TODO make this env ID check future proof for new versions
-                name = name_queue.get()
+                name = self.name_queue.get()
                 if 'config' in data:
                     data['config']['working_dir'] = name
                 else:
@@ -58,46 +570,53 @@ def run_environment(message_queue, response_queue, name_queue):
                 # only a name has been generated, now create the directory
                 os.makedirs(name)
 
-            env = gym.make(data['env'], **data['config'])
-            initialized = True
+                data['config'].update(self.bicycle_config)
+
+            self.env = gym.make(data['env'], **data['config'])
             # print("Initialized environment")
 
-            response_queue.put({
+            return {
                 'command': 'confirm',
                 'data': {
                     # send the client information about the observation and action
                     # spaces so it can reconstruct them
-                    'observation_space': gym_space_to_dict(env.observation_space),
-                    'action_space': gym_space_to_dict(env.action_space)
+                    'observation_space': gym_space_to_dict(self.env.observation_space),
+                    'action_space': gym_space_to_dict(self.env.action_space)
                 }
-            })
+            }
 
         elif command == 'reset':
             if not initialized:
-                # TODO not yet initialized, command inappropriate
-                continue
+                return error_response(
+                    "The environment has not been initialized")
 
-            observation = env.reset()
-            reset = True
+            observation = self.env.reset()
+            self.reset = True
 
             # print('Reset the environment')
 
-            response_queue.put({
+            return {
                 'command': 'confirm',
                 'data': {
                     'observation': observation
                 }
-            })
+            }
 
         elif command == 'step':
-            if not reset:
-                # TODO not yet reset, command inappropriate
-                continue
+            if not self.reset:
+                return error_response("The environment has not been reset")
 
             action = message['data']['action']
-            observation, reward, done, info = env.step(action)
+            result = self.env.step(action)
 
-            response_queue.put({
+            if result is None:
+                # e.g. a SpacarEnv whose episode is done
+                return error_response(
+                    "The episode is done, the environment should be reset")
+
+            observation, reward, done, info = result
+
+            return {
                 'command': 'confirm',
                 'data': {
                     'observation': observation,
@@ -105,23 +624,33 @@ def run_environment(message_queue, response_queue, name_queue):
                     'done': done,
                     'info': info
                 }
-            })
+            }
 
-        elif command == 'shut_down_server':
-            # a client has requested the entire server to shut down
+        else:
+            # the client's handler waits for a response, so there always is
+            # one
+            return error_response(f"Unsupported command '{command}'")
 
-            if initialized:
-                env.close()
+    def close(self):
+        """
+        Closes the environment, if there is one.
+        """
+        if self.env is not None:
+            self.env.close()
 
-            # this event needs to be communicated with the rest of the server
-            response_queue.put(None)
-            break  # now let this process die
+        self.env = None
+        self.reset = False
 
-        else:
-            # TODO unsupported command, raise error
-            # do not forget to put an item on the response queue, or the thread
-            # will block, and so will everything else
-            pass
+
+def error_response(text):
+    """
+    Returns the response to a command that could not be executed.
+
+    Arguments:
+    text -- A description of the problem, which the client raises as the
+        message of an error.
+    """
+    return {'command': 'error', 'data': {'message': text}}
 
 
 def gym_space_to_dict(space):
@@ -0,0 +1,373 @@
+import collections
+import http.server
+import itertools
+import multiprocessing as mp
+import threading
+import time
+
+import gym
+
+from . import tracing
+
+# Metrics of an environment server for monitoring, capacity planning and
+# autoscaling, served over HTTP in the text format of Prometheus (see
+# start_http_server()):
+#
+#   bikey_connections                  gauge      clients being served
+#   bikey_waiting_connections          gauge      clients waiting for a free
+#                                                 slot of an asyncio server
+#   bikey_envs{env}                    gauge      environments of those clients
+#   bikey_env_processes                gauge      environment and worker
+#                                                 processes of the server
+#   bikey_idle_env_processes           gauge      processes kept ready by the
+#                                                 pool
+#   bikey_scheduler_workers            gauge      worker processes of a
+#                                                 StepScheduler
+#   bikey_scheduler_pending_requests   gauge      requests waiting for a busy
+#                                                 worker
+#   bikey_matlab_sessions              gauge      estimated Matlab sessions
+#   bikey_name_queue_size              gauge      working directories ready to
+#                                                 be used, see provide_names()
+#   bikey_steps_total{env}             counter    steps taken per environment
+#                                                 type
+#   bikey_resets_total{env}            counter    resets per environment type
+#   bikey_step_duration_seconds{env}   histogram  time from receiving a step
+#                                                 until its response is ready
+#   bikey_stage_duration_seconds{stage} histogram the stages of traced
+#                                                 requests, see tracing
+#   bikey_uptime_seconds               gauge      time since the server started
+#
+# Steps and resets of a vector of environments count once per environment.
+# Rates, such as the steps per second, follow from the counters, e.g.
+# rate(bikey_steps_total[1m]) in Prometheus.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class ServerMetrics:
+    """
+    Keeps track of what an environment server is doing.
+
+    The server's handlers report their connections and the requests they have
+    answered, other metrics are collected from the pool, the name queue and
+    the tracing histograms when the metrics are rendered. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, pool, stats, name_queue, matlab_params=None):
+        """
+        Arguments:
+        pool -- The EnvProcessPool or StepScheduler of the server
+        stats -- The tracing.StageHistograms of the server
+        name_queue -- The queue of working directories of the server
+        matlab_params -- The Matlab parameters of the server's processes, if
+            any
+        """
+        self.pool = pool
+        self.stats = stats
+        self.name_queue = name_queue
+        self.matlab_params = matlab_params
+
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.keys = itertools.count()
+
+        self.connections = {}  # maps connections to (env type, num envs)
+        self.waiting = set()  # connections that are not served yet
+        self.steps = collections.Counter()
+        self.resets = collections.Counter()
+        self.step_durations = tracing.StageHistograms()
+
+    def opened(self, waiting=False):
+        """
+        Registers a new connection.
+
+        Arguments:
+        waiting -- If True, the connection waits in line until admitted() is
+            called.
+
+        Returns:
+        A key that identifies the connection in later calls.
+        """
+        with self.lock:
+            key = next(self.keys)
+            self.connections[key] = (None, 0)
+
+            if waiting:
+                self.waiting.add(key)
+
+        return key
+
+    def admitted(self, connection):
+        """
+        Registers that a waiting connection is being served.
+        """
+        with self.lock:
+            self.waiting.discard(connection)
+
+    def closed(self, connection):
+        """
+        Registers the end of a connection.
+        """
+        with self.lock:
+            self.connections.pop(connection, None)
+            self.waiting.discard(connection)
+
+    def handled(self, connection, env_type, message, response, num_envs,
+                received_at):
+        """
+        Registers a response that is about to be sent to a client.
+
+        Arguments:
+        connection -- The key returned by opened()
+        env_type -- The environment of the client, or None if unknown
+        message -- The message the response belongs to
+        response -- The response
+        num_envs -- The number of environments of the client
+        received_at -- The tracing.stamp() at which the message was received
+        """
+        command = message['command']
+
+        if response['command'] != 'confirm':
+            return
+
+        with self.lock:
+            if command in ('init', 'resume'):
+                self.connections[connection] = (env_type, num_envs)
+
+            elif command == 'step':
+                self.steps[env_type] += num_envs
+
+            elif command == 'reset':
+                self.resets[env_type] += num_envs
+
+        if command == 'step':
+            self.step_durations.record(
+                {env_type: tracing.stamp() - received_at})
+
+    def render(self):
+        """
+        Returns all metrics in the text format of Prometheus.
+        """
+        with self.lock:
+            envs = collections.Counter()
+            for env_type, num_envs in self.connections.values():
+                if env_type is not None:
+                    envs[env_type] += num_envs
+
+            waiting = len(self.waiting)
+            connections = len(self.connections) - waiting
+            steps = dict(self.steps)
+            resets = dict(self.resets)
+
+        processes = len(mp.active_children())
+
+        # every process started with Matlab parameters keeps its session,
+        # otherwise every Matlab-based environment has one
+        sessions = sum(num_envs for env_type, num_envs in envs.items()
+                       if _uses_matlab(env_type))
+        if self.matlab_params is not None:
+            sessions = max(sessions, processes)
+
+        lines = []
+
+        _gauge(lines, 'bikey_connections', 'Clients being served.',
+               {(): connections})
+        _gauge(lines, 'bikey_waiting_connections',
+               'Clients waiting for a free slot.', {(): waiting})
+        _gauge(lines, 'bikey_envs', 'Environments of the connected clients.',
+               {(('env', env_type),): count
+                for env_type, count in envs.items()})
+        _gauge(lines, 'bikey_env_processes',
+               'Environment and worker processes of the server.',
+               {(): processes})
+
+        status = self.pool.status()
+        if 'idle' in status:
+            _gauge(lines, 'bikey_idle_env_processes',
+                   'Environment processes kept ready by the pool.',
+                   {(): status['idle']})
+        if 'workers' in status:
+            _gauge(lines, 'bikey_scheduler_workers',
+                   'Worker processes of the step scheduler.',
+                   {(): status['workers']})
+            _gauge(lines, 'bikey_scheduler_pending_requests',
+                   'Requests waiting for a busy worker.',
+                   {(): status['pending']})
+
+        _gauge(lines, 'bikey_matlab_sessions',
+               'Estimated number of Matlab sessions.', {(): sessions})
+
+        try:
+            _gauge(lines, 'bikey_name_queue_size',
+                   'Working directories that are ready to be used.',
+                   {(): self.name_queue.qsize()})
+        except NotImplementedError:
+            # e.g. on macOS
+            pass
+
+        _counter(lines, 'bikey_steps_total', 'Steps per environment type.',
+                 {(('env', env_type),): count
+                  for env_type, count in steps.items()})
+        _counter(lines, 'bikey_resets_total', 'Resets per environment type.',
+                 {(('env', env_type),): count
+                  for env_type, count in resets.items()})
+
+        _histograms(lines, 'bikey_step_duration_seconds',
+                    'Time from receiving a step until its response is ready.',
+                    'env', self.step_durations.snapshot())
+
+        stages = self.stats.snapshot()
+        # the number of engine calls is not a duration
+        stages['stages'].pop('engine_calls', None)
+        _histograms(lines, 'bikey_stage_duration_seconds',
+                    'Durations of the stages of traced requests.', 'stage',
+                    stages)
+
+        _gauge(lines, 'bikey_uptime_seconds',
+               'Time since the server started.',
+               {(): time.monotonic() - self.started})
+
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = None  # set by start_http_server()
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.metrics.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the server's output
+        pass
+
+
+def start_http_server(metrics, host, port):
+    """
+    Serves the metrics at http://<host>:<port>/metrics, on a thread of its own.
+
+    Arguments:
+    metrics -- The ServerMetrics that are served
+    host -- The interface to listen on
+    port -- The port to listen on
+
+    Returns:
+    The http.server.ThreadingHTTPServer, which should be passed to
+    stop_http_server() when the environment server shuts down.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'metrics': metrics})
+
+    httpd = http.server.ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    return httpd
+
+
+def stop_http_server(httpd):
+    """
+    Stops a server started with start_http_server().
+    """
+    if httpd is not None:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+_matlab_envs = {}  # caches _uses_matlab()
+
+
+def _uses_matlab(env_type):
+    """
+    Returns whether a registered gym environment is a SpacarEnv.
+    """
+    if env_type not in _matlab_envs:
+        try:
+            # imported here, so the server runs without Matlab installed, in
+            # which case no environment uses it. bikey.bicycle registers
+            # BicycleEnv-v0
+            import bikey.bicycle
+            from bikey.spacar import SpacarEnv
+
+            entry_point = gym.spec(env_type).entry_point
+
+            if isinstance(entry_point, str):
+                entry_point = gym.envs.registration.load(entry_point)
+
+            _matlab_envs[env_type] = isinstance(entry_point, type) and \
+                issubclass(entry_point, SpacarEnv)
+
+        except Exception:
+            _matlab_envs[env_type] = False
+
+    return _matlab_envs[env_type]
+
+
+def _gauge(lines, name, description, samples):
+    _metric(lines, name, description, 'gauge', samples)
+
+
+def _counter(lines, name, description, samples):
+    _metric(lines, name, description, 'counter', samples)
+
+
+def _metric(lines, name, description, kind, samples):
+    """
+    Adds a metric to lines.
+
+    Arguments:
+    samples -- A dictionary mapping tuples of (label, value) tuples to values
+    """
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {kind}')
+
+    for labels, value in samples.items():
+        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+
+def _histograms(lines, name, description, label, snapshot):
+    """
+    Adds the histograms of a tracing.StageHistograms snapshot to lines, with
+    the keys of the histograms as the values of label.
+    """
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} histogram')
+
+    bounds = [_number(bound) for bound in snapshot['buckets']] + ['+Inf']
+
+    for key, histogram in snapshot['stages'].items():
+        # Prometheus buckets are cumulative
+        cumulative = itertools.accumulate(histogram['counts'])
+
+        for bound, count in zip(bounds, cumulative):
+            labels = _labels(((label, key), ('le', bound)))
+            lines.append(f'{name}_bucket{labels} {count}')
+
+        labels = _labels(((label, key),))
+        lines.append(f"{name}_sum{labels} {_number(histogram['sum'])}")
+        lines.append(f"{name}_count{labels} {histogram['count']}")
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    escaped = ['{}="{}"'.format(
+        label, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for label, value in labels]
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
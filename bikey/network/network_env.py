@@ -1,7 +1,33 @@
+import collections
 import gym
+import ipaddress
+import os
 import socket
-import json
+import time
 import numpy as np
+from gym.vector.utils import batch_space
+
+from . import protocol
+from . import tracing
+from .shared_slots import SlotRing
+
+# the number of slots in the ring of observations, see NetworkEnv
+SHARED_MEMORY_SLOTS = 8
+
+# how often, and how many seconds apart, a session is resumed after the
+# connection broke, or a named session is picked up. The server may not have
+# noticed yet that the previous connection of the session is gone
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 0.5
+
+
+class ServerError(Exception):
+    """
+    Raised when the server answers a request with an error, e.g. because the
+    environment raised an exception. The message is the server's description
+    of the error.
+    """
+    pass
 
 
 class NetworkEnv(gym.Env):
@@ -18,17 +44,58 @@ class NetworkEnv(gym.Env):
     the network. If this project continues, this will change in a future
     version.
 
-    The communication is performed on a TCP connection, and data is transmitted
-    in JSON form. Messages are delimited using the '<END>' token, meaning this
-    token should not be part of any of the data you send. At the moment the
+    The communication is performed on a TCP connection. The init command is
+    always transmitted in JSON form, delimited using the '<END>' token. In it
+    the client asks for the binary protocol (see bikey.network.protocol), which
+    sends actions and observations as raw array bytes in length-prefixed
+    frames. Servers that do not know about the binary protocol will not
+    confirm it, in which case all messages stay in JSON form. At the moment the
     actions and observations are expected to be numpy arrays, this may change
     in a future version.
-    """
-    _delimiter = b'<END>'
-    _encoding = 'utf-8'
-    _read_buffer = b''
 
-    def __init__(self, address, port, env_name, **env_config):
+    Large observations can be compressed by the server. The client proposes
+    the compression settings in the init command, and the server confirms the
+    ones it supports, see bikey.network.protocol.Compression. Compression
+    requires the binary protocol.
+
+    If the server runs on the same machine, the client connects to the
+    server's Unix domain socket instead of its TCP port, which avoids the
+    overhead of the TCP stack. Such a client can also ask the server to put
+    the observations in shared memory, in which case only the index of a slot
+    is sent over the socket, see server_utils.share_observations().
+
+    Every request carries an 'id' that the server copies into its response.
+    This allows several requests to be in flight at once: step_async() sends a
+    step without waiting for the response, which is picked up later with
+    step_wait(). In the meantime the agent can do other work, such as computing
+    its next actions, instead of waiting for the network. The server handles
+    requests in the order in which they were sent.
+
+    With a session, the server keeps the environment alive for a while when
+    the connection breaks (see bikey.network.sessions). The client then
+    reconnects by itself and resumes where it left off: responses that were
+    lost are sent again, and requests that never reached the server are
+    repeated. A named session is also kept after close(), so a new NetworkEnv
+    with the same name gets the warm environment instead of a new one.
+
+    With trace, every request is timed at every stage on its way to the
+    environment and back, see bikey.network.tracing. The durations of the
+    stages of the last request are kept in last_trace, and step() also
+    returns them in info['trace'].
+    """
+    _protocol = protocol.JSON
+    _observations = None
+    _session = None
+    _trace = False
+
+    # the durations of the stages of the last traced request
+    last_trace = None
+
+    def __init__(self, address, port, env_name, wire_protocol=protocol.BINARY,
+                 chunk_size=protocol.DEFAULT_CHUNK_SIZE, compression=None,
+                 compression_threshold=1024, delta_encoding=False, local=None,
+                 shared_memory=False, session=None, trace=False,
+                 **env_config):
         """
         Connects to the server and tells it to initialize the environment.
 
@@ -36,21 +103,111 @@ class NetworkEnv(gym.Env):
         address -- The IPv4 address of the server
         port -- The port number to connect to
         env_name -- Name of the environment passed to gym.make()
+        wire_protocol -- The protocol requested from the server, 'binary' or
+            'json'. The server decides which one is used.
+        chunk_size -- The number of bytes received from the socket at once.
+        compression -- The compression method requested from the server,
+            'zlib' or 'lz4', or None for no compression.
+        compression_threshold -- Frames with fewer array bytes than this are
+            not compressed.
+        delta_encoding -- If True, the server sends observations as the
+            difference with the previous observation before compressing them.
+        local -- Whether to connect through the server's Unix domain socket.
+            If None, it is used when the server runs on this machine and the
+            socket exists, otherwise TCP is used.
+        shared_memory -- If True, and the connection is local, the server
+            passes the observations through shared memory.
+        session -- None for no session, True for a session that is resumed
+            when the connection breaks, or the name of a session that can also
+            be picked up by later NetworkEnvs with the same name and
+            environment.
+        trace -- If True, the stages of every request are timed.
         env_config -- Optional parameters passed to the gym.make()
         """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((address, port))
+        self._trace = trace
+
+        init_data = {'env': env_name, 'config': env_config,
+                     'protocol': wire_protocol}
+        init_data.update(_compression_request(
+            compression, compression_threshold, delta_encoding))
+        init_data.update(_session_request(session))
+
+        self._initialize(address, port, init_data, chunk_size, local,
+                         shared_memory)
+
+    def _initialize(self, address, port, init_data,
+                    chunk_size=protocol.DEFAULT_CHUNK_SIZE, local=None,
+                    shared_memory=False):
+        """
+        Connects to the server and sends the init command.
+
+        Arguments:
+        address -- The IPv4 address of the server
+        port -- The port number to connect to
+        init_data -- The data of the init command
+        chunk_size -- The number of bytes received from the socket at once
+        local -- Whether to use the server's Unix domain socket, see
+            NetworkEnv.__init__()
+        shared_memory -- Whether to ask for shared memory observations
+
+        Returns:
+        The data of the server's confirmation.
+
+        Raises:
+        ConnectionError if the named session stays in use by another
+        connection for all RESUME_ATTEMPTS.
+        ServerError if the server could not initialize the environment.
+        """
+        # kept for reconnecting, see _reconnect()
+        self._address = (address, port, local, shared_memory)
+        self._settings = {key: value for key, value in init_data.items()
+                          if key in ('protocol', 'compression')}
+        self._named_session = bool(init_data.get('session'))
+        self._reconnecting = False
+
+        # requests that have been sent, but whose responses have not been
+        # picked up yet. With a session the requests themselves are kept as
+        # well, so they can be repeated after a reconnect
+        self._next_request_id = 0
+        self._pending = collections.deque()
+        self._responses = {}
+        self._requests = {}
+        self._sent = {}  # when traced requests were sent, see _send_command()
+
+        for attempt in range(RESUME_ATTEMPTS):
+            if attempt > 0:
+                # the session is still in use by a previous connection
+                self.socket.close()
+                time.sleep(RESUME_DELAY)
+
+            self._connect(chunk_size)
+
+            # the server only shares its memory with clients on the same
+            # machine
+            if shared_memory and self.socket.family != socket.AF_INET:
+                init_data['shared_memory'] = SHARED_MEMORY_SLOTS
 
-        print('Connected to server, sending command')
+            print('Connected to server, sending command')
 
-        self._send_command('init', {'env': env_name, 'config': env_config})
+            request_id = self._send_request('init', init_data)
 
-        print('Sent init command, waiting for response')
+            print('Sent init command, waiting for response')
 
-        response = self._receive_command()
-        print("Response received: ", response)
+            response = self._wait_for(request_id)
+            print("Response received: ", response)
+
+            if not (response.get('data') or {}).get('retry'):
+                break
+
+        else:
+            # the session stayed in use by another connection
+            self.socket.close()
+            raise ConnectionError(response['data']['message'])
 
         if response['command'] == 'confirm':
+            self._apply_confirmation(response['data'])
+            self._session = response['data'].get('session')
+
             # mimic the observation space on the server
             obs_description = response['data']['observation_space']
             self.observation_space = dict_to_gym_space(obs_description)
@@ -61,26 +218,29 @@ class NetworkEnv(gym.Env):
 
         else:
             print("Did not receive confirmation of initialization")
-            # TODO something went wrong!
-            pass
+            self.socket.close()
+            _raise_error(response)
 
         print("NetworkEnv initiated")
 
+        return response['data']
+
     def reset(self):
         """
         Tells the server to reset the environment, returns initial observation.
 
         Returns:
         Initial observation as defined by the used environment.
+
+        Raises:
+        ServerError if the environment could not be reset.
         """
-        self._send_command('reset')
-        response = self._receive_command()
+        response = self._wait_for(self._send_request('reset'))
 
         if response['command'] != 'confirm':
-            # TODO something went wrong!
-            pass
+            _raise_error(response)
 
-        return np.array(response['data']['observation'])
+        return np.asarray(response['data']['observation'])
 
     def step(self, action):
         """
@@ -96,41 +256,285 @@ class NetworkEnv(gym.Env):
         - Whether the episode is done
         - Additional info useful for debugging
         """
-        self._send_command('step', {'action': action.tolist()})
+        return self.step_wait(self.step_async(action))
 
-        response = self._receive_command()
-
-        if response['command'] == 'confirm':
-            data = response['data']
+    def step_async(self, action):
+        """
+        Tells the server to perform one step, without waiting for the result.
 
-            observation = np.array(data['observation'])
-            reward = data['reward']
-            done = data['done']
-            info = data['info']
+        Arguments:
+        action -- The action performed by the agent
 
+        Returns:
+        The id of the request, which can be passed to step_wait().
+        """
+        if self._protocol == protocol.BINARY:
+            return self._send_request('step', {'action': np.asarray(action)})
         else:
-            pass
-            # TODO something went wrong
+            return self._send_request(
+                'step', {'action': np.asarray(action).tolist()})
+
+    def step_wait(self, request_id=None):
+        """
+        Waits for the result of a step requested with step_async().
+
+        Arguments:
+        request_id -- The id returned by step_async(). If None, the result of
+            the oldest step that has not been picked up is returned.
+
+        Returns:
+        The same four tuple as step().
+
+        Raises:
+        ServerError if the step could not be performed.
+        """
+        if request_id is None:
+            request_id = self._pending[0]
+
+        response = self._wait_for(request_id)
+
+        if response['command'] != 'confirm':
+            _raise_error(response)
+
+        data = response['data']
+
+        observation = np.asarray(data['observation'])
+        reward = data['reward']
+        done = data['done']
+        info = data['info']
+
+        if self._trace and isinstance(info, dict):
+            info['trace'] = self.last_trace
 
         return observation, reward, done, info
 
+    @property
+    def pending_requests(self):
+        """
+        The number of requests whose responses have not been picked up yet.
+        """
+        return len(self._pending)
+
     def close(self):
         """
         Disconnect from the server.
+
+        An unnamed session is ended, so the server can release the
+        environment right away. A named session is kept by the server.
         """
+        if self._session is not None and not self._named_session:
+            try:
+                self._send_command('close')
+            except OSError:
+                pass
+
+            self._session = None
+
         self.socket.close()
 
-    def _send_command(self, command, data=None):
+        if self._observations is not None:
+            self._observations.close()
+            self._observations = None
+
+    def _send_request(self, command, data=None):
+        """
+        Sends a command with a new request id, without waiting for a response.
+
+        Returns:
+        The id of the request.
+        """
+        request_id = self._next_request_id
+        self._next_request_id += 1
+
+        if self._observations is not None:
+            # the server must not overwrite a slot whose observation has not
+            # been read yet
+            while len(self._pending) - len(self._responses) >= \
+                    self._observations.slots:
+                self._buffer_response()
+
+        self._pending.append(request_id)
+
+        if self._session is not None:
+            self._requests[request_id] = (command, data)
+
+        try:
+            self._send_command(command, data, request_id)
+        except OSError:
+            # the request is repeated once the connection is restored
+            self._reconnect()
+
+        return request_id
+
+    def _wait_for(self, request_id):
+        """
+        Waits for the response to a request.
+
+        Responses to other requests that arrive in the meantime are kept until
+        they are asked for.
+
+        Arguments:
+        request_id -- The id of the request, see _send_request()
+
+        Returns:
+        The response, a python dictionary.
+        """
+        if request_id not in self._pending:
+            raise KeyError(f"No request with id {request_id} is in flight")
+
+        while request_id not in self._responses:
+            self._buffer_response()
+
+        self._pending.remove(request_id)
+        response = self._responses.pop(request_id)
+
+        if response is None:
+            raise ConnectionError(f"The response to request {request_id} was "
+                                  "lost with the connection")
+
+        if self._trace:
+            self.last_trace = response.pop('trace', None)
+
+        return response
+
+    def _buffer_response(self):
+        """
+        Receives the next response and keeps it until it is asked for.
+        """
+        try:
+            response = self._receive_command()
+        except ConnectionError:
+            response = None
+
+        if response is None:
+            # try again on a new connection
+            self._reconnect()
+            return
+
+        # the server answers in order, older servers do not return the id
+        response_id = response.pop('id', None)
+        if response_id is None:
+            response_id = next(i for i in self._pending
+                               if i not in self._responses)
+
+        self._responses[response_id] = response
+        self._requests.pop(response_id, None)
+
+    def _connect(self, chunk_size):
+        """
+        Opens a new connection, which starts out using the JSON protocol.
+        """
+        address, port, local, _ = self._address
+        self.socket = _connect(address, port, local)
+
+        self._protocol = protocol.JSON
+        self._reader = protocol.MessageReader(self._protocol, chunk_size)
+        self._compression = None
+
+        if self._observations is not None:
+            self._observations.close()
+            self._observations = None
+
+    def _apply_confirmation(self, data):
+        """
+        Switches to the settings the server has agreed to in the confirmation
+        of an init or resume command.
+        """
+        # older servers do not mention the protocol and only understand JSON
+        self._protocol = data.get('protocol', self._protocol)
+        self._reader.protocol = self._protocol
+
+        if 'compression' in data:
+            self._compression = protocol.Compression(**data['compression'])
+
+        if 'shared_memory' in data:
+            self._observations = SlotRing.from_spec(data['shared_memory'])
+
+    def _reconnect(self):
+        """
+        Restores a broken connection and resumes the session.
+
+        Raises:
+        ConnectionError if there is no session, or it cannot be resumed.
+        """
+        if self._session is None or self._reconnecting:
+            raise ConnectionError("The connection with the server was broken")
+
+        print("Connection was broken, resuming the session")
+
+        self.socket.close()
+        self._reconnecting = True
+
+        try:
+            for attempt in range(RESUME_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(RESUME_DELAY)
+
+                self._connect(self._reader.chunk_size)
+
+                unanswered = [i for i in self._pending
+                              if i not in self._responses]
+
+                data = dict(self._settings, session=self._session,
+                            pending=unanswered)
+                if self._address[3] and self.socket.family != socket.AF_INET:
+                    data['shared_memory'] = SHARED_MEMORY_SLOTS
+
+                response = self._wait_for(self._send_request('resume', data))
+
+                if response['command'] == 'confirm':
+                    break
+
+                self.socket.close()
+
+                if not response['data'].get('retry'):
+                    raise ConnectionError(response['data']['message'])
+
+            else:
+                raise ConnectionError(response['data']['message'])
+
+            self._apply_confirmation(response['data'])
+
+        except OSError as error:
+            raise ConnectionError("The session could not be resumed") \
+                from error
+
+        finally:
+            self._reconnecting = False
+
+        # responses that were lost are sent again, requests that did not
+        # reach the server are repeated, anything else is gone for good
+        last_id = response['data']['last_id']
+        replayed = response['data']['replayed']
+
+        for request_id in unanswered:
+            if request_id in replayed:
+                continue
+
+            if last_id is None or request_id > last_id:
+                command, data = self._requests[request_id]
+                self._send_command(command, data, request_id)
+            else:
+                self._responses[request_id] = None
+                self._requests.pop(request_id, None)
+                self._sent.pop(request_id, None)
+
+    def _send_command(self, command, data=None, request_id=None):
         """
         Utility function used to send commands to the server.
 
-        All data is sent in a JSON dictionary:
+        All data is sent in a dictionary:
         {'command': <command>, 'data':<data>} or
-        {'command': <command>} when data is None.
+        {'command': <command>} when data is None. If request_id is not None it
+        is added as 'id'.
+
+        It is encoded according to the protocol that has been agreed upon with
+        the server, see bikey.network.protocol.
 
         Arguments:
         command -- The contents assigned to 'command'
         data -- The contents assigned to 'data'
+        request_id -- The contents assigned to 'id'
         """
         if data is not None:
             message = {
@@ -142,8 +546,23 @@ class NetworkEnv(gym.Env):
                 'command': command
             }
 
-        self.socket.sendall(json.dumps(message).encode(self._encoding)
-                            + self._delimiter)
+        if request_id is not None:
+            message['id'] = request_id
+
+        if not self._trace or request_id is None:
+            self.socket.sendall(protocol.encode(message, self._protocol))
+            return
+
+        message['trace'] = True
+
+        started = tracing.stamp()
+        raw_message = protocol.encode(message, self._protocol)
+
+        encoded_at = tracing.stamp()
+        self.socket.sendall(raw_message)
+
+        self._sent[request_id] = (started, encoded_at - started,
+                                  tracing.stamp() - encoded_at)
 
     def _receive_command(self):
         """
@@ -152,18 +571,227 @@ class NetworkEnv(gym.Env):
         Returns:
         A python dictionary containing 'command' and possibly 'data'.
         """
-        while self._delimiter not in self._read_buffer:
-            data = self.socket.recv(1024)
-            if not data:
-                self.close()
+        response = self._reader.next_message()
+
+        while response is None:
+            if not self._reader.recv_from(self.socket):
+                # the connection is broken, close it on this side as well
+                self.socket.close()
                 return
-                # TODO connection is broken, close it on this side as well
-            self._read_buffer += data
 
-        response, self._read_buffer = \
-            self._read_buffer.split(self._delimiter, maxsplit=1)
+            response = self._reader.next_message()
+
+        decoding_at = tracing.stamp()
+        response = protocol.decode(response, self._protocol, self._compression)
+
+        data = response.get('data') or {}
+        if 'observation_slot' in data:
+            # copy the observation before the server reuses the slot
+            data['observation'] = np.array(
+                self._observations.read(data.pop('observation_slot')))
+
+        sent = self._sent.pop(response.get('id'), None)
+        if sent is not None:
+            now = tracing.stamp()
+            response['trace'] = tracing.client_durations(
+                response.get('trace'), sent, now, now - decoding_at)
+
+        return response
+
+
+class VectorNetworkEnv(NetworkEnv):
+    """
+    Controls several copies of an environment over a single connection.
+
+    The server runs every copy in its own process, but a call to reset() or
+    step() only takes one round trip for all of them. Actions, observations,
+    rewards and dones are stacked along a new first axis of size num_envs.
+
+    Like gym's vector environments, an environment that is done is reset
+    immediately by the server. The observation returned by step() is then the
+    first observation of the new episode, and the last observation of the
+    finished episode can be found in info['terminal_observation'].
+    """
+
+    def __init__(self, address, port, env_name, num_envs,
+                 wire_protocol=protocol.BINARY,
+                 chunk_size=protocol.DEFAULT_CHUNK_SIZE, compression=None,
+                 compression_threshold=1024, delta_encoding=False, local=None,
+                 shared_memory=False, session=None, trace=False,
+                 **env_config):
+        """
+        Connects to the server and tells it to initialize the environments.
+
+        Arguments:
+        address -- The IPv4 address of the server
+        port -- The port number to connect to
+        env_name -- Name of the environment passed to gym.make()
+        num_envs -- The number of copies of the environment
+        wire_protocol -- The protocol requested from the server, 'binary' or
+            'json'. The server decides which one is used.
+        chunk_size -- The number of bytes received from the socket at once.
+        compression -- See NetworkEnv.
+        compression_threshold -- See NetworkEnv.
+        delta_encoding -- See NetworkEnv.
+        local -- See NetworkEnv.
+        shared_memory -- See NetworkEnv.
+        session -- See NetworkEnv.
+        trace -- See NetworkEnv. The durations are only kept in last_trace.
+        env_config -- Optional parameters passed to the gym.make()
+        """
+        self._trace = trace
+
+        init_data = {
+            'env': env_name,
+            'config': env_config,
+            'protocol': wire_protocol,
+            'num_envs': num_envs
+        }
+        init_data.update(_compression_request(
+            compression, compression_threshold, delta_encoding))
+        init_data.update(_session_request(session))
+
+        data = self._initialize(address, port, init_data, chunk_size, local,
+                                shared_memory)
+
+        if data.get('num_envs', 1) != num_envs:
+            self.close()
+            raise RuntimeError(f"The server did not create {num_envs} "
+                               "environments, it may not support them")
+
+        self.num_envs = num_envs
+
+        self.single_observation_space = self.observation_space
+        self.single_action_space = self.action_space
+
+        self.observation_space = batch_space(
+            self.single_observation_space, num_envs)
+        self.action_space = batch_space(
+            self.single_action_space, num_envs)
+
+    def reset(self):
+        """
+        Tells the server to reset all environments.
+
+        Returns:
+        The stacked initial observations, with shape (num_envs, ...).
+        """
+        return super().reset()
+
+    def step(self, actions):
+        """
+        Tells the server to perform one step in all environments.
+
+        Arguments:
+        actions -- The stacked actions, with shape (num_envs, ...)
+
+        Returns:
+        A four tuple containing
+        - The stacked observations
+        - An array of rewards
+        - An array of booleans, indicating which episodes are done
+        - A list with the additional info of every environment
+        """
+        return super().step(actions)
+
+    def step_wait(self, request_id=None):
+        """
+        Waits for the result of a step requested with step_async().
+
+        Returns:
+        The same four tuple as step().
+        """
+        observations, rewards, dones, infos = super().step_wait(request_id)
+
+        for info in infos:
+            if 'terminal_observation' in info:
+                info['terminal_observation'] = \
+                    np.asarray(info['terminal_observation'])
+
+        return observations, np.asarray(rewards), np.asarray(dones), infos
+
+
+def _connect(address, port, local=None):
+    """
+    Opens a connection to a server, see NetworkEnv.__init__() for local.
+    """
+    if local is None:
+        local = _is_this_machine(address) and \
+            os.path.exists(protocol.local_socket_path(port))
+
+    if local and hasattr(socket, 'AF_UNIX'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            connection.connect(protocol.local_socket_path(port))
+            return connection
+
+        except OSError:
+            # e.g. a stale socket file, fall back to TCP
+            connection.close()
+
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.connect((address, port))
+
+    return connection
+
+
+def _is_this_machine(address):
+    """
+    Returns whether an address belongs to this machine.
+    """
+    try:
+        if ipaddress.ip_address(address).is_loopback:
+            return True
+    except ValueError:
+        # a host name
+        pass
+
+    try:
+        hostname = socket.gethostname()
+        own_addresses = socket.gethostbyname_ex(hostname)[2]
+        return socket.gethostbyname(address) in own_addresses + ['127.0.0.1']
+    except OSError:
+        return False
+
+
+def _raise_error(response):
+    """
+    Raises a ServerError for a response that is not a confirmation.
+    """
+    message = (response.get('data') or {}).get('message')
+
+    if message is None:
+        message = f"Unexpected response from the server: {response}"
+
+    raise ServerError(message)
+
+
+def _compression_request(method, threshold, delta):
+    """
+    Returns the compression entry of an init command, if any.
+    """
+    if method is None:
+        return {}
+
+    return {
+        'compression': {
+            'method': method,
+            'threshold': threshold,
+            'delta': delta
+        }
+    }
+
+
+def _session_request(session):
+    """
+    Returns the session entry of an init command, if any.
+    """
+    if session is None or session is False:
+        return {}
 
-        return json.loads(response.decode('utf-8'))
+    # the server picks a random token for unnamed sessions
+    return {'session': '' if session is True else str(session)}
 
 
 def dict_to_gym_space(description):
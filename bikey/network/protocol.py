@@ -0,0 +1,533 @@
+import json
+import os
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+# Messages are exchanged in one of two wire formats. Every connection starts
+# out in the legacy JSON format, in which messages are delimited by '<END>'.
+# The client can ask for the binary format in its 'init' command, and if the
+# server confirms this both sides switch over after the confirmation.
+#
+# A binary frame looks like this (all integers are little-endian):
+#
+#   <uint32 payload length> <uint32 header length> <header> <array bytes>
+#
+# The header is a small JSON document containing the message with all numpy
+# arrays in message['data'] taken out. The arrays are described in the
+# header's '__arrays__' entry as (key, dtype, shape) and their raw bytes are
+# concatenated behind the header in the same order.
+#
+# A connection using the binary format can also negotiate compression of the
+# array bytes of the server's responses, see Compression. Compressed frames
+# mention the method in the header's '__compressed__' entry, and the arrays
+# that were delta encoded in '__delta__'.
+
+JSON = 'json'
+BINARY = 'binary'
+
+_delimiter = b'<END>'
+_encoding = 'utf-8'
+
+_length = struct.Struct('<I')
+
+# the number of bytes requested from a socket at once by MessageReader
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def local_socket_path(port):
+    """
+    Returns the path of the Unix domain socket of a server on this machine.
+
+    Besides its TCP port, a server listens on a Unix domain socket whose path
+    is derived from the port number. Clients on the same machine find it
+    without any extra configuration, see NetworkEnv.
+
+    Arguments:
+    port -- The TCP port of the server
+    """
+    return os.path.join(tempfile.gettempdir(), f'bikey-{port}.sock')
+
+
+def encode(message, protocol, compression=None):
+    """
+    Turn a message into bytes that can be sent over a socket.
+
+    Arguments:
+    message -- The message stored in a python dictionary
+    protocol -- Either protocol.JSON or protocol.BINARY
+    compression -- The Compression of the connection, or None. Only used by
+        the binary protocol.
+
+    Returns:
+    The bytes making up one complete message, including framing.
+    """
+    if protocol == BINARY:
+        return encode_binary(message, compression)
+    else:
+        return encode_json(message)
+
+
+def decode(raw_message, protocol, compression=None):
+    """
+    Turn the bytes of one message (without framing) back into a dictionary.
+
+    Arguments:
+    raw_message -- The bytes of the message, as returned by split_message()
+        or MessageReader.next_message()
+    protocol -- Either protocol.JSON or protocol.BINARY
+    compression -- The Compression of the connection, or None. Only used by
+        the binary protocol.
+
+    Returns:
+    The message stored in a python dictionary.
+    """
+    if protocol == BINARY:
+        return decode_binary(raw_message, compression)
+    else:
+        return decode_json(raw_message)
+
+
+def split_message(buffer, protocol):
+    """
+    Take the first complete message from the front of a receive buffer.
+
+    Arguments:
+    buffer -- The bytes received so far
+    protocol -- Either protocol.JSON or protocol.BINARY
+
+    Returns:
+    A tuple containing the raw message (None if the buffer does not yet
+    contain a complete message) and the remainder of the buffer.
+    """
+    if protocol == BINARY:
+        if len(buffer) < _length.size:
+            return None, buffer
+
+        length, = _length.unpack_from(buffer)
+        end = _length.size + length
+
+        if len(buffer) < end:
+            return None, buffer
+
+        return buffer[_length.size:end], buffer[end:]
+
+    else:
+        if _delimiter not in buffer:
+            return None, buffer
+
+        raw_message, buffer = buffer.split(_delimiter, maxsplit=1)
+        return raw_message, buffer
+
+
+class MessageReader:
+    """
+    Splits a stream of bytes received from a socket into messages.
+
+    Data is received straight into a reusable bytearray with recv_into, in
+    chunks of a configurable size. Delimiters are searched for only in data
+    that has not been searched before, and for binary frames the buffer is
+    grown to fit the whole frame as soon as its length is known. This keeps
+    the time needed to receive a message linear in its size, however many
+    chunks it arrives in.
+
+    The protocol can be changed between messages by assigning to protocol.
+    """
+
+    def __init__(self, protocol=JSON, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Arguments:
+        protocol -- Either protocol.JSON or protocol.BINARY
+        chunk_size -- The number of bytes requested from the socket at once
+        """
+        self.protocol = protocol
+        self.chunk_size = chunk_size
+
+        self._buffer = bytearray(chunk_size)
+        self._start = 0  # the first byte that has not been read yet
+        self._end = 0  # the end of the received data
+        self._scan = 0  # no delimiter starts before this position
+
+    def recv_from(self, sock):
+        """
+        Receives the next chunk of data from a socket.
+
+        Arguments:
+        sock -- A connected socket
+
+        Returns:
+        The number of bytes received, 0 if the connection has been closed.
+        """
+        self._reserve(self.chunk_size)
+
+        with memoryview(self._buffer) as view:
+            with view[self._end:] as free:
+                received = sock.recv_into(free)
+
+        self._end += received
+
+        return received
+
+    def feed(self, data):
+        """
+        Adds data that has been received in some other way, e.g. by an
+        asyncio.StreamReader.
+        """
+        self._reserve(len(data))
+
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_message(self):
+        """
+        Takes the next complete message from the buffer.
+
+        Returns:
+        The raw message without framing, as used by decode(), or None if no
+        complete message has been received yet.
+        """
+        if self.protocol == BINARY:
+            if self._end - self._start < _length.size:
+                return None
+
+            length, = _length.unpack_from(self._buffer, self._start)
+            begin = self._start + _length.size
+            end = begin + length
+
+            if end > self._end:
+                # make room for the rest of the frame right away
+                self._reserve(end - self._end)
+                return None
+
+        else:
+            end = self._buffer.find(_delimiter, max(self._scan, self._start),
+                                    self._end)
+
+            if end < 0:
+                # the delimiter might have been received partially
+                self._scan = max(self._start,
+                                 self._end - len(_delimiter) + 1)
+                return None
+
+            begin = self._start
+
+        with memoryview(self._buffer) as view:
+            with view[begin:end] as message:
+                raw_message = bytes(message)
+
+        if self.protocol == BINARY:
+            self._consume(end)
+        else:
+            self._consume(end + len(_delimiter))
+
+        return raw_message
+
+    def messages(self):
+        """
+        Yields every complete message in the buffer, see next_message().
+        """
+        raw_message = self.next_message()
+
+        while raw_message is not None:
+            yield raw_message
+            raw_message = self.next_message()
+
+    def _consume(self, position):
+        self._start = position
+
+        if self._start == self._end:
+            # nothing left to read, start at the front of the buffer again
+            self._start = self._end = self._scan = 0
+
+    def _reserve(self, size):
+        # makes sure at least size bytes are free behind the received data
+        if len(self._buffer) - self._end >= size:
+            return
+
+        if self._start:
+            # move the unread data to the front of the buffer
+            unread = self._end - self._start
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+
+            self._scan = max(0, self._scan - self._start)
+            self._start = 0
+            self._end = unread
+
+        if len(self._buffer) - self._end < size:
+            new_size = max(self._end + size, 2 * len(self._buffer))
+            self._buffer.extend(bytes(new_size - len(self._buffer)))
+
+
+def encode_json(message):
+    """
+    Encode a message in the legacy JSON format.
+
+    Any numpy arrays should already have been converted to lists.
+    """
+    return json.dumps(message, default=_to_builtin).encode(_encoding) \
+        + _delimiter
+
+
+def decode_json(raw_message):
+    """
+    Decode a message in the legacy JSON format.
+    """
+    return json.loads(raw_message.decode(_encoding))
+
+
+def encode_binary(message, compression=None):
+    """
+    Encode a message as a length-prefixed binary frame.
+
+    Numpy arrays stored directly in message['data'] are sent as raw
+    little-endian bytes instead of being converted to lists. If compression is
+    not None, these bytes may be compressed, see Compression.pack().
+    """
+    header = {key: value for key, value in message.items() if key != 'data'}
+    arrays = []
+
+    if message.get('data') is not None:
+        data = {}
+        descriptions = []
+
+        for key, value in message['data'].items():
+            if isinstance(value, np.ndarray):
+                array = _little_endian(value)
+                descriptions.append((key, array.dtype.str, array.shape))
+                arrays.append(array)
+            else:
+                data[key] = value
+
+        header['data'] = data
+        if descriptions:
+            header['__arrays__'] = descriptions
+
+    elif 'data' in message:
+        header['data'] = None
+
+    if compression is not None and arrays:
+        array_bytes, extras = compression.pack(header['__arrays__'], arrays)
+        header.update(extras)
+    else:
+        array_bytes = b''.join(array.tobytes() for array in arrays)
+
+    header_bytes = json.dumps(header, default=_to_builtin).encode(_encoding)
+
+    body = [_length.pack(len(header_bytes)), header_bytes, array_bytes]
+
+    payload_length = sum(len(part) for part in body)
+
+    return b''.join([_length.pack(payload_length)] + body)
+
+
+def decode_binary(payload, compression=None):
+    """
+    Decode the payload of a binary frame.
+
+    Arrays are returned as read-only views on the payload created with
+    np.frombuffer, so no copies are made. Compressed frames are decompressed
+    first, which requires the Compression of the connection.
+    """
+    header_length, = _length.unpack_from(payload)
+    offset = _length.size + header_length
+
+    message = json.loads(bytes(payload[_length.size:offset]).decode(_encoding))
+    arrays = message.pop('__arrays__', [])
+
+    method = message.pop('__compressed__', None)
+    delta_keys = message.pop('__delta__', [])
+
+    if compression is not None and arrays:
+        payload = compression.unpack(arrays, payload[offset:], method,
+                                     delta_keys)
+        offset = 0
+
+    elif method is not None or delta_keys:
+        raise ValueError("Received a compressed frame, but compression was "
+                         "not negotiated")
+
+    for key, dtype, shape in arrays:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+
+        message['data'][key] = np.frombuffer(
+            payload, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+        offset += count * dtype.itemsize
+
+    return message
+
+
+class Compression:
+    """
+    Compresses the arrays sent over one connection.
+
+    Both ends of a connection keep their own Compression with the same
+    settings. The client proposes the settings in its init command, and the
+    server confirms the ones it supports, see Compression.negotiate().
+
+    The array bytes of a frame are compressed as a whole once they reach a
+    size threshold. With delta encoding an array is first XORed with the
+    previous array sent under the same key, if it has the same size. Successive
+    observations of a slowly changing system share most of their bytes, so
+    this leaves mostly zeros, which compress very well. Unlike subtracting the
+    observations it is lossless.
+    """
+
+    def __init__(self, method='zlib', level=1, threshold=1024, delta=False):
+        """
+        Arguments:
+        method -- 'zlib', or 'lz4' if the lz4 package is installed
+        level -- The compression level
+        threshold -- The minimum number of array bytes in a frame for it to be
+            compressed
+        delta -- Whether arrays are delta encoded
+        """
+        if method == 'zlib':
+            self._compress = lambda data: zlib.compress(data, level)
+            self._decompress = zlib.decompress
+        elif method == 'lz4':
+            # optional dependency, only needed when lz4 is asked for
+            import lz4.frame
+            self._compress = lambda data: lz4.frame.compress(
+                data, compression_level=level)
+            self._decompress = lz4.frame.decompress
+        else:
+            raise ValueError(f"Unknown compression method '{method}'")
+
+        self.method = method
+        self.level = level
+        self.threshold = threshold
+        self.delta = delta
+
+        self._previous = {}  # the last bytes of every array key
+
+    @classmethod
+    def negotiate(cls, settings):
+        """
+        Creates a Compression from settings proposed by the other side.
+
+        Returns:
+        The Compression, or None if the settings are not supported.
+        """
+        try:
+            return cls(**settings)
+        except (ImportError, TypeError, ValueError):
+            return None
+
+    def settings(self):
+        """
+        Returns the settings as a dictionary that can be sent as JSON.
+        """
+        return {
+            'method': self.method,
+            'level': self.level,
+            'threshold': self.threshold,
+            'delta': self.delta
+        }
+
+    def pack(self, descriptions, arrays):
+        """
+        Turns arrays into the (compressed) bytes of a frame.
+
+        Arguments:
+        descriptions -- The (key, dtype, shape) of every array
+        arrays -- The arrays, little-endian and C-contiguous
+
+        Returns:
+        A tuple containing the bytes, and the entries that should be added to
+        the header of the frame.
+        """
+        parts = []
+        delta_keys = []
+
+        for (key, _, _), array in zip(descriptions, arrays):
+            data = array.tobytes()
+
+            if self.delta:
+                previous = self._previous.get(key)
+                self._previous[key] = data
+
+                if previous is not None and len(previous) == len(data):
+                    data = _xor(data, previous)
+                    delta_keys.append(key)
+
+            parts.append(data)
+
+        data = b''.join(parts)
+        extras = {}
+
+        if delta_keys:
+            extras['__delta__'] = delta_keys
+
+        if len(data) >= self.threshold:
+            data = self._compress(data)
+            extras['__compressed__'] = self.method
+
+        return data, extras
+
+    def unpack(self, descriptions, data, method, delta_keys):
+        """
+        Reverses pack().
+
+        Arguments:
+        descriptions -- The (key, dtype, shape) of every array in the frame
+        data -- The bytes following the header of the frame
+        method -- The compression method mentioned in the header, or None
+        delta_keys -- The keys of the delta encoded arrays
+
+        Returns:
+        The original array bytes.
+        """
+        if method is not None:
+            data = self._decompress(data)
+
+        if not self.delta:
+            return data
+
+        parts = []
+        offset = 0
+
+        for key, dtype, shape in descriptions:
+            size = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            part = bytes(data[offset:offset + size])
+            offset += size
+
+            if key in delta_keys:
+                part = _xor(part, self._previous[key])
+
+            self._previous[key] = part
+            parts.append(part)
+
+        return b''.join(parts)
+
+
+def _xor(data, other):
+    """
+    Returns the bytewise exclusive or of two byte strings of equal length.
+    """
+    return np.bitwise_xor(np.frombuffer(data, dtype=np.uint8),
+                          np.frombuffer(other, dtype=np.uint8)).tobytes()
+
+
+def _little_endian(array):
+    """
+    Returns a C-contiguous little-endian version of the array.
+    """
+    array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+
+    return np.ascontiguousarray(array)
+
+
+def _to_builtin(value):
+    """
+    Fallback for json.dumps, converts numpy types to python equivalents.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON "
+                    "serializable")
@@ -0,0 +1,350 @@
+import asyncio
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+
+from .env_process import error_response, run_environments
+
+
+class StepScheduler:
+    """
+    Hosts the environments of all clients in a few worker processes, and
+    batches their requests.
+
+    Without a scheduler every client gets its own environment process, and
+    every request is a separate round trip to that process. With many clients
+    of a fast environment, most of the time is then spent passing messages and
+    switching between processes. The scheduler places up to envs_per_worker
+    environments of the same type in one worker process instead (see
+    bikey.network.env_process.run_environments()). Requests for a worker are
+    collected while the worker is busy, and sent to it together as soon as it
+    is done, so a busy worker never waits for the server and every round trip
+    serves as many environments as possible.
+
+    The scheduler can take the place of an EnvProcessPool: acquire() returns a
+    ScheduledEnv, which the server uses like an environment process. It is
+    safe to use from several threads and from an asyncio event loop.
+    """
+
+    def __init__(self, name_queue, envs_per_worker, matlab_params=None):
+        """
+        Arguments:
+        name_queue -- A queue that provides working directories to supported
+            environments, see bikey.network.env_process.run_environment().
+        envs_per_worker -- The maximum number of environments in one worker.
+        matlab_params -- If not None, the parameters of the Matlab sessions
+            used by BicycleEnvs. Every worker reuses its sessions.
+        """
+        self.name_queue = name_queue
+        self.envs_per_worker = envs_per_worker
+        self.matlab_params = matlab_params
+
+        self.lock = threading.Lock()
+        self.workers = []
+        self.slots = itertools.count()
+
+    def acquire(self):
+        """
+        Returns a handle on a new environment. The environment is placed in a
+        worker once its init command arrives.
+        """
+        return ScheduledEnv(self)
+
+    def release(self, env):
+        """
+        Closes the environment of a client that has left.
+
+        Returns:
+        True, the handle needs no further attention.
+        """
+        env.stop()
+        return True
+
+    def status(self):
+        """
+        Returns the number of live workers in 'workers', and the number of
+        requests waiting for a busy worker in 'pending'.
+        """
+        with self.lock:
+            workers = [worker for worker in self.workers if worker.alive]
+
+        pending = 0
+        for worker in workers:
+            with worker.condition:
+                pending += len(worker.pending)
+
+        return {'workers': len(workers), 'pending': pending}
+
+    def close(self):
+        """
+        Shuts down all workers.
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+
+        for worker in workers:
+            worker.stop()
+
+        for worker in workers:
+            worker.join()
+
+    def _place(self, env, env_type):
+        """
+        Picks a worker for a new environment: one that already runs this type
+        of environment, an idle one, or else a new one.
+        """
+        with self.lock:
+            candidates = []
+
+            for worker in self.workers:
+                with worker.condition:
+                    if worker.alive and \
+                            len(worker.envs) < self.envs_per_worker and \
+                            worker.env_type in (env_type, None):
+                        candidates.append((len(worker.envs), worker))
+
+            if candidates:
+                # fill up workers of the same type before using idle ones.
+                # Only _place() adds environments, so the worker still has
+                # room
+                _, worker = max(candidates, key=lambda candidate: candidate[0])
+            else:
+                worker = _Worker(self.name_queue, self.matlab_params)
+                self.workers.append(worker)
+
+            with worker.condition:
+                worker.env_type = env_type
+                worker.envs[env.slot] = env
+
+        return worker
+
+
+class ScheduledEnv:
+    """
+    The server's handle on an environment hosted by a StepScheduler.
+
+    Has the methods of an EnvProcess and a PipeEnvProcess, so the servers can
+    use it in the same way.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.slot = next(scheduler.slots)
+        self.worker = None
+
+        self.responses = queue.Queue()
+        self._wake_up = None  # set while a coroutine waits for a response
+
+    def send(self, message):
+        """
+        Pass a message on to the environment.
+        """
+        if message is None:
+            self.stop()
+            return
+
+        if message['command'] == 'shut_down_server':
+            # the worker serves other clients as well, only this environment
+            # is closed. The server is told that the environment is gone
+            self.stop()
+            self._deliver(None)
+            return
+
+        if self.worker is None:
+            env_type = (message.get('data') or {}).get('env')
+            self.worker = self.scheduler._place(self, env_type)
+
+        if not self.worker.submit(self.slot, message):
+            # the worker has died
+            self._deliver(None)
+
+    def receive(self):
+        """
+        Wait for the next response of the environment.
+        """
+        return self.responses.get()
+
+    def request(self, message):
+        """
+        Send a message and wait for the response to it.
+        """
+        self.send(message)
+        return self.receive()
+
+    async def send_async(self, message):
+        """
+        Pass a message on without blocking the running event loop.
+
+        The first message may start a worker process, so it is sent by the
+        loop's executor.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.send, message)
+
+    async def receive_async(self):
+        """
+        Wait for the next response without blocking the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                return self.responses.get_nowait()
+            except queue.Empty:
+                pass
+
+            ready = loop.create_future()
+            self._wake_up = lambda: loop.call_soon_threadsafe(
+                lambda: ready.done() or ready.set_result(None))
+
+            # a response may have arrived before _wake_up was set
+            if self.responses.empty():
+                await ready
+
+            self._wake_up = None
+
+    async def request_async(self, message):
+        """
+        Send a message and wait for the response without blocking the loop.
+        """
+        await self.send_async(message)
+        return await self.receive_async()
+
+    def stop(self):
+        """
+        Close the environment and free its place in the worker.
+        """
+        if self.worker is not None:
+            self.worker.remove(self.slot)
+            self.worker = None
+
+    def join(self):
+        pass
+
+    async def join_async(self):
+        pass
+
+    def _deliver(self, response):
+        self.responses.put(response)
+
+        wake_up = self._wake_up
+        if wake_up is not None:
+            wake_up()
+
+
+class _Worker:
+    """
+    A process running run_environments(), and the thread that sends it the
+    batches of requests.
+    """
+
+    def __init__(self, name_queue, matlab_params):
+        self.connection, child_connection = mp.Pipe()
+
+        self.process = mp.Process(
+            target=run_environments,
+            args=(child_connection, name_queue, matlab_params))
+        self.process.start()
+
+        child_connection.close()
+
+        # the condition's lock guards env_type, envs, alive and pending
+        self.condition = threading.Condition()
+
+        self.env_type = None
+        self.envs = {}  # maps slots to ScheduledEnvs
+        self.alive = True
+
+        self.pending = []
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, slot, message):
+        """
+        Adds a request to the next batch. A message of None closes the
+        environment in the slot.
+
+        Returns:
+        False if the worker has died, and the request will not be handled.
+        """
+        with self.condition:
+            if not self.alive:
+                return False
+
+            self.pending.append((slot, message))
+            self.condition.notify()
+
+        return True
+
+    def remove(self, slot):
+        """
+        Closes the environment in a slot, which can then be used by a new
+        environment.
+        """
+        self.submit(slot, None)
+
+        with self.condition:
+            self.envs.pop(slot, None)
+
+            if not self.envs:
+                # any type of environment can move in
+                self.env_type = None
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def join(self):
+        self.thread.join()
+        self.process.join()
+        self.connection.close()
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+
+                if not self.pending:
+                    break
+
+                # everything that arrived while the worker was busy
+                batch, self.pending = self.pending, []
+                envs = [self.envs.get(slot) for slot, _ in batch]
+
+            try:
+                self.connection.send(batch)
+                responses = self.connection.recv()
+
+            except (EOFError, OSError):
+                # the worker has died, and its environments with it
+                with self.condition:
+                    self.alive = False
+                    self.pending = []
+                    envs = list(self.envs.values())
+
+                for env in envs:
+                    env._deliver(None)
+
+                return
+
+            for env, (_, message), response in zip(envs, batch, responses):
+                if env is None or message is None:
+                    # the environment has been closed
+                    continue
+
+                if response is None:
+                    # the client waits for a response, so there always is one
+                    response = error_response(
+                        f"The '{message['command']}' command got no response")
+
+                env._deliver(response)
+
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
@@ -1,18 +1,22 @@
-import json
+import select
 import socket
 import time
-import multiprocessing as mp
 import threading
 
+from . import async_server
+from . import metrics as server_metrics
+from . import protocol
 from . import server_utils
-from .env_process import run_environment
+from . import tracing
+from .env_process import EnvProcess, EnvProcessPool, SharedMemoryEnvProcess
+from .scheduler import StepScheduler
+from .sessions import DEFAULT_TIMEOUT, SessionRegistry
 
 
-_delimiter = b'<END>'
-_encoding = 'utf-8'
-
-
-def start_server(host, port, server_dir, max_connections):
+def start_server(host, port, server_dir, max_connections, pool_size=0,
+                 matlab_params=None, shared_memory=False, local_socket=True,
+                 session_timeout=DEFAULT_TIMEOUT, envs_per_worker=0,
+                 trace=False, metrics_port=None):
     """
     Start an environment server on the specified interface and port.
 
@@ -22,6 +26,33 @@ def start_server(host, port, server_dir, max_connections):
     unimpeded. This way, any CPU-bound computations do not block the server's
     connections either.
 
+    The environment processes can be started in advance, see
+    bikey.network.env_process.EnvProcessPool. Processes from the pool are
+    reused when their client leaves.
+
+    By default messages are passed to the environment processes through
+    queues. With shared_memory, actions and observations are passed through
+    shared memory instead, see bikey.network.env_process.SharedMemoryEnvProcess.
+
+    Besides the TCP port, the server listens on a Unix domain socket for
+    clients on the same machine, see protocol.local_socket_path(). This skips
+    the TCP stack, and such clients can also receive their observations
+    through shared memory.
+
+    Clients can ask for a session, which keeps their environments alive for a
+    while after they disconnect, see bikey.network.sessions.
+
+    With envs_per_worker, the environments do not get a process each. They are
+    hosted together in worker processes, and their requests are batched, see
+    bikey.network.scheduler.StepScheduler.
+
+    Requests can be traced, which times every stage they pass through, see
+    bikey.network.tracing. The durations are collected in histograms, which
+    can be requested with server_utils.request_stats().
+
+    With metrics_port, the server's metrics are served over HTTP for
+    monitoring and autoscaling, see bikey.network.metrics.
+
     Arguments:
     host -- The interface to listen on
     port -- The port to listen on
@@ -30,15 +61,57 @@ def start_server(host, port, server_dir, max_connections):
     max_connections -- The maximum number of simultaneous connections. This is
         useful when one environment takes up a lot of resources, for example,
         and having too many executing simultaneously would impact performance.
+    pool_size -- The number of environment processes that are kept ready.
+    matlab_params -- If not None, the processes in the pool start a Matlab
+        session with these parameters in advance.
+    shared_memory -- If True, environment processes exchange actions and
+        observations with the server through shared memory.
+    local_socket -- If True, the server also listens on a Unix domain socket.
+    session_timeout -- The number of seconds the environments of a
+        disconnected client with a session are kept.
+    envs_per_worker -- If above 0, the maximum number of environments hosted
+        by one worker process. pool_size and shared_memory are then ignored.
+    trace -- If True, every request is traced, not only the requests of
+        clients that ask for it.
+    metrics_port -- If not None, the port on which the metrics are served at
+        /metrics.
     """
     connections = []
 
+    # bind first, if the port is taken nothing has been started that would
+    # have to be stopped again
+    s = server_utils.bind_socket(host, port)
+
     dir_thread, stop_dir_generator, name_queue = server_utils.setup_name_queue(server_dir)
     stop_server = threading.Event()
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((host, port))
-        s.listen()
+    if envs_per_worker > 0:
+        pool = StepScheduler(name_queue, envs_per_worker, matlab_params)
+    else:
+        process_class = SharedMemoryEnvProcess if shared_memory else EnvProcess
+        pool = EnvProcessPool(name_queue, pool_size, process_class,
+                              matlab_params)
+    sessions = SessionRegistry(session_timeout)
+    stats = tracing.StageHistograms()
+    metrics = server_metrics.ServerMetrics(pool, stats, name_queue,
+                                           matlab_params)
+
+    reaper = threading.Thread(target=reap_sessions,
+                              args=(sessions, pool, stop_server),
+                              daemon=True)
+    reaper.start()
+
+    httpd = None
+    if metrics_port is not None:
+        httpd = server_metrics.start_http_server(metrics, host, metrics_port)
+        print(f"Serving metrics at http://{host}:{metrics_port}/metrics")
+
+    with s:
+        listeners = [s]
+        unix_socket = server_utils.open_local_socket(port) if local_socket \
+            else None
+        if unix_socket is not None:
+            listeners.append(unix_socket)
 
         while not stop_server.is_set():
             # don't keep track of closed connections
@@ -49,27 +122,34 @@ def start_server(host, port, server_dir, max_connections):
 
             if len(connections) <= max_connections:
                 print("Waiting for new connection")
-                client_socket, addr = s.accept()
+                readable, _, _ = select.select(listeners, [], [])
+                client_socket, addr = readable[0].accept()
 
                 print("Incoming connection from: ", addr)
 
                 # determine if the client is running on this machine as well
-                from_server = host == addr[0]
+                from_server = server_utils.is_local_connection(
+                    client_socket, host, addr)
 
                 thread = threading.Thread(target=handle_client,
                                           args=(client_socket, from_server,
-                                                stop_server, name_queue))
+                                                stop_server, pool, sessions,
+                                                stats, metrics, trace))
                 connections.append((addr, thread))
                 thread.start()
 
             else:
                 print('Server full')
-                print('Waiting 30 seconds before checking available slots again')
+                print('Waiting 10 seconds before checking available slots again')
                 time.sleep(10)  # wait a little before checking again
 
+        server_utils.close_local_socket(unix_socket, port)
+
     # stop the thread that generates working directories
     stop_dir_generator.set()
 
+    server_metrics.stop_http_server(httpd)
+
     # if all goes well all threads will exit and the server shutdown message
     # is displayed
 
@@ -77,6 +157,20 @@ def start_server(host, port, server_dir, max_connections):
         thread.join()
         print("One thread is definitely dead")
 
+    reaper.join()
+
+    # nobody can pick up the parked sessions anymore
+    parked = sessions.close()
+
+    for env_process in parked:
+        env_process.stop()
+
+    for env_process in parked:
+        env_process.join()
+
+    pool.close()
+    print("Idle processes are definitely dead")
+
     dir_thread.join()
     print("Directory gen. thread is definitely dead")
 
@@ -85,59 +179,144 @@ def start_server(host, port, server_dir, max_connections):
     print("All threads or processes are dead")
 
 
-def handle_client(client_socket, from_server, stop_server, name_queue):
+def handle_client(client_socket, from_server, stop_server, pool, sessions,
+                  stats, metrics, trace_all=False):
     """
     Handles all communications with clients of the server in its own thread.
 
+    Every connection starts out using the JSON protocol. If the client asks for
+    the binary protocol in its init command, the confirmation of the init
+    command is the last message sent in JSON form. After that both sides
+    switch to binary frames, see bikey.network.protocol. Compression of the
+    responses is negotiated in the same way, as are shared memory observations
+    for clients on the same machine (see server_utils.share_observations()).
+
+    Clients may send several messages without waiting for the responses, see
+    NetworkEnv.step_async(). Messages are handled in the order in which they
+    arrive, and every complete message in the buffer is handled before waiting
+    for more data.
+
+    A client can ask for several copies of an environment by setting
+    'num_envs' in its init command. Every copy gets its own process, and the
+    messages of the client are forwarded to all of them, see forward_message().
+
+    A client with a session keeps its environments when its connection breaks,
+    it can pick them up again with a 'resume' command, see
+    server_utils.open_session(). Clients end their session with a 'close'
+    command.
+
+    Requests that are traced (see bikey.network.tracing) get the durations of
+    their stages in their response, and these are added to stats. A 'stats'
+    command is answered with the histograms in stats.
+
+    The connection and the requests it answers are reported to metrics.
+
     Arguments:
     client_socket -- The socket associated with the connection.
+    from_server -- Whether the client runs on the same machine as the server
     stop_server -- A threading.Event that stops the entire server when set
-    name_queue - A multiprocessing.Queue object containing designated
-        directories for clients
+    pool -- The EnvProcessPool or StepScheduler providing environment
+        processes
+    sessions -- The SessionRegistry holding sessions of disconnected clients
+    stats -- The tracing.StageHistograms of the server
+    metrics -- The metrics.ServerMetrics of the server
+    trace_all -- Whether to trace every request
     """
     # print('Created a new thread')
-    read_buffer = b''
+    wire_protocol = protocol.JSON
+    requested_protocol = protocol.JSON
+    compression = None
+    requested_compression = None
+    observations = None
+    requested_slots = None
+    reader = protocol.MessageReader(wire_protocol)
 
-    message_queue = mp.Queue()
-    response_queue = mp.Queue()
+    # more processes are started if the client asks for a vector of envs
+    env_processes = [pool.acquire()]
+    shut_down = False
 
-    env_process = mp.Process(
-        target=run_environment,
-        args=(message_queue, response_queue, name_queue))
+    session = None
+    closed = False  # whether the client has ended its session
+    retired = []  # processes that are no longer needed by anyone
 
-    env_process.start()
+    connection = metrics.opened()
+    env_type = None
 
     try:
         with client_socket:
-            while not stop_server.is_set():
+            while not stop_server.is_set() and not shut_down:
                 # print('Waiting for a new message')
 
-                data = client_socket.recv(1024)
-
-                if not data:
+                if not reader.recv_from(client_socket):
                     # connection is broken, shut down everything
-                    message_queue.put(None)
                     break
 
-                read_buffer += data
-
-                if _delimiter in read_buffer:
+                # several messages may have arrived at once, handle all of them
+                for raw_message in reader.messages():
                     # a full message has been received, put it in the queue
-                    raw_message, read_buffer = \
-                        read_buffer.split(_delimiter, maxsplit=1)
-                    message = json.loads(raw_message.decode(_encoding))
-                    # make sure observations are turned into numpy arrays
-                    server_utils.numpyify(message)
+                    received_at = tracing.stamp()
+                    message = server_utils.decode_client_message(
+                        raw_message, wire_protocol)
+                    responses = None
+                    durations = None
+
+                    if message['command'] == 'close':
+                        # no response, the client disconnects right away
+                        closed = True
+                        continue
+
+                    if message['command'] == 'stats':
+                        responses = [(message, {'command': 'confirm',
+                                                'data': stats.snapshot()})]
+
+                    if message['command'] in ('init', 'resume'):
+                        requested_protocol = message['data'].pop(
+                            'protocol', protocol.JSON)
+                        requested_compression = message['data'].pop(
+                            'compression', None)
+
+                        # shared memory is useless to remote clients
+                        requested_slots = message['data'].pop(
+                            'shared_memory', None)
+                        if not from_server:
+                            requested_slots = None
+
+                        num_envs = message['data'].pop('num_envs', 1)
+
+                        session, env_processes, dropped, responses = \
+                            server_utils.open_session(
+                                sessions, message, num_envs, env_processes)
+                        retired.extend(dropped)
+
+                        env_type = session.env if session is not None \
+                            else message['data'].get('env')
+
+                        while responses is None and \
+                                len(env_processes) < num_envs:
+                            env_processes.append(pool.acquire())
                     # print('Received new message: ', message)
 
-                    message_queue.put(message)
+                    if responses is None:
+                        durations = tracing.begin(message, received_at,
+                                                  trace_all)
+
+                        # wait for a response from the process(es)
+                        response = forward_message(message, env_processes)
+                        responses = [(message, response)]
 
-                    # wait for a response from the process
-                    response = response_queue.get()
+                        if durations is not None and response is not None:
+                            tracing.finish(durations, response, received_at)
+
+                        if session is not None and response is not None:
+                            session.record(message, response)
 
                     # print('Received response from process: ', response)
 
-                    if response is None:
+                    if responses[0][1] is None:
+                        # the processes are shutting down, they are of no use
+                        # to the pool anymore
+                        shut_down = True
+
                         if from_server:
                             # the entire server should be shut down (requested
                             # by client)
@@ -147,27 +326,129 @@ def handle_client(client_socket, from_server, stop_server, name_queue):
 
                         break
 
-                    # make sure observations are turned into lists before being
-                    # turned into json
-                    server_utils.denumpyify(response)
-                    client_socket.sendall(
-                        json.dumps(response).encode(_encoding) + _delimiter)
+                    # replayed responses of a resumed session are not counted
+                    metrics.handled(connection, env_type, *responses[0],
+                                    len(env_processes), received_at)
+
+                    for request, response in responses:
+                        observations = server_utils.share_observations(
+                            request, response, observations, requested_slots)
+
+                        encoding_at = tracing.stamp()
+                        raw_response, wire_protocol, compression = \
+                            server_utils.encode_client_response(
+                                request, response, wire_protocol,
+                                requested_protocol, compression,
+                                requested_compression)
+
+                        sending_at = tracing.stamp()
+                        client_socket.sendall(raw_response)
+
+                    if durations is not None:
+                        durations['server_encode'] = sending_at - encoding_at
+                        durations['server_send'] = \
+                            tracing.stamp() - sending_at
+                        stats.record(durations)
 
                     # print('Sent process response to client')
 
-            else:
-                # the stop_server event was set
-                message_queue.put(None)
+                    # the next message may use a different protocol
+                    reader.protocol = wire_protocol
 
-    except ConnectionResetError:
+    except ConnectionError:
         # print("The connection with the client was broken, killing thread and process")
-        message_queue.put(None)
+        pass
+
+    metrics.closed(connection)
+
+    if observations is not None:
+        observations.close()
+
+    if session is not None and not shut_down and not closed and \
+            session.confirmation is not None:
+        # keep the environments for when the client comes back
+        session.env_processes = env_processes
+        retired.extend(sessions.park(session))
+        env_processes = []
+
+    elif session is not None:
+        sessions.forget(session)
+
+    retired.extend(sessions.expired())
+
+    # the connection is broken or the server is stopping, processes go back
+    # to the pool, or shut down if the pool does not need them
+    stopped = [env_process for env_process in env_processes + retired
+               if shut_down or not pool.release(env_process)]
+
+    for env_process in stopped:
+        env_process.stop()
 
     # print("End of thread")
-    env_process.join()
+    for env_process in stopped:
+        env_process.join()
     # print("End of process")
 
 
+def reap_sessions(sessions, pool, stop_server):
+    """
+    Closes the sessions that have been parked for too long, until the server
+    stops. Without this, the environments of parked sessions would only be
+    released when a connection closes.
+
+    Arguments:
+    sessions -- The SessionRegistry of the server
+    pool -- The EnvProcessPool or StepScheduler of the server
+    stop_server -- A threading.Event that is set when the server stops
+    """
+    while not stop_server.wait(sessions.reap_interval):
+        stopped = [env_process for env_process in sessions.expired()
+                   if not pool.release(env_process)]
+
+        for env_process in stopped:
+            env_process.stop()
+
+        for env_process in stopped:
+            env_process.join()
+
+
+def forward_message(message, env_processes):
+    """
+    Forwards a message of a client to its environment processes.
+
+    With a single environment the message is passed on as is. With several
+    environments the message is split up and the responses are combined, see
+    server_utils.scatter_message() and server_utils.gather_responses().
+
+    Arguments:
+    message -- The message received from the client, already decoded.
+    env_processes -- A list of EnvProcess instances serving the client.
+
+    Returns:
+    The response for the client, or None if the environment processes have
+    shut down.
+    """
+    if len(env_processes) == 1:
+        return env_processes[0].request(message)
+
+    messages = server_utils.scatter_message(message, len(env_processes))
+
+    for env_process, env_message in zip(env_processes, messages):
+        env_process.send(env_message)
+
+    responses = [env_process.receive() for env_process in env_processes]
+
+    if any(response is None for response in responses):
+        return None
+
+    # start new episodes for finished environments, so the client can keep
+    # stepping
+    resets = {i: env_processes[i].request({'command': 'reset'})
+              for i in server_utils.finished_envs(message, responses)}
+
+    return server_utils.gather_responses(message, responses, resets)
+
+
 def main():
     args = server_utils.parse_cli_args()
 
@@ -180,12 +461,38 @@ def main():
         print("This server will now be shut down.")
         server_utils.send_shutdown_command(args.host, args.port)
 
+    elif args.print_stats:
+        server_utils.print_stats(
+            server_utils.request_stats(args.host, args.port))
+
     else:
         print("An environment server will be started with the following properties:\n")
         print(f"\t- Directory: {args.directory}")
         print(f"\t- Max. connections: {args.max_connections}")
-
-        start_server(args.host, args.port, args.directory, args.max_connections)
+        print(f"\t- Pool size: {args.pool_size}")
+        print(f"\t- Matlab params: {args.matlab_params}")
+        print(f"\t- Asyncio: {args.asyncio}")
+        print(f"\t- Shared memory: {args.shared_memory}")
+        print(f"\t- Local socket: {not args.no_local_socket}")
+        print(f"\t- Session timeout: {args.session_timeout}")
+        print(f"\t- Envs per worker: {args.envs_per_worker}")
+        print(f"\t- Trace all requests: {args.trace}")
+        print(f"\t- Metrics port: {args.metrics_port}")
+
+        if args.asyncio:
+            async_server.start_server(args.host, args.port, args.directory,
+                                      args.max_connections, args.pool_size,
+                                      args.matlab_params, args.shared_memory,
+                                      not args.no_local_socket,
+                                      args.session_timeout,
+                                      args.envs_per_worker, args.trace,
+                                      args.metrics_port)
+        else:
+            start_server(args.host, args.port, args.directory,
+                         args.max_connections, args.pool_size,
+                         args.matlab_params, args.shared_memory,
+                         not args.no_local_socket, args.session_timeout,
+                         args.envs_per_worker, args.trace, args.metrics_port)
 
     print("End of server.py")
 
@@ -4,13 +4,13 @@ import numpy as np
 import datetime
 import os
 import argparse
-import time
 from queue import Full
 import socket
-import json
 
-_delimiter = b'<END>'
-_encoding = 'utf-8'
+from . import protocol
+from . import tracing
+from .sessions import DEFAULT_TIMEOUT, Session
+from .shared_slots import SlotRing, slot_layout
 
 
 def parse_cli_args(host='127.0.0.1', port=65432, directory=os.getcwd(),
@@ -31,6 +31,11 @@ def parse_cli_args(host='127.0.0.1', port=65432, directory=os.getcwd(),
     parser.add_argument('-s', '--stop',
                         help='if specified, it will shut down the server instead of starting it',
                         action='store_true')
+    parser.add_argument('-P', '--print_stats',
+                        help='if specified, it will print the timing \
+                                    histograms of a running server instead of \
+                                    starting one',
+                        action='store_true')
     parser.add_argument('-H', '--host',
                         help='the host address of the server',
                         default=host)
@@ -46,6 +51,48 @@ def parse_cli_args(host='127.0.0.1', port=65432, directory=os.getcwd(),
                         help='the maximum number of simultaneous connections',
                         default=max_connections,
                         type=int)
+    parser.add_argument('-w', '--pool_size',
+                        help='the number of environment processes that are \
+                                    started in advance and kept ready',
+                        default=0,
+                        type=int)
+    parser.add_argument('-m', '--matlab_params',
+                        help='if specified, the processes started in advance \
+                                    also start a Matlab session with these \
+                                    parameters, e.g. "-desktop"',
+                        default=None)
+    parser.add_argument('-a', '--asyncio',
+                        help='handle all connections on one asyncio event \
+                                    loop instead of a thread per connection',
+                        action='store_true')
+    parser.add_argument('-S', '--shared_memory',
+                        help='pass actions and observations to the environment \
+                                    processes through shared memory',
+                        action='store_true')
+    parser.add_argument('-t', '--session_timeout',
+                        help='the number of seconds the environments of a \
+                                    disconnected client are kept for it',
+                        default=DEFAULT_TIMEOUT,
+                        type=float)
+    parser.add_argument('-U', '--no_local_socket',
+                        help='do not listen on a Unix domain socket for \
+                                    clients on the same machine',
+                        action='store_true')
+    parser.add_argument('-T', '--trace',
+                        help='time the stages of every request, not only \
+                                    those of clients that ask for it',
+                        action='store_true')
+    parser.add_argument('-k', '--envs_per_worker',
+                        help='if specified, host up to this many environments \
+                                    in one worker process and batch their \
+                                    requests',
+                        default=0,
+                        type=int)
+    parser.add_argument('-M', '--metrics_port',
+                        help='if specified, serve the metrics of the server \
+                                    over HTTP on this port, at /metrics',
+                        default=None,
+                        type=int)
 
     args = parser.parse_args()
 
@@ -57,9 +104,9 @@ def send_shutdown_command(host, port):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.connect((host, port))
 
-            message = json.dumps({'command': 'shut_down_server'})
+            message = {'command': 'shut_down_server'}
 
-            s.sendall(message.encode(_encoding) + _delimiter)
+            s.sendall(protocol.encode_json(message))
 
             data = s.recv(1024)
 
@@ -91,6 +138,148 @@ def send_shutdown_command(host, port):
     print("Server should have shut down soon")
 
 
+def request_stats(host, port, timeout=None):
+    """
+    Asks a running server for the histograms of the durations of the stages
+    of traced requests, see bikey.network.tracing.
+
+    Arguments:
+    host -- The address of the server
+    port -- The port of the server
+    timeout -- If not None, the number of seconds after which to give up on
+        connecting or on a response, with a socket.timeout.
+
+    Returns:
+    The result of tracing.StageHistograms.snapshot() on the server.
+    """
+    with socket.create_connection((host, port), timeout) as s:
+        s.sendall(protocol.encode_json({'command': 'stats'}))
+
+        reader = protocol.MessageReader(protocol.JSON)
+
+        while True:
+            raw_message = reader.next_message()
+
+            if raw_message is not None:
+                return protocol.decode_json(raw_message)['data']
+
+            if not reader.recv_from(s):
+                raise ConnectionError("The server closed the connection")
+
+
+def print_stats(stats):
+    """
+    Prints the estimated median and 99th percentile of every stage, see
+    request_stats().
+    """
+    print(f"{'stage':<24} {'count':>9} {'mean ms':>9} {'p50 ms':>9} "
+          f"{'p99 ms':>9}")
+
+    for stage, histogram in sorted(stats['stages'].items()):
+        if stage == 'engine_calls':
+            # not a duration
+            continue
+
+        mean = histogram['sum'] / max(histogram['count'], 1)
+        p50 = tracing.quantile(stats, stage, 0.5)
+        p99 = tracing.quantile(stats, stage, 0.99)
+
+        print(f"{stage:<24} {histogram['count']:>9} {1000 * mean:>9.3f} "
+              f"{1000 * p50:>9.3f} {1000 * p99:>9.3f}")
+
+
+def bind_socket(host, port):
+    """
+    Creates the listening TCP socket of a server.
+
+    The address is reused, so a server can be restarted right away even if
+    connections of the previous one are still in TIME_WAIT.
+
+    Raises:
+    OSError if the socket cannot be bound, e.g. because the port is in use.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    try:
+        s.bind((host, port))
+        s.listen()
+    except OSError:
+        s.close()
+        raise
+
+    return s
+
+
+def open_local_socket(port):
+    """
+    Creates the listening Unix domain socket of a server, see
+    protocol.local_socket_path().
+
+    A socket file left behind by a server that has stopped is replaced, but
+    the socket of a server that is still running is left alone.
+
+    Arguments:
+    port -- The TCP port of the server
+
+    Returns:
+    The listening socket, or None if Unix domain sockets are not supported or
+    the path is in use.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    path = protocol.local_socket_path(port)
+
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+
+            print(f"Another server is listening on {path}")
+            return None
+
+        except OSError:
+            # nobody is listening, the file is stale
+            os.remove(path)
+
+    local_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    local_socket.bind(path)
+    local_socket.listen()
+
+    return local_socket
+
+
+def close_local_socket(local_socket, port):
+    """
+    Closes a socket created by open_local_socket() and removes its file.
+    """
+    if local_socket is None:
+        return
+
+    local_socket.close()
+
+    try:
+        os.remove(protocol.local_socket_path(port))
+    except OSError:
+        pass
+
+
+def is_local_connection(client_socket, host, address):
+    """
+    Determines whether a client runs on the same machine as the server.
+
+    Arguments:
+    client_socket -- The socket of the connection
+    host -- The interface the server listens on
+    address -- The address of the client, as returned by accept()
+    """
+    if getattr(socket, 'AF_UNIX', None) == client_socket.family:
+        return True
+
+    return host == address[0]
+
+
 def display_connections(connections):
     """
     Prints all provided connections.
@@ -174,18 +363,206 @@ def provide_names(base_dir, queue, queue_size, stop_dir_generator):
         try:
             queue.put(name(), False)  # do not block
         except Full:
-            # queue is full, wait a while before trying again
-            time.sleep(10)
+            # queue is full, wait a while before trying again. Stop right away
+            # when asked to, so a server that fails to start can exit
+            stop_dir_generator.wait(10)
             continue
         # print(f"Put {name} on the queue")
         counter += 1
 
 
+def decode_client_message(raw_message, wire_protocol):
+    """
+    Decodes a message received from a client.
+
+    Arguments:
+    raw_message -- The bytes of the message, without framing
+    wire_protocol -- The protocol currently used by the connection
+
+    Returns:
+    The message stored in a python dictionary, with the action as numpy array.
+    """
+    message = protocol.decode(raw_message, wire_protocol)
+
+    if wire_protocol == protocol.JSON:
+        # make sure actions are turned into numpy arrays, the binary protocol
+        # already delivers them as arrays
+        numpyify(message)
+
+    return message
+
+
+def encode_client_response(message, response, wire_protocol,
+                           requested_protocol, compression=None,
+                           requested_compression=None):
+    """
+    Encodes the response to a client's message.
+
+    If the message is an init (or resume) command in which the client asked
+    for the binary protocol, the confirmation mentions the binary protocol. It
+    is still sent in JSON form, but afterwards both sides switch over.
+    Compression is only used together with the binary protocol: if the client
+    asked for it and the server supports its settings, the settings are
+    confirmed as well, and all later responses are compressed.
+
+    If the message has a request 'id', the response gets the same id so the
+    client can match them up when it has several requests in flight.
+
+    Arguments:
+    message -- The message the response belongs to
+    response -- The response stored in a python dictionary
+    wire_protocol -- The protocol currently used by the connection
+    requested_protocol -- The protocol the client asked for in its init command
+    compression -- The protocol.Compression currently used by the connection,
+        or None
+    requested_compression -- The compression settings the client asked for in
+        its init command, or None
+
+    Returns:
+    A tuple containing the bytes that should be sent to the client, and the
+    protocol and compression the connection uses from now on.
+    """
+    if wire_protocol == protocol.JSON:
+        # make sure observations are turned into lists before being turned
+        # into json
+        denumpyify(response)
+
+    if 'id' in message:
+        response['id'] = message['id']
+
+    if message['command'] in ('init', 'resume') and \
+            response['command'] == 'confirm' and \
+            requested_protocol == protocol.BINARY:
+        response['data']['protocol'] = protocol.BINARY
+
+        if requested_compression is not None:
+            compression = protocol.Compression.negotiate(requested_compression)
+
+            if compression is not None:
+                response['data']['compression'] = compression.settings()
+
+        return protocol.encode(response, wire_protocol), protocol.BINARY, \
+            compression
+
+    return protocol.encode(response, wire_protocol, compression), \
+        wire_protocol, compression
+
+
+def share_observations(message, response, observations, requested_slots):
+    """
+    Passes the observations of a local client through shared memory.
+
+    A client on the same machine can ask for shared memory in its init
+    command, by setting 'shared_memory' to a number of slots. The confirmation
+    of the init command then describes a SlotRing (see
+    bikey.network.shared_slots) that the client attaches to. Afterwards every
+    observation that fits is written into the next slot of the ring, and the
+    response only contains the index of the slot as 'observation_slot'.
+
+    Arguments:
+    message -- The message the response belongs to
+    response -- The response stored in a python dictionary, it is changed in
+        place
+    observations -- The SlotRing used by the connection, or None
+    requested_slots -- The number of slots the client asked for, or None if
+        the client should not get shared memory
+
+    Returns:
+    The SlotRing the connection uses from now on, or None.
+    """
+    data = response.get('data') or {}
+
+    if message['command'] in ('init', 'resume'):
+        if response['command'] != 'confirm' or not requested_slots:
+            return observations
+
+        # a client may initialize a new environment on the same connection
+        if observations is not None:
+            observations.close()
+
+        shape, dtype = slot_layout(data['observation_space'])
+        if 'num_envs' in data:
+            shape = (data['num_envs'],) + shape
+
+        observations = SlotRing(shape, dtype, int(requested_slots))
+        data['shared_memory'] = observations.spec()
+
+    elif observations is not None and 'observation' in data and \
+            observations.fits(data['observation']):
+        data['observation_slot'] = observations.write(data.pop('observation'))
+
+    return observations
+
+
+def open_session(sessions, message, num_envs, env_processes):
+    """
+    Handles the session a client asks for in an init or resume command.
+
+    Without a 'session' entry an init command is handled as usual. With one,
+    the client either gets the environments of a parked session back, or a
+    new session is started for it, see bikey.network.sessions.
+
+    Arguments:
+    sessions -- The SessionRegistry of the server
+    message -- The init or resume command, its 'session' entry is removed
+    num_envs -- The number of environments asked for
+    env_processes -- The environment processes serving the client so far
+
+    Returns:
+    A four tuple containing
+    - the Session of the connection, or None
+    - the environment processes serving the client from now on
+    - environment processes that are no longer needed, and should be released
+    - a list of (message, response) tuples that should be sent to the client,
+        or None if the message should be forwarded to the environment
+        processes as usual
+    """
+    key = message['data'].pop('session', None)
+    resume = message['command'] == 'resume'
+
+    if key is None and not resume:
+        return None, env_processes, [], None
+
+    if key and sessions.in_use(key):
+        # the client may come back before its old connection has been
+        # noticed to be broken, it should try again a little later
+        error = {
+            'command': 'error',
+            'data': {'message': f"Session '{key}' is in use", 'retry': True}
+        }
+        return None, env_processes, [], [(message, error)]
+
+    if resume:
+        session, dropped = sessions.take(key)
+    else:
+        session, dropped = sessions.take(key, message['data'], num_envs)
+
+    if session is None:
+        if resume:
+            error = {
+                'command': 'error',
+                'data': {'message': f"There is no session '{key}' to resume"}
+            }
+            return None, env_processes, dropped, [(message, error)]
+
+        session = Session(key, message['data'], num_envs)
+        sessions.start(session)
+
+        return session, env_processes, dropped, None
+
+    # the processes of the session replace the ones of this connection
+    confirmation, replays = session.resume(message)
+
+    return session, session.env_processes, dropped + env_processes, \
+        [(message, confirmation)] + replays
+
+
 def numpyify(message):
     """
     Transforms specified 'action' into a numpy array.
 
-    At this point the numpy array is stored in its .tolist() form.
+    At this point the numpy array is stored in its .tolist() form. Only needed
+    for clients using the legacy JSON protocol.
 
     Arguments:
     message -- The message stored in a python dictionary
@@ -199,7 +576,8 @@ def denumpyify(message):
     """
     Transforms 'observation' numpy array into list form.
 
-    Replaces the 'observation' with its array.tolist() form.
+    Replaces the 'observation' with its array.tolist() form. Only needed for
+    clients using the legacy JSON protocol.
 
     Arguments:
     message -- The message stored in a python dictionary
@@ -207,3 +585,128 @@ def denumpyify(message):
     if 'data' in message and 'observation' in message['data']:
         message['data']['observation'] = \
             message['data']['observation'].tolist()
+
+
+def scatter_message(message, num_envs):
+    """
+    Splits up a client's message for a vector of environments.
+
+    'step' messages contain stacked actions, every environment receives its own
+    row. Any other message is sent to all environments unchanged.
+
+    Arguments:
+    message -- The message stored in a python dictionary
+    num_envs -- The number of environments serving the client
+
+    Returns:
+    A list with a message for every environment.
+    """
+    if message['command'] == 'step':
+        actions = message['data']['action']
+        messages = [{'command': 'step', 'data': {'action': action}}
+                    for action in actions]
+
+        if 'trace' in message:
+            for env_message in messages:
+                env_message['trace'] = message['trace']
+
+        return messages
+
+    return [message] * num_envs
+
+
+def finished_envs(message, responses):
+    """
+    Returns the indices of the environments whose episodes have just ended.
+
+    Arguments:
+    message -- The message the responses belong to
+    responses -- The responses of all environments
+    """
+    if message['command'] != 'step':
+        return []
+
+    return [i for i, response in enumerate(responses)
+            if response['command'] == 'confirm' and response['data']['done']]
+
+
+def gather_responses(message, responses, resets):
+    """
+    Combines the responses of a vector of environments into one response.
+
+    Observations are stacked, rewards and dones are put into arrays and the
+    infos into a list. The environments in resets have started a new episode,
+    the first observation of that episode replaces the final one, which is
+    moved to info['terminal_observation'].
+
+    Arguments:
+    message -- The message the responses belong to
+    responses -- The responses of all environments
+    resets -- A dictionary mapping environment indices to the response to a
+        'reset' command sent after the environment's episode ended.
+
+    Returns:
+    The response for the client. If any environment answered with an error,
+    this is the first error.
+    """
+    errors = [response for response in responses + list(resets.values())
+              if response['command'] != 'confirm']
+    if errors:
+        return errors[0]
+
+    response = _gather(message, responses, resets)
+
+    # a traced request is as slow as its slowest environment
+    trace = tracing.merge([response.get('trace') for response in responses])
+    if trace is not None:
+        response['trace'] = trace
+
+    return response
+
+
+def _gather(message, responses, resets):
+    command = message['command']
+
+    if command == 'init':
+        # all environments are identical, so are their spaces
+        response = responses[0]
+        response['data']['num_envs'] = len(responses)
+        return response
+
+    elif command == 'reset':
+        return {
+            'command': 'confirm',
+            'data': {
+                'observation': np.stack(
+                    [response['data']['observation'] for response in responses])
+            }
+        }
+
+    elif command == 'step':
+        observations = []
+        infos = []
+
+        for i, response in enumerate(responses):
+            observation = response['data']['observation']
+            info = response['data']['info']
+
+            if i in resets:
+                info['terminal_observation'] = observation
+                observation = resets[i]['data']['observation']
+
+            observations.append(observation)
+            infos.append(info)
+
+        return {
+            'command': 'confirm',
+            'data': {
+                'observation': np.stack(observations),
+                'reward': np.array([response['data']['reward']
+                                    for response in responses]),
+                'done': np.array([bool(response['data']['done'])
+                                  for response in responses]),
+                'info': infos
+            }
+        }
+
+    return responses[0]
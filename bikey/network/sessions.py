@@ -0,0 +1,253 @@
+import collections
+import copy
+import secrets
+import threading
+import time
+
+# Keeps the environments of a client alive when its connection is gone.
+#
+# A client that asks for a session in its init command (by setting 'session'
+# to a name, or to '' to get a random token) can come back later:
+#
+#   - After its connection broke, the client reconnects and sends a 'resume'
+#     command with the token. It gets its environments back in the state they
+#     were in, and responses that were lost with the connection are sent
+#     again.
+#   - A new client that sends an init command with the name of a parked
+#     session, for the same environment, gets the environments of that session
+#     instead of new ones. This saves starting processes and Matlab, e.g. when
+#     a worker of a training run is restarted.
+#
+# Parked sessions that are not picked up in time are closed, see
+# SessionRegistry.expired(). The servers look for these periodically, so they
+# are also closed when nobody connects to the server anymore.
+
+# the number of recent responses kept for replaying after a reconnect
+REPLAY_SIZE = 16
+
+# the number of seconds a parked session is kept by default
+DEFAULT_TIMEOUT = 300
+
+# the maximum number of seconds between two looks for expired sessions, see
+# SessionRegistry.reap_interval
+REAP_INTERVAL = 10
+
+
+class Session:
+    """
+    The environments of one client, and what is needed to hand them over to a
+    new connection.
+    """
+
+    def __init__(self, key, init_data, num_envs):
+        """
+        Arguments:
+        key -- The name of the session, or '' for a random token
+        init_data -- The data of the init command that created the session,
+            without the settings of the connection
+        num_envs -- The number of environments of the session
+        """
+        self.token = key or secrets.token_hex(16)
+        self.named = bool(key)
+
+        self.env = init_data.get('env')
+        self.config = init_data.get('config')
+        self.num_envs = num_envs
+
+        self.env_processes = []
+        self.confirmation = None  # the data of the init confirmation
+
+        self.last_id = None  # the id of the last message that was handled
+        self.responses = collections.deque(maxlen=REPLAY_SIZE)
+
+        self.parked_at = None
+
+    def matches(self, init_data, num_envs):
+        """
+        Returns whether an init command asks for the environments of this
+        session.
+        """
+        return self.env == init_data.get('env') and \
+            self.config == init_data.get('config') and \
+            self.num_envs == num_envs
+
+    def record(self, message, response):
+        """
+        Remembers a response, so it can be sent again after a reconnect.
+
+        Must be called before the response is encoded, with the message it
+        belongs to. The confirmation of the init command is given the token
+        of the session.
+        """
+        if message['command'] == 'resume':
+            # only the client's own requests are replayed
+            return
+
+        if message['command'] == 'init' and response['command'] == 'confirm':
+            response['data']['session'] = self.token
+            self.confirmation = copy.deepcopy(response['data'])
+
+        self.last_id = message.get('id')
+
+        # observations may be views on shared memory that is reused later
+        self.responses.append((message.get('id'), copy.deepcopy(response)))
+
+    def resume(self, message):
+        """
+        Confirms a 'resume' command, or an init command that reuses the
+        session.
+
+        Arguments:
+        message -- The resume or init command
+
+        Returns:
+        A tuple containing the confirmation, and a list of (message, response)
+        tuples of the responses that should be sent again afterwards.
+        """
+        data = copy.deepcopy(self.confirmation)
+        data['session'] = self.token
+        replays = []
+
+        if message['command'] == 'resume':
+            # the client mentions the requests it has not seen a response to
+            pending = set(message['data'].get('pending', []))
+
+            replays = [({'command': 'replay', 'id': request_id}, response)
+                       for request_id, response in self.responses
+                       if request_id in pending]
+
+            data['last_id'] = self.last_id
+            data['replayed'] = [replay['id'] for replay, _ in replays]
+
+        else:
+            # a new client, its request ids start over
+            self.last_id = None
+            self.responses.clear()
+
+        return {'command': 'confirm', 'data': data}, copy.deepcopy(replays)
+
+
+class SessionRegistry:
+    """
+    Holds the sessions whose client has disconnected, and knows which sessions
+    are in use by a connected client.
+
+    The registry is safe to use from several threads.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Arguments:
+        timeout -- The number of seconds a parked session is kept.
+        """
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.parked = {}
+        self.active = set()  # the tokens of sessions with a connected client
+
+    def start(self, session):
+        """
+        Marks a new session as in use.
+        """
+        with self.lock:
+            self.active.add(session.token)
+
+    def in_use(self, token):
+        """
+        Returns whether a connected client is using the session.
+
+        This is also the case for a short while after the client's connection
+        broke, until the server notices.
+        """
+        with self.lock:
+            return token in self.active
+
+    def forget(self, session):
+        """
+        Ends a session that is not parked.
+        """
+        with self.lock:
+            self.active.discard(session.token)
+
+    def park(self, session):
+        """
+        Keeps a session until a client picks it up.
+
+        Returns:
+        The environment processes of a session that had the same name, and
+        that should be released.
+        """
+        session.parked_at = time.monotonic()
+
+        with self.lock:
+            self.active.discard(session.token)
+            previous = self.parked.pop(session.token, None)
+            self.parked[session.token] = session
+
+        return previous.env_processes if previous is not None else []
+
+    def take(self, token, init_data=None, num_envs=1):
+        """
+        Hands a parked session over to a new connection.
+
+        Arguments:
+        token -- The name or token of the session
+        init_data -- The data of the init command, or None for a 'resume'
+            command
+        num_envs -- The number of environments asked for in the init command
+
+        Returns:
+        A tuple containing the session, or None if no suitable session is
+        parked, and the environment processes of a session that had the
+        requested name but a different environment. These should be released.
+        """
+        with self.lock:
+            session = self.parked.pop(token, None)
+
+            if session is not None and (init_data is None or
+                                        session.matches(init_data, num_envs)):
+                self.active.add(token)
+                return session, []
+
+        if session is None:
+            return None, []
+
+        return None, session.env_processes
+
+    @property
+    def reap_interval(self):
+        """
+        The number of seconds between two calls to expired() by the server.
+        Sessions are closed at most this long after their timeout.
+        """
+        return min(REAP_INTERVAL, max(self.timeout, 1))
+
+    def expired(self):
+        """
+        Removes the sessions that have been parked for too long.
+
+        Returns:
+        The environment processes of those sessions, which should be released.
+        """
+        deadline = time.monotonic() - self.timeout
+
+        with self.lock:
+            expired = [token for token, session in self.parked.items()
+                       if session.parked_at < deadline]
+            sessions = [self.parked.pop(token) for token in expired]
+
+        return [env_process for session in sessions
+                for env_process in session.env_processes]
+
+    def close(self):
+        """
+        Removes all sessions.
+
+        Returns:
+        The environment processes of all sessions.
+        """
+        with self.lock:
+            sessions, self.parked = list(self.parked.values()), {}
+
+        return [env_process for session in sessions
+                for env_process in session.env_processes]
@@ -0,0 +1,316 @@
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+# Moves actions and observations between the server and an environment process
+# through shared memory instead of pickling them into a pipe.
+#
+# Both sides hold a ring of preallocated slots for actions and one for
+# observations, sized from the spaces the environment reported in its init
+# confirmation. Sending an action means writing it into the next free slot and
+# sending a small control tuple through the pipe that says which slot to read:
+#
+#   server -> process:  ('step', slot, trace)
+#   process -> server:  ('observation', slot, data, trace)
+#
+# where data holds the rest of the response, i.e. the reward, done and info,
+# and trace the 'trace' entry of the message, if any (see
+# bikey.network.tracing).
+# Messages that do not fit in a slot, and all other commands, are sent through
+# the pipe as before. See bikey.network.env_process.SharedMemoryEnvProcess.
+
+_STEP = 'step'
+_OBSERVATION = 'observation'
+_ATTACH = 'attach'
+
+
+class SlotRing:
+    """
+    A fixed number of equally sized array slots in a block of shared memory.
+
+    Slots are handed out in turn, so a slot is only overwritten after all
+    other slots have been used. An array read from a slot therefore stays
+    valid while the next slots - 1 messages are exchanged.
+    """
+
+    def __init__(self, shape, dtype, slots, name=None):
+        """
+        Creates a new block of shared memory, or attaches to an existing one.
+
+        Arguments:
+        shape -- The shape of the array in every slot.
+        dtype -- The data type of the arrays.
+        slots -- The number of slots.
+        name -- The name of an existing block to attach to, or None to create
+            a new one.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.owner = name is None
+
+        size = max(1, slots * int(np.prod(self.shape, dtype=np.int64)) *
+                   self.dtype.itemsize)
+
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = _attach(name)
+
+        self.array = np.ndarray((slots,) + self.shape, self.dtype,
+                                buffer=self.memory.buf)
+        self.position = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Attaches to the ring described by spec, see SlotRing.spec().
+        """
+        name, shape, dtype, slots = spec
+        return cls(shape, dtype, slots, name)
+
+    def spec(self):
+        """
+        Returns a description of the ring, with which another process can
+        attach to it.
+        """
+        return self.memory.name, self.shape, self.dtype.str, self.slots
+
+    def fits(self, value):
+        """
+        Returns whether an array can be stored in a slot without losing
+        information.
+        """
+        return isinstance(value, np.ndarray) and value.shape == self.shape \
+            and np.can_cast(value.dtype, self.dtype, 'safe')
+
+    def write(self, value):
+        """
+        Copies an array into the next slot.
+
+        Returns:
+        The index of the slot.
+        """
+        slot = self.position
+        self.array[slot] = value
+        self.position = (slot + 1) % self.slots
+
+        return slot
+
+    def read(self, slot):
+        """
+        Returns a read-only view on the array in a slot.
+        """
+        view = self.array[slot]
+        view.flags.writeable = False
+
+        return view
+
+    def close(self):
+        """
+        Detaches from the shared memory, which is freed by its owner.
+        """
+        self.array = None
+
+        try:
+            self.memory.close()
+        except BufferError:
+            # views on the memory are still in use, they keep it mapped until
+            # they are garbage collected
+            pass
+
+        if self.owner:
+            # an environment process shares the resource tracker of the
+            # server, so its _attach() may have unregistered the memory there.
+            # unlink() unregisters the memory, which the tracker reports as an
+            # error if it is no longer registered
+            resource_tracker.register(self.memory._name, 'shared_memory')
+            self.memory.unlink()
+
+
+class ServerChannel:
+    """
+    The server's end of a shared memory channel to an environment process.
+
+    Has the send() and recv() methods of a multiprocessing.Connection, so it
+    can take the place of the server's end of a pipe.
+    """
+
+    def __init__(self, connection, slots=4):
+        """
+        Arguments:
+        connection -- The server's end of a pipe to the environment process.
+        slots -- The number of slots in the rings of actions and observations.
+        """
+        self.connection = connection
+        self.slots = slots
+
+        # created once the environment has described its spaces
+        self.actions = None
+        self.observations = None
+
+    def send(self, message):
+        if self.actions is not None and message is not None and \
+                message['command'] == 'step':
+            action = np.asarray(message['data']['action'])
+
+            if self.actions.fits(action):
+                self.connection.send((_STEP, self.actions.write(action),
+                                      message.get('trace')))
+                return
+
+        self.connection.send(message)
+
+    def recv(self):
+        message = self.connection.recv()
+
+        if isinstance(message, tuple):
+            # only observations are sent as a tuple
+            _, slot, data, trace = message
+            data['observation'] = self.observations.read(slot)
+
+            response = {'command': 'confirm', 'data': data}
+            if trace is not None:
+                response['trace'] = trace
+
+            return response
+
+        if message is not None and 'action_space' in (message.get('data')
+                                                      or {}):
+            # the confirmation of an init command, the spaces are now known
+            self._allocate(message['data'])
+
+        return message
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def close(self):
+        """
+        Frees the shared memory and closes the pipe.
+        """
+        self._free()
+        self.connection.close()
+
+    def _allocate(self, data):
+        # a reused process may have served a different environment before
+        self._free()
+
+        self.actions = SlotRing(
+            *slot_layout(data['action_space']), self.slots)
+        self.observations = SlotRing(
+            *slot_layout(data['observation_space']), self.slots)
+
+        self.connection.send(
+            (_ATTACH, self.actions.spec(), self.observations.spec()))
+
+    def _free(self):
+        for ring in (self.actions, self.observations):
+            if ring is not None:
+                ring.close()
+
+        self.actions = None
+        self.observations = None
+
+
+class ProcessChannel:
+    """
+    The environment process's end of a shared memory channel.
+
+    Has the get() and put() methods of a queue, so run_environment() can use
+    it in place of its message and response queues.
+    """
+
+    def __init__(self, connection):
+        """
+        Arguments:
+        connection -- The environment process's end of a pipe to the server.
+        """
+        self.connection = connection
+
+        self.actions = None
+        self.observations = None
+
+    def get(self):
+        while True:
+            message = self.connection.recv()
+
+            if not isinstance(message, tuple):
+                return message
+
+            if message[0] == _ATTACH:
+                self._attach(message[1], message[2])
+                continue
+
+            _, slot, trace = message
+            message = {
+                'command': 'step',
+                'data': {'action': self.actions.read(slot)}
+            }
+            if trace is not None:
+                message['trace'] = trace
+
+            return message
+
+    def put(self, message):
+        if self.observations is not None and message is not None and \
+                'observation' in (message.get('data') or {}):
+            data = dict(message['data'])
+            observation = data.pop('observation')
+
+            if self.observations.fits(observation):
+                slot = self.observations.write(observation)
+                self.connection.send((_OBSERVATION, slot, data,
+                                      message.get('trace')))
+                return
+
+        self.connection.send(message)
+
+    def _attach(self, action_spec, observation_spec):
+        for ring in (self.actions, self.observations):
+            if ring is not None:
+                ring.close()
+
+        self.actions = SlotRing.from_spec(action_spec)
+        self.observations = SlotRing.from_spec(observation_spec)
+
+
+def slot_layout(description):
+    """
+    Determines the shape and data type of slots for a space.
+
+    Floating point slots always use 64 bits, because environments often
+    return more precise values than their spaces declare.
+
+    Arguments:
+    description -- A space description created by
+        bikey.network.env_process.gym_space_to_dict().
+
+    Returns:
+    A tuple containing the shape and the data type.
+    """
+    if description['space'] == 'gym.spaces.Discrete':
+        return (), np.dtype(np.int64)
+
+    dtype = np.dtype(description['dtype'])
+
+    if dtype.kind == 'f':
+        dtype = np.dtype(np.float64)
+
+    return tuple(description['shape']), dtype
+
+
+def _attach(name):
+    # the creator of the memory is responsible for freeing it. Before Python
+    # 3.13 attaching registers the memory with this process's resource
+    # tracker, which would free it as soon as this process exits (bpo-38119).
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # undo the registration, as the usual workaround does. Patching register()
+    # instead would affect other threads that create shared memory meanwhile
+    memory = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(memory._name, 'shared_memory')
+
+    return memory
@@ -0,0 +1,294 @@
+import bisect
+import copy
+import threading
+import time
+
+# Opt-in timing of the stages a request passes through on its way from a
+# NetworkEnv to an environment and back.
+#
+# A NetworkEnv created with trace=True marks its requests with 'trace': True.
+# The server (which can also be told to trace every request) replaces the mark
+# by the time at which it forwards the request to the environment process.
+# The environment process answers with the times at which it received and
+# answered the request, and the time it spent in Matlab engine calls. The
+# server turns these into durations, and the client adds its own. The stages
+# are, in seconds:
+#
+#   client_encode   encoding the request on the client
+#   client_send     handing the request over to the socket
+#   network         the rest of the round trip: the socket in both directions,
+#                   waiting until the server gets to the request, and encoding
+#                   the response
+#   server_decode   parsing the request in the server's handle_client()
+#   to_env          passing the request to the environment process, through
+#                   its queue or pipe, or the batch of a StepScheduler
+#   env             handling the request in the environment process
+#   engine          the part of env spent in Matlab engine calls, which is
+#                   also split up per engine function as engine.<function>
+#   from_env        passing the response back to the server
+#   server          everything on the server, from receiving the request until
+#                   the response is ready to be encoded
+#   client_decode   decoding the response on the client
+#   total           the entire request, as seen by the client
+#
+# engine_calls holds the number of engine calls. Only processes on the same
+# machine compare their clocks: they share the clock of time.perf_counter().
+#
+# The server also adds the durations of every traced request to its
+# StageHistograms, together with server_encode and server_send, the time it
+# took to encode the response and to hand it over to the socket. Anyone can
+# ask the server for these with a 'stats' command, see
+# bikey.network.server_utils.request_stats().
+
+# the upper bounds of the histogram buckets in seconds, four per decade from
+# 10 microseconds up to 10 seconds. Longer durations go in one more bucket
+BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-20, 5))
+
+stamp = time.perf_counter
+
+
+def begin(message, received_at, trace_all=False):
+    """
+    Starts the trace of a request that the server has just parsed.
+
+    The request is marked with the current time, which the environment process
+    uses to determine how long the request took to reach it.
+
+    Arguments:
+    message -- The request, already decoded
+    received_at -- The time at which the server started parsing the request
+    trace_all -- Whether to trace the request even if the client did not ask
+        for it
+
+    Returns:
+    A dictionary with the durations of the stages, or None if the request is
+    not traced.
+    """
+    if not message.pop('trace', False) and not trace_all:
+        return None
+
+    now = stamp()
+    message['trace'] = now
+
+    return {'server_decode': now - received_at}
+
+
+def finish(durations, response, received_at):
+    """
+    Completes the trace of a request once its response is ready, and adds the
+    durations to the response.
+
+    Arguments:
+    durations -- The durations returned by begin()
+    response -- The response of the environment process(es)
+    received_at -- The time at which the server started parsing the request
+    """
+    env = response.pop('trace', None)
+    now = stamp()
+
+    if env is not None:
+        durations['to_env'] = env['received_at'] - env['sent_at']
+        durations['env'] = env['done_at'] - env['received_at']
+        durations['from_env'] = now - env['done_at']
+        durations.update(env['engine'])
+
+    durations['server'] = now - received_at
+    response['trace'] = dict(durations)
+
+
+def merge(traces):
+    """
+    Combines the traces of a vector of environments into one.
+
+    The request is as slow as its slowest environment, so the trace of the
+    environment that answered last is used.
+
+    Arguments:
+    traces -- The 'trace' entries of the responses, None where missing
+
+    Returns:
+    The merged trace, or None if there are no traces.
+    """
+    traces = [trace for trace in traces if trace is not None]
+
+    if not traces:
+        return None
+
+    return max(traces, key=lambda trace: trace['done_at'])
+
+
+def engine_usage(env):
+    """
+    Returns the Matlab engine calls of an environment so far.
+
+    Arguments:
+    env -- A gym environment, or None
+
+    Returns:
+    A dictionary mapping the names of engine functions to their number of
+    calls and total time, see bikey.spacar.CountingSession. It is empty if the
+    environment does not use Matlab.
+    """
+    session = getattr(getattr(env, 'unwrapped', None), 'session', None)
+    usage = getattr(session, 'usage', None)
+
+    return copy.deepcopy(usage) if usage is not None else {}
+
+
+def engine_durations(before, after):
+    """
+    Returns the engine stages of a request, from the engine usage before and
+    after handling it (see engine_usage()).
+    """
+    durations = {}
+    calls = 0
+    total = 0.0
+
+    for name, (after_calls, after_time) in after.items():
+        before_calls, before_time = before.get(name, (0, 0.0))
+
+        if after_calls > before_calls:
+            durations[f'engine.{name}'] = after_time - before_time
+            calls += after_calls - before_calls
+            total += after_time - before_time
+
+    if calls:
+        durations['engine'] = total
+        durations['engine_calls'] = calls
+
+    return durations
+
+
+def env_trace(sent_at, received_at, engine):
+    """
+    Returns the trace an environment process adds to its response.
+
+    Arguments:
+    sent_at -- The time at which the server forwarded the request
+    received_at -- The time at which the environment process received it
+    engine -- The engine stages, see engine_durations()
+    """
+    return {
+        'sent_at': sent_at,
+        'received_at': received_at,
+        'done_at': stamp(),
+        'engine': engine
+    }
+
+
+def client_durations(durations, sent, received_at, decode):
+    """
+    Adds the client's stages to the durations sent by the server.
+
+    Arguments:
+    durations -- The 'trace' entry of the response, or None if the server did
+        not trace the request
+    sent -- A tuple containing the time at which the client started encoding
+        the request, the encode duration and the send duration
+    received_at -- The time at which the response was decoded
+    decode -- The decode duration
+
+    Returns:
+    The durations of all stages.
+    """
+    started, encode, send = sent
+    durations = dict(durations or {})
+
+    durations['client_encode'] = encode
+    durations['client_send'] = send
+    durations['client_decode'] = decode
+    durations['total'] = received_at - started
+
+    if 'server' in durations:
+        durations['network'] = durations['total'] - encode - send - decode - \
+            durations['server']
+
+    return durations
+
+
+class StageHistograms:
+    """
+    Histograms of the durations of the stages of traced requests.
+
+    Every histogram counts the durations in buckets, like a Prometheus
+    histogram: the bucket of a duration is the first one whose upper bound is
+    not exceeded. The histograms are safe to update from several threads.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        Arguments:
+        buckets -- The upper bounds of the buckets in seconds, in increasing
+            order.
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, durations):
+        """
+        Adds the durations of the stages of one request.
+
+        Arguments:
+        durations -- A dictionary mapping stages to seconds. engine_calls is a
+            count, it is added to a histogram of its own with the same
+            buckets.
+        """
+        with self.lock:
+            for stage, value in durations.items():
+                histogram = self.stages.get(stage)
+
+                if histogram is None:
+                    histogram = {'counts': [0] * (len(self.buckets) + 1),
+                                 'count': 0, 'sum': 0.0}
+                    self.stages[stage] = histogram
+
+                histogram['counts'][bisect.bisect_left(self.buckets,
+                                                       value)] += 1
+                histogram['count'] += 1
+                histogram['sum'] += value
+
+    def snapshot(self):
+        """
+        Returns a copy of all histograms that can be sent as JSON.
+
+        Returns:
+        A dictionary containing the bucket bounds in 'buckets', and the
+        histogram of every stage in 'stages'. A histogram holds the count of
+        every bucket in 'counts' (the last one for durations above all
+        bounds), the number of durations in 'count' and their sum in 'sum'.
+        """
+        with self.lock:
+            return {'buckets': list(self.buckets),
+                    'stages': copy.deepcopy(self.stages)}
+
+
+def quantile(snapshot, stage, q):
+    """
+    Estimates a quantile of the durations of a stage from a snapshot of
+    StageHistograms.
+
+    Arguments:
+    snapshot -- The result of StageHistograms.snapshot()
+    stage -- The name of the stage
+    q -- The quantile, between 0 and 1
+
+    Returns:
+    The upper bound of the bucket containing the quantile, infinity if it is
+    in the last bucket, or None if the stage has no durations.
+    """
+    histogram = snapshot['stages'].get(stage)
+
+    if histogram is None or histogram['count'] == 0:
+        return None
+
+    rank = q * histogram['count']
+    seen = 0
+
+    for bound, count in zip(snapshot['buckets'], histogram['counts']):
+        seen += count
+
+        if seen >= rank:
+            return bound
+
+    return float('inf')
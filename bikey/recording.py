@@ -0,0 +1,467 @@
+import gym
+import json
+import numpy as np
+import os
+
+# Recording of the transitions of an environment, for offline reinforcement
+# learning and debugging.
+#
+# A recording is a directory of chunks. Every chunk is a directory holding one
+# .npy file per column, and every file is preallocated for chunk_size steps
+# and written through a memory map, so recording a step is little more than
+# copying a few arrays. The columns are
+#
+#   observations        the observation in which the action was taken
+#   actions             the action
+#   rewards             the reward
+#   next_observations   the observation that followed the action
+#   dones               whether the episode ended with this step
+#
+# The file index.json holds the number of steps in every chunk, the shapes and
+# dtypes of the columns (and the size of Discrete spaces), and the episodes:
+# the step at which each of them starts, its length, and the
+# episode_end_reason of its last step (None if it was cut short by a reset or
+# by closing the recorder). Steps are numbered over all chunks. The index is
+# written whenever a chunk is full or an episode ends, and when the recorder is
+# closed.
+#
+# TrajectoryReader opens the files of a recording as read-only memory maps,
+# so a recording can be much larger than the available memory. It can also
+# read logs that consist of plain arrays, see open_trajectories().
+
+INDEX_FILE = "index.json"
+COLUMNS = ("observations", "actions", "rewards", "next_observations", "dones")
+
+
+class TrajectoryRecorder(gym.Wrapper):
+    """
+    Records every transition of an environment, see the notes at the top of
+    bikey.recording.
+
+    The wrapper itself behaves exactly like the environment it wraps. Steps
+    that return None (e.g. SpacarEnv.step() after the end of an episode) are
+    not recorded.
+    """
+
+    def __init__(self, env, directory=None, chunk_size=4096):
+        """
+        Arguments:
+        env -- The environment to record, its observation and action spaces
+            should be gym.spaces.Box or gym.spaces.Discrete.
+        directory -- The directory of the recording. By default this is the
+            directory 'trajectories' in the working_dir of the environment, or
+            in the current directory if the environment has none. If the
+            directory already holds a recording, the new steps are appended.
+        chunk_size -- The number of steps in one chunk.
+        """
+        super().__init__(env)
+
+        if directory is None:
+            working_dir = getattr(env.unwrapped, "working_dir", os.getcwd())
+            directory = os.path.join(working_dir, "trajectories")
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+        self.columns = {
+            "observations": _column(env.observation_space),
+            "actions": _column(env.action_space),
+            "rewards": {"shape": [], "dtype": "float64"},
+            "next_observations": _column(env.observation_space),
+            "dones": {"shape": [], "dtype": "bool"},
+        }
+
+        index_path = os.path.join(directory, INDEX_FILE)
+
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                self.index = json.load(file)
+
+            if self.index["columns"] != self.columns:
+                raise ValueError(f"The recording in {directory} has "
+                                 f"different columns than the environment")
+        else:
+            self.index = {"chunk_size": chunk_size, "columns": self.columns,
+                          "chunks": [], "episodes": []}
+
+        self.steps = sum(self.index["chunks"])  # the number of recorded steps
+        self.chunk = None  # the memory maps of the chunk being filled
+        self.row = 0  # the next row of the chunk
+
+        self.observation = None  # the observation the next action is taken in
+        self.episode_start = None  # the first step of the current episode
+
+    def reset(self, **kwargs):
+        observation = self.env.reset(**kwargs)
+
+        # the previous episode did not end by itself
+        self._end_episode(None)
+
+        self.observation = observation
+        self.episode_start = self.steps
+
+        return observation
+
+    def step(self, action):
+        result = self.env.step(action)
+
+        if result is None or self.observation is None:
+            return result
+
+        observation, reward, done, info = result
+
+        if self.chunk is None:
+            self._open_chunk()
+
+        row = self.row
+        self.chunk["observations"][row] = self.observation
+        self.chunk["actions"][row] = action
+        self.chunk["rewards"][row] = reward
+        self.chunk["next_observations"][row] = observation
+        self.chunk["dones"][row] = done
+
+        self.row += 1
+        self.steps += 1
+        self.index["chunks"][-1] = self.row
+        self.observation = observation
+
+        if done:
+            reason = info.get("episode_end_reason") \
+                if isinstance(info, dict) else None
+            self._end_episode(reason)
+            self.observation = None
+
+        if self.row == self.chunk_size:
+            self._close_chunk()
+
+        return result
+
+    def close(self):
+        self._end_episode(None)
+        self._close_chunk()
+
+        return self.env.close()
+
+    def _open_chunk(self):
+        """
+        Preallocates the files of a new chunk.
+        """
+        path = _chunk_path(self.directory, len(self.index["chunks"]))
+        os.makedirs(path, exist_ok=True)
+
+        self.chunk = {
+            name: np.lib.format.open_memmap(
+                os.path.join(path, name + ".npy"), mode="w+",
+                dtype=column["dtype"],
+                shape=(self.chunk_size, *column["shape"]))
+            for name, column in self.columns.items()
+        }
+        self.row = 0
+        self.index["chunks"].append(0)
+
+    def _close_chunk(self):
+        """
+        Writes the chunk being filled to disk, the next step starts a new one.
+        """
+        if self.chunk is None:
+            return
+
+        for array in self.chunk.values():
+            array.flush()
+
+        self.chunk = None
+        self._write_index()
+
+    def _end_episode(self, reason):
+        """
+        Adds the current episode to the index, if it has any steps.
+        """
+        if self.episode_start is None:
+            return
+
+        length = self.steps - self.episode_start
+
+        if length > 0:
+            self.index["episodes"].append([self.episode_start, length,
+                                           reason])
+            self._write_index()
+
+        self.episode_start = None
+
+    def _write_index(self):
+        if self.chunk is not None:
+            # steps that are in the index should be on disk
+            for array in self.chunk.values():
+                array.flush()
+
+        path = os.path.join(self.directory, INDEX_FILE)
+
+        # readers never see a half written index
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.index, file)
+        os.replace(path + ".tmp", path)
+
+
+class TrajectoryReader:
+    """
+    Reads a recording made by a TrajectoryRecorder.
+
+    Nothing is loaded into memory until it is used: the files are opened as
+    read-only memory maps, and the arrays of an episode are views on these
+    (unless the episode spans two or more chunks).
+    """
+
+    def __init__(self, directory, index=None):
+        """
+        Arguments:
+        directory -- The directory of the recording.
+        index -- The index of the recording. By default it is read from the
+            directory.
+        """
+        self.directory = directory
+
+        if index is None:
+            with open(os.path.join(directory, INDEX_FILE)) as file:
+                index = json.load(file)
+
+        self.index = index
+        self.columns = self.index["columns"]
+        self.chunk_size = self.index["chunk_size"]
+
+        # the first step of every chunk
+        self.offsets = np.cumsum([0] + self.index["chunks"][:-1])
+        self.episode_list = self.index["episodes"]
+
+        self.chunks = {}  # the memory maps of the chunks opened so far
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Reads a log that consists of one array per column, e.g. memory maps of
+        .npy files.
+
+        The arrays hold one step per row, and should at least include
+        observations, actions, rewards and dones (see COLUMNS). The episodes
+        follow from the dones, steps after the last done form an episode that
+        did not end. Logs have no episode end reasons.
+
+        Arguments:
+        arrays -- A dictionary mapping the names of columns to arrays.
+
+        Returns:
+        A TrajectoryReader.
+        """
+        missing = [name for name in ("observations", "actions", "rewards",
+                                     "dones") if name not in arrays]
+        if missing:
+            raise ValueError(f"The log has no {', '.join(missing)}")
+
+        length = len(arrays["dones"])
+        if any(len(array) != length for array in arrays.values()):
+            raise ValueError("The columns of the log differ in length")
+
+        ends = np.flatnonzero(arrays["dones"]) + 1
+        if length and (len(ends) == 0 or ends[-1] != length):
+            ends = np.append(ends, length)
+        starts = np.concatenate(([0], ends[:-1]))
+
+        index = {
+            "chunk_size": length,
+            "columns": {name: {"shape": list(array.shape[1:]),
+                               "dtype": array.dtype.name}
+                        for name, array in arrays.items()},
+            "chunks": [length],
+            "episodes": [[int(start), int(end - start), None]
+                         for start, end in zip(starts, ends)],
+        }
+
+        reader = cls(None, index)
+        reader.chunks[0] = dict(arrays)
+
+        return reader
+
+    def __len__(self):
+        """
+        Returns the number of recorded steps.
+        """
+        return sum(self.index["chunks"])
+
+    @property
+    def num_episodes(self):
+        return len(self.episode_list)
+
+    def episode(self, number):
+        """
+        Returns a recorded episode.
+
+        Arguments:
+        number -- The number of the episode, in the order of recording.
+
+        Returns:
+        A dictionary with an array for every column, and the
+        episode_end_reason of the episode.
+        """
+        start, length, reason = self.episode_list[number]
+
+        episode = self.steps(start, start + length)
+        episode["episode_end_reason"] = reason
+
+        return episode
+
+    def episodes(self):
+        """
+        Yields all episodes one by one, see episode().
+        """
+        for number in range(self.num_episodes):
+            yield self.episode(number)
+
+    def steps(self, start, stop):
+        """
+        Returns the columns of a range of steps.
+
+        Arguments:
+        start -- The first step
+        stop -- The step after the last one
+
+        Returns:
+        A dictionary mapping the names of the columns to arrays.
+        """
+        parts = {name: [] for name in self.columns}
+
+        for number, length in enumerate(self.index["chunks"]):
+            offset = self.offsets[number]
+            begin = max(start - offset, 0)
+            end = min(stop - offset, length)
+
+            if begin >= end:
+                continue
+
+            chunk = self.chunk(number)
+            for name in self.columns:
+                parts[name].append(chunk[name][begin:end])
+
+        return {name: arrays[0] if len(arrays) == 1 else
+                _concatenate(arrays, self.columns[name])
+                for name, arrays in parts.items()}
+
+    def batches(self, batch_size, columns=None, shuffle=False, seed=None,
+                drop_last=False):
+        """
+        Yields all steps in batches, e.g. for offline training.
+
+        Batches are read from the memory maps as they are needed. In order,
+        a batch within one chunk is a view on the files. Shuffled batches
+        read their steps in the order in which they are stored, which keeps
+        reading from disk fast.
+
+        Arguments:
+        batch_size -- The number of steps in a batch
+        columns -- The names of the columns in the batches, all by default
+        shuffle -- Whether to yield the steps in a random order
+        seed -- The seed used to shuffle the steps
+        drop_last -- Whether to leave out a final batch that is not full
+
+        Returns:
+        A generator of dictionaries mapping the names of the columns to
+        arrays.
+        """
+        columns = list(self.columns) if columns is None else columns
+        length = len(self)
+
+        if drop_last:
+            length -= length % batch_size
+
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(len(self))
+
+        for start in range(0, length, batch_size):
+            stop = min(start + batch_size, length)
+
+            if not shuffle:
+                batch = self.steps(start, stop)
+                yield {name: batch[name] for name in columns}
+                continue
+
+            indices = np.sort(order[start:stop])
+
+            # the chunk of every step
+            chunks = np.searchsorted(self.offsets, indices, side="right") - 1
+            parts = {name: [] for name in columns}
+
+            for number in np.unique(chunks):
+                rows = indices[chunks == number] - self.offsets[number]
+                chunk = self.chunk(number)
+
+                for name in columns:
+                    parts[name].append(chunk[name][rows])
+
+            yield {name: _concatenate(parts[name], self.columns[name])
+                   for name in columns}
+
+    def chunk(self, number):
+        """
+        Returns the memory maps of a chunk, cut off after its last step.
+        """
+        if number not in self.chunks:
+            path = _chunk_path(self.directory, number)
+            length = self.index["chunks"][number]
+
+            self.chunks[number] = {
+                name: np.load(os.path.join(path, name + ".npy"),
+                              mmap_mode="r")[:length]
+                for name in self.columns
+            }
+
+        return self.chunks[number]
+
+
+def open_trajectories(path):
+    """
+    Opens a recording or a log of trajectories.
+
+    Arguments:
+    path -- The directory of a recording made by a TrajectoryRecorder, a
+        directory holding one .npy file per column (e.g. observations.npy),
+        or an .npz file with one array per column. .npy files are opened as
+        memory maps, the arrays of an .npz file are read when opened.
+
+    Returns:
+    A TrajectoryReader.
+    """
+    if os.path.isfile(os.path.join(path, INDEX_FILE)):
+        return TrajectoryReader(path)
+
+    if os.path.isdir(path):
+        arrays = {name[:-len(".npy")]:
+                  np.load(os.path.join(path, name), mmap_mode="r")
+                  for name in os.listdir(path) if name.endswith(".npy")}
+    else:
+        with np.load(path) as file:
+            arrays = dict(file)
+
+    return TrajectoryReader.from_arrays(arrays)
+
+
+def _column(space):
+    """
+    Returns the shape and dtype of the values of a space. A Discrete space
+    also keeps its number of values and its first value, so it can be rebuilt.
+    """
+    if isinstance(space, gym.spaces.Discrete):
+        return {"shape": [], "dtype": "int64", "n": int(space.n),
+                "start": int(space.start)}
+
+    return {"shape": list(space.shape), "dtype": np.dtype(space.dtype).name}
+
+
+def _chunk_path(directory, number):
+    return os.path.join(directory, f"chunk_{number:06d}")
+
+
+def _concatenate(arrays, column):
+    if not arrays:
+        return np.empty((0, *column["shape"]), dtype=column["dtype"])
+
+    return np.concatenate(arrays)
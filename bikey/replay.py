@@ -0,0 +1,171 @@
+import gym
+import numpy as np
+
+from bikey.recording import TrajectoryReader, open_trajectories
+
+# Serves recorded trajectories through the gym.Env API, without Matlab.
+#
+# Every episode of a ReplayEnv is an episode of the recording or log: reset()
+# returns its first observation, and every step returns the next recorded
+# observation, reward and done, whatever the action. This makes it possible to
+# benchmark training pipelines and the networking code at the speed of the
+# disk, and to evaluate policies on recorded data. Because the data comes from
+# memory maps, the recording can be larger than the available memory.
+#
+# Like any other gym environment, a ReplayEnv can be used through a NetworkEnv:
+#
+#   env = NetworkEnv('127.0.0.1', 65432, 'ReplayEnv-v0',
+#                    path='path/to/trajectories')
+
+
+class ReplayEnv(gym.Env):
+    def __init__(self, path=None, trajectories=None, shuffle=False, seed=None,
+                 observation_space=None, action_space=None,
+                 logged_actions=False):
+        """
+        An environment that replays recorded episodes.
+
+        Arguments:
+        path -- The recording or log to replay, see
+            bikey.recording.open_trajectories(). This is the option to use
+            through a NetworkEnv.
+        trajectories -- A TrajectoryReader, or a dictionary of arrays (see
+            TrajectoryReader.from_arrays()), used when no path is given.
+        shuffle -- Whether to replay the episodes in a random order. By
+            default they are replayed in the order of recording. After the
+            last episode the replay starts over.
+        seed -- The seed used to shuffle the episodes.
+        observation_space -- The observation space. By default it is rebuilt
+            from the recording: a gym.spaces.Discrete if a Discrete space was
+            recorded, otherwise an unbounded gym.spaces.Box shaped like the
+            recorded observations. Logs of plain arrays do not know about
+            Discrete spaces, their integer columns also become Boxes, so pass
+            the space to use instead.
+        action_space -- The action space, rebuilt from the recorded actions in
+            the same way by default.
+        logged_actions -- If True, the info of every step holds the recorded
+            action in 'logged_action', as a list, e.g. to compare a policy
+            with the one that was recorded.
+        """
+        super().__init__()
+
+        if path is not None:
+            trajectories = open_trajectories(path)
+        elif isinstance(trajectories, dict):
+            trajectories = TrajectoryReader.from_arrays(trajectories)
+        elif trajectories is None:
+            raise ValueError("ReplayEnv needs a path or trajectories")
+
+        if trajectories.num_episodes == 0:
+            raise ValueError("There are no episodes to replay")
+
+        self.trajectories = trajectories
+        columns = trajectories.columns
+
+        self.observation_space = observation_space or \
+            _space(columns["observations"])
+        self.action_space = action_space or _space(columns["actions"])
+
+        self.shuffle = shuffle
+        self.random = np.random.default_rng(seed)
+        self.logged_actions = logged_actions
+
+        self.order = []  # the episodes that are still to be replayed
+        self.episode = None  # the columns of the current episode
+        self.reason = None  # the episode end reason of the current episode
+        self.length = 0
+        self.steps = 0
+        self.done = False
+
+    def step(self, actions):
+        """
+        Returns the next recorded step. The action is ignored.
+
+        Returns:
+        The same tuple as BicycleEnv.step(), or None if the episode is done.
+        """
+        if self.episode is None or self.done:
+            return None
+
+        step = self.steps
+        self.steps += 1
+
+        episode = self.episode
+        observations = self._observation(self._next_observation(step))
+        reward = float(episode["rewards"][step])
+        info = {}
+
+        if self.logged_actions:
+            info["logged_action"] = np.asarray(
+                episode["actions"][step]).tolist()
+
+        if self.steps == self.length:
+            # the last step of the episode, even if the recording was cut short
+            self.done = True
+            eer = "episode_end_reason"
+
+            if self.reason is not None:
+                info[eer] = self.reason
+            elif not episode["dones"][step]:
+                info[eer] = "end_of_log"
+
+        return observations, reward, self.done, info
+
+    def reset(self):
+        """
+        Starts replaying the next episode, and returns its first observation.
+        """
+        if not self.order:
+            self.order = list(range(self.trajectories.num_episodes))
+
+            if self.shuffle:
+                self.random.shuffle(self.order)
+
+            # the episodes are popped from the end
+            self.order.reverse()
+
+        number = self.order.pop()
+        self.episode = self.trajectories.episode(number)
+        self.reason = self.episode["episode_end_reason"]
+        self.length = len(self.episode["dones"])
+        self.steps = 0
+        self.done = False
+
+        return self._observation(self.episode["observations"][0])
+
+    def _observation(self, value):
+        # a copy, the recording itself is read-only
+        if isinstance(self.observation_space, gym.spaces.Discrete):
+            return int(value)
+
+        return np.array(value)
+
+    def _next_observation(self, step):
+        episode = self.episode
+
+        if "next_observations" in episode:
+            return episode["next_observations"][step]
+
+        # a plain log, the next observation is the one the next action was
+        # taken in. The last observation of an episode was never logged
+        if step + 1 < self.length:
+            return episode["observations"][step + 1]
+
+        return episode["observations"][step]
+
+
+def _space(column):
+    """
+    Rebuilds the space of a recorded column, see bikey.recording._column().
+    """
+    if "n" in column:
+        return gym.spaces.Discrete(column["n"], start=column.get("start", 0))
+
+    return gym.spaces.Box(-np.inf, np.inf, shape=tuple(column["shape"]),
+                          dtype=column["dtype"])
+
+
+gym.envs.register(
+    id="ReplayEnv-v0",
+    entry_point="bikey.replay:ReplayEnv"
+)
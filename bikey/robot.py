@@ -0,0 +1,107 @@
+import gym
+from math import inf, pi
+import numpy as np
+
+# Properties of the bicycle robot that are shared by all bicycle environments,
+# regardless of how the bicycle is simulated. This module does not depend on
+# Matlab.
+
+# Properties of the motors/servos used in the bicycle robot, torques in
+# Newton-meters
+
+maxonEC90 = {
+    "stall_torque": 4.940,
+    "nominal_torque": 0.44,
+    "limited_torque": 0.4
+}
+
+maxonF2140 = {
+    "stall_torque": 0.031,
+    "nominal_torque": 0.012,
+    "limited_torque": 0.01
+}
+
+transmission_ratios = {
+    "steering": 1,
+    "body_leaning": 30,
+    "propulsion": 1
+}
+
+# limits / at what point should the episode terminate?
+deg_to_rad = 2 * pi / 360
+leaning_limit = 20 * deg_to_rad  # leaning angle of bicycle
+steering_limit = 40 * deg_to_rad  # steering angle
+ub_leaning_limit = 20 * deg_to_rad  # leaning angle of upper body
+
+limits = np.array([steering_limit, leaning_limit, ub_leaning_limit])
+
+
+def torque_limits():
+    """
+    Returns the maximum torques of the steering, body leaning and propulsion
+    motors, in the order in which they appear in the actions.
+    """
+    torque_limit_propulsion = \
+        maxonEC90["limited_torque"] * transmission_ratios["propulsion"]
+    torque_limit_steering = \
+        maxonEC90["limited_torque"] * transmission_ratios["steering"]
+    torque_limit_leaning = \
+        maxonF2140["limited_torque"] * transmission_ratios["body_leaning"]
+
+    return np.array([
+        torque_limit_steering,
+        torque_limit_leaning,
+        torque_limit_propulsion],
+        dtype=np.float32) / 5
+
+
+def action_space():
+    """
+    Returns the action space of the bicycle: the torques applied by the
+    steering, body leaning and propulsion motors.
+    """
+    limits = torque_limits()
+
+    return gym.spaces.Box(
+        low=-limits,
+        high=limits,
+        shape=(3,),
+        dtype=np.float32)
+
+
+def observation_space():
+    """
+    Returns the observation space of the bicycle.
+
+    The observations are the propulsion (rear wheel) angle, steering angle,
+    leaning angle of the bicycle, leaning angle of the upper body, and the x
+    and y coordinates of the bicycle.
+    """
+    infinity = np.array([inf, inf, inf, inf, inf, inf],
+                        dtype=np.float32)
+
+    # TODO: give a better description of the observations?
+    return gym.spaces.Box(
+        low=-infinity,
+        high=infinity,
+        shape=(6,),
+        dtype=np.float32)
+
+
+def exceeds_limits(observations, limits=limits):
+    """
+    Determines whether the bicycle has strayed too far from a normal upright
+    configuration.
+
+    Arguments:
+    observations -- One observation, or an array of observations with one
+        observation in every row.
+    limits -- The largest allowed steering, leaning and upper body leaning
+        angles.
+
+    Returns:
+    A boolean, or an array of booleans with one for every row.
+    """
+    angles = np.abs(observations[..., 1:4])
+
+    return np.any(angles > limits, axis=-1)
@@ -5,6 +5,7 @@ import gym
 import bikey.utils
 import numpy as np
 import os
+import time
 
 # The ssl library only needs to be imported on linux. Apparently the system's
 # 'libssl.so' and the one shipped with matlab clash. By loading the system's
@@ -16,6 +17,14 @@ import os
 
 # TODO: update all documentation after refactoring
 
+# with native arrays the actions block reads its value from this variable in
+# Matlab's base workspace
+_actions_variable = "bikey_actions"
+
+# Matlab without its desktop and splash screen. Note that -nojvm cannot be used
+# as well, Simulink does not run without Matlab's Java virtual machine.
+_headless_matlab_params = "-nodesktop -nosplash"
+
 # only settings supported by SpacarEnv.change_settings will have an effect
 _default_sim_config = {
     "initial_action": np.zeros((3,)),
@@ -29,7 +38,9 @@ class SpacarEnv(gym.Env):
     def __init__(self, simulink_file, working_dir=os.getcwd(), template_dir=
                  None, copy_simulink=False, copy_spacar=False,
                  simulink_config=_default_sim_config, matlab_params=
-                 '-desktop'):
+                 None, matlab_session=None, engine_pool=None,
+                 fused_step=False, native_arrays=False, action_repeat=1,
+                 warm_reset=False, headless=False):
         """
         This environment wraps a general physics simulation running in Spacar.
 
@@ -51,7 +62,45 @@ class SpacarEnv(gym.Env):
         template directory, this is done in the same way as copy_simulink.
 
         Finally, some parameters can be passed to Matlab at startup with
-        matlab_params.
+        matlab_params. Instead of starting a new Matlab session, an existing
+        one can be provided through matlab_session. That session is not shut
+        down when the environment is closed, its workspace is cleared instead.
+        Similarly, a session can be borrowed from a bikey.engine_pool.EnginePool
+        shared by many environments. It is handed back when the environment
+        is closed.
+
+        Every call to the Matlab engine crosses a process boundary. With
+        fused_step, a step is performed by a single call to the bikey_step
+        Matlab function from the template directory, instead of a separate
+        call for every action update, command and status check. The number of
+        engine calls is counted in engine_calls, and step_engine_calls holds
+        the number of calls made by the last step.
+
+        By default actions are sent to Simulink as text, which Simulink parses
+        again, and observations come back as nested lists. With native_arrays
+        the actions are written to the Matlab workspace as a matlab.double,
+        and the observations are converted from the returned Matlab array
+        directly. This only pays off together with fused_step: without it,
+        writing the actions to the workspace and telling Simulink to read them
+        again takes one more engine call per step than sending them as text.
+
+        With action_repeat, every call to step() advances the simulation by
+        that many Simulink steps using the same actions. The steps are taken
+        by the bikey_step Matlab function without returning to Python in
+        between, so this implies fused_step. The observations of all
+        intermediate steps are processed by process_step(): their rewards are
+        summed, and the episode ends at the first step at which it is done.
+
+        By default every reset closes the Simulink model and opens it again,
+        which takes up most of the time of short episodes. With warm_reset the
+        model stays loaded: the simulation is stopped and started again from
+        its initial state, and only the settings in simulink_config that
+        changed since they were last applied are written to the model again.
+
+        Environments on compute nodes have no use for any graphical interface.
+        With headless, Matlab is started without its desktop, the model is
+        loaded with load_system instead of being opened in the Simulink editor,
+        and spadraw is turned off regardless of simulink_config.
 
         # TODO a quick overview of how the synchronization works would be nice
 
@@ -68,7 +117,20 @@ class SpacarEnv(gym.Env):
             directory into the working directory.
         simulink_config -- The specific configuration applied to the
             simulink_file by SpacarEnv.change_settings().
-        matlab_params -- Parameters passed to Matlab at startup.
+        matlab_params -- Parameters passed to Matlab at startup. By default
+            '-desktop', or '-nodesktop -nosplash' if headless is True.
+        matlab_session -- An already running Matlab session that is used
+            instead of starting a new one, or None.
+        engine_pool -- An EnginePool from which a Matlab session is leased
+            instead of starting a new one, or None.
+        fused_step -- If True, every step is performed with a single call to
+            the Matlab engine.
+        native_arrays -- If True, actions and observations are passed as
+            Matlab arrays instead of text. Use it together with fused_step.
+        action_repeat -- The number of Simulink steps for which every action
+            is applied.
+        warm_reset -- If True, reset() keeps the Simulink model loaded.
+        headless -- If True, no graphical interfaces are used.
         """
 
         super().__init__()
@@ -76,10 +138,27 @@ class SpacarEnv(gym.Env):
         # TODO: check whether specified .slx and .dat files exist
         # TODO: catch all potential errors caused by simulink simulation not
         # yet being available
-        # TODO: having a matlab session for every environment may not be
-        # efficient
+        self.engine_pool = engine_pool
+        self.headless = headless
+
+        if matlab_params is None:
+            matlab_params = _headless_matlab_params if headless \
+                else '-desktop'
+
+        if engine_pool is not None:
+            session = engine_pool.lease(working_dir)
+            self.owns_session = False
+        elif matlab_session is None:
+            session = matlab.engine.start_matlab(matlab_params)
+            self.owns_session = True
+        else:
+            # somebody else started this session, and will also shut it down
+            session = matlab_session
+            self.owns_session = False
 
-        self.session = matlab.engine.start_matlab(matlab_params)
+        # all calls to matlab go through this wrapper, so they can be counted
+        self.session = CountingSession(session)
+        self.step_engine_calls = 0
 
         # sets the working directory, allows matlab to find correct files
         self.session.cd(working_dir)
@@ -92,6 +171,14 @@ class SpacarEnv(gym.Env):
             # set the template directory
             bikey.utils.set_template_dir(template_dir)
 
+        self.action_repeat = action_repeat
+        self.fused_step = fused_step or action_repeat > 1
+        self.native_arrays = native_arrays
+
+        if self.fused_step:
+            # allow matlab to find the bikey_step function
+            self.session.addpath(bikey.utils.find_template_dir(), nargout=0)
+
         if copy_simulink:
             # copy a simulink model template
             bikey.utils.copy_from_template_dir(simulink_file, working_dir)
@@ -104,8 +191,16 @@ class SpacarEnv(gym.Env):
         self.simulink_loaded = False
         self.model_name = simulink_file[:-4]  # remove the .slx extension
 
+        self.warm_reset = warm_reset
+        # the settings that have been applied to the loaded model
+        self.applied_config = {}
+
         config = _default_sim_config.copy()
         config.update(simulink_config)
+
+        if headless:
+            config["use_spadraw"] = False
+
         self.simulink_config = config
 
         # if simulink_loaded is True, done indicates the end of the episode
@@ -131,7 +226,15 @@ class SpacarEnv(gym.Env):
         if not self.simulink_loaded or self.done:
             return None  # TODO: throw an error instead of returning None
 
-        if self.get_sim_status() == 'paused':
+        calls_before = self.session.calls
+
+        if self.fused_step:
+            stepped, observation_block, status = self.fused_update(actions)
+
+            if not stepped:
+                return None
+
+        elif self.get_sim_status() == 'paused':
             # TODO: add safeguards that prevent updating action inputs before
             # they are required.
             # TODO: Also check whether 'paused' is the only acceptable
@@ -142,26 +245,38 @@ class SpacarEnv(gym.Env):
             # TODO make sure the simulation is paused/stopped/whatever before
             # reading out the new observations
             observations = self.get_observations()
+            observation_block = None if observations is None \
+                else observations[np.newaxis]
+            status = None  # requested after processing the observations
+
+        else:
+            return None
 
-            # subclasses can easily implement their own behaviour here
-            reward, done, info = self.process_step(observations)
-            eer = "episode_end_reason"
+        # subclasses can easily implement their own behaviour here
+        observations, reward, done, info = \
+            self.process_block(observation_block)
+        eer = "episode_end_reason"
 
-            if self.get_sim_status() == 'stopped':
-                info[eer] = "end_of_sim"
-                self.done = True
+        if status is None:
+            status = self.get_sim_status()
 
-            # allow subclasses to implement their own logic here
-            if done:
-                if eer in info:
-                    info[eer] += "/end_of_epi"
-                else:
-                    info[eer] = "end_of_epi"
+        if status == 'stopped':
+            info[eer] = "end_of_sim"
+            self.done = True
 
-                self.done = True
-                self.send_sim_command('stop')
+        # allow subclasses to implement their own logic here
+        if done:
+            if eer in info:
+                info[eer] += "/end_of_epi"
+            else:
+                info[eer] = "end_of_epi"
 
-            return observations, reward, self.done, info
+            self.done = True
+            self.send_sim_command('stop')
+
+        self.step_engine_calls = self.session.calls - calls_before
+
+        return observations, reward, self.done, info
 
     def reset(self):
         """
@@ -171,16 +286,24 @@ class SpacarEnv(gym.Env):
         Returns:
         Initial observations of the system, as defined by get_observations().
         """
-        # Gracefully shutdown Simulink and clear the observations stored in the
-        # workspace
-        if self.simulink_loaded:
-            self.close_simulink()
+        if self.simulink_loaded and self.warm_reset:
+            # keep the model loaded, only the simulation itself is restarted
+            self.rewind_simulink()
+
+        else:
+            # Gracefully shutdown Simulink and clear the observations stored in
+            # the workspace
+            if self.simulink_loaded:
+                self.close_simulink()
+
+            if self.headless:
+                # load the simulink model without opening the editor
+                self.session.load_system(self.model_name, nargout=0)
+            else:
+                # open the simulink model
+                self.session.open_system(self.model_name, nargout=0)
 
-        # TODO: make simulink GUI an option of the environment
-        # open the simulink model
-        self.session.open_system(self.model_name, nargout=0)
-        # self.sym_handle = self.session.load_system(self.model_name) # no GUI
-        self.simulink_loaded = True
+            self.simulink_loaded = True
 
         self.done = False
 
@@ -196,15 +319,29 @@ class SpacarEnv(gym.Env):
         """
         Makes requested changes to the opened Simulink file.
 
+        Settings that have already been applied to the loaded model, and have
+        not changed since, are skipped.
+
         Requires the Simulink file to be loaded.
         """
-        conf = self.simulink_config
+        conf = {key: value for key, value in self.simulink_config.items()
+                if key not in self.applied_config
+                or not _same_setting(self.applied_config[key], value)}
 
         if "initial_action" in conf:
             # set the action that is performed once when the env is reset
-            str_repr = str(conf["initial_action"].flatten())
-            self.session.set_param(
-                f"{self.model_name}/actions", 'value', str_repr, nargout=0)
+            if self.native_arrays:
+                # the actions block reads the actions from the workspace
+                self.session.assignin(
+                    'base', _actions_variable,
+                    to_matlab_array(conf["initial_action"]), nargout=0)
+                self.session.set_param(
+                    f"{self.model_name}/actions", 'value', _actions_variable,
+                    nargout=0)
+            else:
+                str_repr = str(conf["initial_action"].flatten())
+                self.session.set_param(
+                    f"{self.model_name}/actions", 'value', str_repr, nargout=0)
 
         if "spacar_file" in conf:
             # point spacar towards the correct model definition
@@ -230,15 +367,29 @@ class SpacarEnv(gym.Env):
                 f"{self.model_name}/spacar", "use_spadraw",
                 convert(use_spadraw), nargout=0)
 
+        # store copies, so changes made to arrays in place are detected
+        self.applied_config.update(
+            (key, np.copy(value) if isinstance(value, np.ndarray) else value)
+            for key, value in conf.items())
+
     def close(self):
         """
         Shutdown Simulink and Matlab.
+
+        If the Matlab session was provided by the caller it is not shut down,
+        only its workspace is cleared so it can be used again. A session leased
+        from an engine pool is handed back to the pool.
         """
         if self.simulink_loaded:
             self.close_simulink()
 
-        # close matlab
-        self.session.quit()
+        if self.engine_pool is not None:
+            self.engine_pool.release(self.session.engine)
+        elif self.owns_session:
+            # close matlab
+            self.session.quit()
+        else:
+            self.session.eval('clear', nargout=0)
 
     def close_simulink(self):
         """
@@ -252,7 +403,13 @@ class SpacarEnv(gym.Env):
         self.send_sim_command('stop')
 
         # close simulink and do not save changes
-        self.session.eval(f"close_system(bdroot, 0)", nargout=0)
+        if self.headless:
+            # a model that was loaded without the editor is never the current
+            # system, so bdroot cannot be used to find it
+            self.session.eval(f"close_system('{self.model_name}', 0)",
+                              nargout=0)
+        else:
+            self.session.eval(f"close_system(bdroot, 0)", nargout=0)
         # TODO: figure out what is going on here:
         # can't use the command below since matlab seems to think 0 is a filenme
         # self.session.eval(f"close_system({self.model_name}, 0), nargout=0)
@@ -265,6 +422,39 @@ class SpacarEnv(gym.Env):
 
         # register simulink no longer being available
         self.simulink_loaded = False
+        self.applied_config = {}
+
+    def rewind_simulink(self):
+        """
+        Stop the Simulink simulation so it can be started from the beginning.
+
+        Unlike close_simulink() the model stays loaded. Stepping only changes
+        the actions and simulation_time_python blocks, so only those are
+        restored:
+        - simulation_time_python is set to '0' again, and
+        - the initial action is marked as not applied, so change_settings()
+          writes it to the actions block again.
+        The workspace variable 'out' is cleared as well. The other settings in
+        simulink_config are left as they are, change_settings() updates those
+        that changed.
+
+        Should only be called if env.simulink_loaded is True.
+        """
+        # the simulation starts from its initial state when started again
+        self.send_sim_command('stop')
+
+        # remove observations stored in the workspace (variable 'out')
+        self.session.clear('out', nargout=0)
+
+        # the check_simulation_time block pauses the simulation as soon as its
+        # time passes this value, which should count from zero again
+        self.session.set_param(
+            f'{self.model_name}/simulation_time_python', 'value', '0',
+            nargout=0)
+
+        # every step has overwritten the actions, so the initial action has to
+        # be applied again
+        self.applied_config.pop("initial_action", None)
 
     def update_matlab(self, actions):
         """
@@ -277,9 +467,15 @@ class SpacarEnv(gym.Env):
         Arguments:
         actions -- A numpy array with shape conforming to the action space.
         """
-        string_repr = str(actions.flatten())
-        self.session.set_param(
-            f'{self.model_name}/actions', 'value', string_repr, nargout=0)
+        if self.native_arrays:
+            self.session.assignin(
+                'base', _actions_variable, to_matlab_array(actions), nargout=0)
+            # let the actions block pick up the new value of the variable
+            self.send_sim_command('update')
+        else:
+            string_repr = str(actions.flatten())
+            self.session.set_param(
+                f'{self.model_name}/actions', 'value', string_repr, nargout=0)
 
         # TODO remove this part of the synchronization mechanism, seems
         # redundant
@@ -289,6 +485,87 @@ class SpacarEnv(gym.Env):
             f'{self.model_name}/simulation_time_python', 'value',
             str(simulation_time_matlab), nargout=0)
 
+    @property
+    def engine_calls(self):
+        """
+        The total number of calls made to the Matlab engine by this env.
+        """
+        return self.session.calls
+
+    def process_block(self, observation_block):
+        """
+        Processes the observations of one or more consecutive Simulink steps.
+
+        All rows are evaluated with process_steps(). The rewards are summed up
+        to and including the first row at which the episode is done, later rows
+        are ignored.
+
+        Arguments:
+        observation_block -- A numpy array with the observations of one
+            Simulink step in every row, or None if there are no observations.
+
+        Returns:
+        A tuple containing:
+        - The observations of the last processed row
+        - The summed reward
+        - Whether the episode is done
+        - The info of the last processed row
+        """
+        if observation_block is None:
+            reward, done, info = self.process_step(None)
+            return None, reward, done, info
+
+        rewards, dones, infos = self.process_steps(observation_block)
+
+        finished = np.flatnonzero(dones)
+        last = finished[0] if finished.size else len(observation_block) - 1
+
+        info = {} if infos is None else infos[last]
+
+        return observation_block[last], rewards[:last + 1].sum(), \
+            bool(dones[last]), info
+
+    def fused_update(self, actions):
+        """
+        Performs action_repeat steps of the simulation with one engine call.
+
+        Calls the bikey_step Matlab function, which updates the actions,
+        continues the simulation, waits until it has paused again and reads
+        out the observations, as many times as action_repeat.
+
+        Arguments:
+        actions -- A numpy array with shape conforming to the action space.
+
+        Returns:
+        A tuple containing:
+        - Whether a step was performed, i.e. the simulation was paused
+        - A numpy array with the observations after every Simulink step in its
+          rows, or None if there are no observations
+        - The status of the simulation after the last step, see
+          get_sim_status()
+        """
+        if self.native_arrays:
+            matlab_actions = to_matlab_array(actions)
+        else:
+            matlab_actions = str(actions.flatten())
+
+        stepped, observations, status, _ = self.session.bikey_step(
+            self.model_name, matlab_actions, float(self.action_repeat),
+            nargout=4)
+
+        if self.native_arrays:
+            observations = from_matlab_array(observations)
+        else:
+            observations = np.array(observations)
+
+        if observations.size == 0:
+            return stepped, None, status
+
+        # a single row may come back as a flat list
+        observations = observations.reshape(-1, observations.shape[-1])
+
+        return stepped, observations, status
+
     def send_sim_command(self, command):
         """
         Sends a command to the Simulink simulation, if it is loaded.
@@ -313,7 +590,12 @@ class SpacarEnv(gym.Env):
         or None if the simulation has not been started.
         """
         if self.session.exist('out'):
-            return np.array(self.session.eval('out.observations')).flatten()
+            observations = self.session.eval('out.observations')
+
+            if self.native_arrays:
+                return from_matlab_array(observations).flatten()
+            else:
+                return np.array(observations).flatten()
         else:
             return None
 
@@ -348,3 +630,112 @@ class SpacarEnv(gym.Env):
         done = False
         info = {}
         return reward, done, info
+
+    def process_steps(self, observation_batch):
+        """
+        Batched counterpart of process_step().
+
+        Evaluates the rules of the environment for many observations at once,
+        e.g. the Simulink steps taken during one step with action_repeat, or
+        recorded observations that are relabeled. By default process_step() is
+        called for every row, subclasses can override this with a vectorised
+        implementation.
+
+        Arguments:
+        observation_batch -- A numpy array with one observation in every row.
+
+        Returns:
+        A tuple containing:
+        - An array with the reward of every row
+        - An array of booleans, indicating for every row whether the episode
+          would be done
+        - A list with the info of every row, or None if there is no info
+        """
+        results = [self.process_step(observations)
+                   for observations in observation_batch]
+
+        rewards = np.array([reward for reward, _, _ in results], dtype=float)
+        dones = np.array([bool(done) for _, done, _ in results])
+        infos = [info for _, _, info in results]
+
+        return rewards, dones, infos
+
+
+def to_matlab_array(array):
+    """
+    Converts a numpy array to a Matlab row vector of doubles.
+
+    Arguments:
+    array -- A numpy array of any shape, it is flattened.
+
+    Returns:
+    A matlab.double with shape (1, array.size).
+    """
+    return matlab.double(np.asarray(array, dtype=float).flatten().tolist())
+
+
+def from_matlab_array(value):
+    """
+    Converts a Matlab array returned by the engine to a numpy array.
+
+    Only the public interface of matlab.double is used. Since R2022a it
+    supports the buffer protocol, so its memory is used without going through
+    the elements. Older versions are read through its sequence protocol, one
+    row at a time, which is slower.
+
+    Arguments:
+    value -- A matlab.double, or a float if Matlab returned a scalar.
+
+    Returns:
+    A numpy array with the same shape as the Matlab array.
+    """
+    return np.asarray(value, dtype=float)
+
+
+def _same_setting(old, new):
+    """
+    Returns whether two values of a simulink_config setting are equal.
+    """
+    if isinstance(old, np.ndarray) or isinstance(new, np.ndarray):
+        return np.array_equal(old, new)
+
+    return old == new
+
+
+class CountingSession:
+    """
+    Wraps a Matlab session and counts the calls made through it.
+
+    Every method call on the wrapper is passed on to the session, and counted
+    in calls. The number of calls and the time they took are also kept per
+    function in usage, which maps function names to [calls, seconds]. Other
+    attributes are passed on as they are.
+    """
+
+    def __init__(self, engine):
+        """
+        Arguments:
+        engine -- The Matlab session that is wrapped.
+        """
+        self.engine = engine
+        self.calls = 0
+        self.usage = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.engine, name)
+
+        if not callable(attribute):
+            return attribute
+
+        def counted_call(*args, **kwargs):
+            self.calls += 1
+            started = time.perf_counter()
+
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                usage = self.usage.setdefault(name, [0, 0.0])
+                usage[0] += 1
+                usage[1] += time.perf_counter() - started
+
+        return counted_call
@@ -0,0 +1,520 @@
+import gym
+from bikey import robot
+from gym.vector.utils import batch_space
+from math import atan, cos, sin
+import numpy as np
+
+# A surrogate for the Spacar simulation of the bicycle robot, written in numpy.
+#
+# The bicycle is modelled as a linearised Whipple bicycle (Meijaard et al.,
+# "Linearized dynamics equations for the balance and steer of a bicycle: a
+# benchmark and review", 2007) with an extra degree of freedom for the leaning
+# of the upper body of the rider. For a state q = [roll, steer, lean] the
+# equations of motion are
+#
+#   M q'' + (v C1 + D) q' + (g K0 + v^2 K2) q = [0, steer torque, lean torque]
+#
+# where v is the forward speed. The speed changes with the propulsion torque,
+# and the position of the rear wheel contact point follows from the speed and
+# heading. The model ignores everything the linearisation leaves out, so it is
+# only accurate for small angles, but it is orders of magnitude faster than
+# the real simulation.
+
+# the layout of a state vector
+ROLL, STEER, LEAN, ROLL_RATE, STEER_RATE, LEAN_RATE, WHEEL_RATE, X, Y, \
+    HEADING, WHEEL_ANGLE = range(11)
+STATE_DIM = 11
+
+# Physical parameters of the bicycle robot, taken from templates/bicycle.dat.
+# Following Meijaard et al. the z-axis points downwards, so heights are
+# negative. Lengths in meters, masses in kilograms, inertias in kg m^2.
+robot_parameters = {
+    "wheelbase": 0.2913,
+    "trail": 0.0232,
+    "steer_axis_tilt": atan(0.32),
+    # rear wheel
+    "rR": 0.1, "mR": 0.5122, "IRxx": 0.0017, "IRyy": 0.0033,
+    # rear frame
+    "xB": 0.066, "zB": -0.1538, "mB": 4.5897,
+    "IBxx": 0.0122, "IBxz": -0.0036, "IByy": 0.015, "IBzz": 0.0039,
+    # front fork and handlebars
+    "xH": 0.2561, "zH": -0.2395, "mH": 1.5349,
+    "IHxx": 0.0, "IHxz": 0.0, "IHzz": 0.0,
+    # front wheel
+    "rF": 0.1, "mF": 0.5122, "IFxx": 0.0017, "IFyy": 0.0033,
+    # upper body, leaning around a joint on the rear frame
+    "xU": 0.0857, "zJ": -0.2783, "hU": 0.101, "mU": 0.5,
+    "IUxx": 0.0281, "IUxz": 0.0118, "IUzz": 0.0343,
+    "dU": 1.0,  # damping of the leaning joint, in Nm s/rad
+}
+
+
+class BicycleModel:
+    """
+    The equations of motion of the bicycle, and their numerical integration.
+
+    All methods work on a single state vector as well as on an array of states
+    with one state in every row, so many bicycles can be simulated at once.
+    """
+
+    def __init__(self, parameters=robot_parameters, gravity=9.81):
+        """
+        Arguments:
+        parameters -- A dictionary of physical parameters, see
+            robot_parameters for the required entries.
+        gravity -- The gravitational acceleration.
+        """
+        p = parameters
+
+        self.gravity = gravity
+        self.wheelbase = p["wheelbase"]
+        self.trail = p["trail"]
+        self.cos_tilt = cos(p["steer_axis_tilt"])
+        self.rear_radius = p["rR"]
+
+        self.M, self.C1, self.K0, self.K2, self.D = _matrices(p)
+        self.M_inv = np.linalg.inv(self.M)
+
+        # the inertia felt by the propulsion motor on the rear wheel axle
+        total_mass = p["mR"] + p["mB"] + p["mH"] + p["mF"] + p["mU"]
+        self.wheel_inertia = total_mass * p["rR"] ** 2 + p["IRyy"] + \
+            p["IFyy"] * (p["rR"] / p["rF"]) ** 2
+
+    def initial_state(self, num_bicycles=None, speed=0.0):
+        """
+        Returns the state of an upright bicycle at the origin.
+
+        Arguments:
+        num_bicycles -- If not None, an array with this many states is returned.
+        speed -- The forward speed of the bicycle.
+        """
+        shape = (STATE_DIM,) if num_bicycles is None \
+            else (num_bicycles, STATE_DIM)
+
+        state = np.zeros(shape)
+        state[..., WHEEL_RATE] = speed / self.rear_radius
+
+        return state
+
+    def step(self, state, actions, dt):
+        """
+        Integrates the equations of motion over one time step, in place.
+
+        Uses the semi-implicit Euler method.
+
+        Arguments:
+        state -- A state vector, or an array of states. It is overwritten.
+        actions -- The steering, body leaning and propulsion torques, with the
+            same leading dimensions as state.
+        dt -- The time step.
+
+        Returns:
+        The updated state.
+        """
+        q = state[..., ROLL:LEAN + 1]
+        qd = state[..., ROLL_RATE:LEAN_RATE + 1]
+        v = state[..., WHEEL_RATE, np.newaxis] * self.rear_radius
+
+        forces = np.zeros(q.shape)
+        forces[..., 1:] = actions[..., :2]
+
+        forces -= v * (qd @ self.C1.T) + qd @ self.D.T
+        forces -= q @ (self.gravity * self.K0.T) + v ** 2 * (q @ self.K2.T)
+
+        qd += dt * (forces @ self.M_inv.T)
+        q += dt * qd
+
+        v = v[..., 0]
+        heading_rate = (v * state[..., STEER] +
+                        self.trail * state[..., STEER_RATE]) * \
+            self.cos_tilt / self.wheelbase
+
+        state[..., HEADING] += dt * heading_rate
+        state[..., X] += dt * v * np.cos(state[..., HEADING])
+        state[..., Y] += dt * v * np.sin(state[..., HEADING])
+        state[..., WHEEL_RATE] += dt * actions[..., 2] / self.wheel_inertia
+        state[..., WHEEL_ANGLE] += dt * state[..., WHEEL_RATE]
+
+        return state
+
+    def observe(self, state):
+        """
+        Returns the observations of the bicycle(s), in the same order as the
+        Spacar simulation: propulsion (the rotation angle of the rear wheel),
+        steering, leaning, upper body leaning, and the x and y coordinates of
+        the rear wheel contact point.
+        """
+        return state[..., [WHEEL_ANGLE, STEER, ROLL, LEAN, X, Y]]
+
+
+class SurrogateBicycleEnv(gym.Env):
+    def __init__(self, time_step=0.01, substeps=1, initial_speed=0.0,
+                 initial_noise=0.0, max_steps=None, parameters=
+                 robot_parameters, seed=None):
+        """
+        A drop-in replacement for BicycleEnv that does not need Matlab.
+
+        The action and observation spaces and the rules of the environment are
+        the same as those of BicycleEnv, but the bicycle is simulated by a
+        BicycleModel instead of Spacar. This is useful for cheap pre-training
+        and testing.
+
+        Arguments:
+        time_step -- The simulated time that passes during one step.
+        substeps -- The number of integration steps taken during one step.
+        initial_speed -- The forward speed of the bicycle when it is reset.
+        initial_noise -- The standard deviation of random perturbations of the
+            angles of the bicycle when it is reset.
+        max_steps -- If not None, episodes end after this many steps, like the
+            end of a Simulink simulation.
+        parameters -- The physical parameters of the bicycle, see
+            bikey.surrogate.robot_parameters.
+        seed -- The seed of the random number generator used by reset().
+        """
+        super().__init__()
+
+        self.action_space = robot.action_space()
+        self.observation_space = robot.observation_space()
+
+        self.model = BicycleModel(parameters)
+        self.time_step = time_step
+        self.substeps = substeps
+        self.initial_speed = initial_speed
+        self.initial_noise = initial_noise
+        self.max_steps = max_steps
+        self.random = np.random.default_rng(seed)
+
+        self.torque_limits = robot.torque_limits()
+        self.limits = robot.limits.copy()
+
+        self.state = None
+        self.steps = 0
+        self.done = False
+
+    def step(self, actions):
+        """
+        Performs one step of the simulation and returns output of this step.
+
+        Returns:
+        The same tuple as BicycleEnv.step(), or None if the episode is done.
+        """
+        if self.state is None or self.done:
+            return None
+
+        actions = np.clip(np.asarray(actions, dtype=float).flatten(),
+                          -self.torque_limits, self.torque_limits)
+        dt = self.time_step / self.substeps
+
+        for _ in range(self.substeps):
+            self.model.step(self.state, actions, dt)
+
+        self.steps += 1
+        observations = self.model.observe(self.state)
+
+        reward, done, info = self.process_step(observations)
+        eer = "episode_end_reason"
+
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            info[eer] = "end_of_sim"
+            self.done = True
+
+        if done:
+            if eer in info:
+                info[eer] += "/end_of_epi"
+            else:
+                info[eer] = "end_of_epi"
+
+            self.done = True
+
+        return observations, reward, self.done, info
+
+    def reset(self):
+        """
+        Puts the bicycle back at the origin and returns the initial
+        observations.
+        """
+        self.state = self.model.initial_state(speed=self.initial_speed)
+
+        if self.initial_noise:
+            self.state[ROLL:LEAN + 1] = self.random.normal(
+                scale=self.initial_noise, size=3)
+
+        self.steps = 0
+        self.done = False
+
+        return self.model.observe(self.state)
+
+    def process_step(self, observations):
+        """
+        Defines the rewards and episode termination rules, these are the same
+        as those of BicycleEnv.process_step().
+        """
+        reward = 1
+
+        done = robot.exceeds_limits(observations, self.limits)
+
+        info = {}
+
+        return reward, done, info
+
+    def process_steps(self, observation_batch):
+        """
+        Vectorised version of process_step(), see
+        bikey.spacar.SpacarEnv.process_steps().
+        """
+        rewards = np.ones(len(observation_batch))
+        dones = robot.exceeds_limits(observation_batch, self.limits)
+
+        return rewards, dones, None
+
+    def close(self):
+        pass
+
+
+class BicycleVecEnv(gym.Env):
+    """
+    Simulates many surrogate bicycles at once.
+
+    The states of all bicycles are kept in a single (num_envs, STATE_DIM)
+    array, which is integrated by one BicycleModel. Actions, observations,
+    rewards and dones are stacked along the first axis, like those of
+    bikey.network.network_env.VectorNetworkEnv, and there are no Python
+    objects per bicycle. This makes it possible to simulate hundreds of
+    thousands of steps per second on a single core.
+
+    Like gym's vector environments, a bicycle whose episode is done is reset
+    immediately. The observation returned by step() is then the first
+    observation of its new episode. The last observations of all bicycles
+    before any resets are in info['terminal_observation'].
+    """
+
+    def __init__(self, num_envs, time_step=0.01, substeps=1, initial_speed=
+                 0.0, initial_noise=0.0, max_steps=None, parameters=
+                 robot_parameters, seed=None):
+        """
+        Arguments:
+        num_envs -- The number of bicycles.
+        Other arguments are equal to those of SurrogateBicycleEnv, consult its
+            documentation instead.
+        """
+        super().__init__()
+
+        self.num_envs = num_envs
+
+        self.single_action_space = robot.action_space()
+        self.single_observation_space = robot.observation_space()
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_space = batch_space(
+            self.single_observation_space, num_envs)
+
+        self.model = BicycleModel(parameters)
+        self.time_step = time_step
+        self.substeps = substeps
+        self.initial_speed = initial_speed
+        self.initial_noise = initial_noise
+        self.max_steps = max_steps
+        self.random = np.random.default_rng(seed)
+
+        self.torque_limits = robot.torque_limits()
+        self.limits = robot.limits.copy()
+
+        self.state = self.model.initial_state(num_envs, initial_speed)
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+
+    def step(self, actions):
+        """
+        Performs one step of the simulation for all bicycles.
+
+        Arguments:
+        actions -- The stacked actions, with shape (num_envs, 3)
+
+        Returns:
+        A four tuple containing
+        - The stacked observations
+        - An array of rewards
+        - An array of booleans, indicating which episodes are done
+        - A dictionary with arrays of additional info: 'terminal_observation'
+          holds the observations before any resets, and 'end_of_sim'
+          indicates which episodes ended because max_steps was reached
+        """
+        actions = np.clip(
+            np.asarray(actions, dtype=float).reshape(self.num_envs, -1),
+            -self.torque_limits, self.torque_limits)
+        dt = self.time_step / self.substeps
+
+        for _ in range(self.substeps):
+            self.model.step(self.state, actions, dt)
+
+        self.steps += 1
+        observations = self.model.observe(self.state)
+
+        rewards, dones, _ = self.process_steps(observations)
+
+        if self.max_steps is not None:
+            end_of_sim = self.steps >= self.max_steps
+            dones |= end_of_sim
+        else:
+            end_of_sim = np.zeros(self.num_envs, dtype=bool)
+
+        info = {
+            "terminal_observation": observations,
+            "end_of_sim": end_of_sim
+        }
+
+        finished = np.flatnonzero(dones)
+
+        if finished.size:
+            self._reset_rows(finished)
+
+            # leave the terminal observations untouched
+            observations = observations.copy()
+            observations[finished] = self.model.observe(self.state[finished])
+
+        return observations, rewards, dones, info
+
+    def reset(self):
+        """
+        Resets all bicycles.
+
+        Returns:
+        The stacked initial observations, with shape (num_envs, 6).
+        """
+        self._reset_rows(slice(None))
+
+        return self.model.observe(self.state)
+
+    def process_steps(self, observations):
+        """
+        Defines the rewards and episode termination rules for all bicycles at
+        once, these are the same as those of BicycleEnv.process_step().
+
+        Arguments:
+        observations -- The stacked observations
+
+        Returns:
+        The same tuple as SpacarEnv.process_steps(). There is no info, so
+        the last element is None.
+        """
+        rewards = np.ones(len(observations))
+        dones = robot.exceeds_limits(observations, self.limits)
+
+        return rewards, dones, None
+
+    def close(self):
+        pass
+
+    def _reset_rows(self, rows):
+        # puts the selected bicycles back at the origin, in place
+        self.state[rows] = self.model.initial_state(speed=self.initial_speed)
+        self.steps[rows] = 0
+
+        if self.initial_noise:
+            shape = self.state[rows, ROLL:LEAN + 1].shape
+            self.state[rows, ROLL:LEAN + 1] = self.random.normal(
+                scale=self.initial_noise, size=shape)
+
+
+def _matrices(p):
+    """
+    Returns the matrices M, C1, K0, K2 and D of the equations of motion.
+
+    The roll and steer part follows appendix A of Meijaard et al. (2007), with
+    the upper body included in the rear frame. The leaning of the upper body
+    relative to the rear frame is added as a third degree of freedom.
+    """
+    w, c, tilt = p["wheelbase"], p["trail"], p["steer_axis_tilt"]
+    rR, rF = p["rR"], p["rF"]
+
+    # rear frame and upper body as one rigid body
+    mB = p["mB"] + p["mU"]
+    zU = p["zJ"] - p["hU"]
+    xB = (p["xB"] * p["mB"] + p["xU"] * p["mU"]) / mB
+    zB = (p["zB"] * p["mB"] + zU * p["mU"]) / mB
+    IBxx = p["IBxx"] + p["IUxx"] + p["mB"] * (p["zB"] - zB) ** 2 + \
+        p["mU"] * (zU - zB) ** 2
+    IBxz = p["IBxz"] + p["IUxz"] - \
+        p["mB"] * (p["xB"] - xB) * (p["zB"] - zB) - \
+        p["mU"] * (p["xU"] - xB) * (zU - zB)
+    IBzz = p["IBzz"] + p["IUzz"] + p["mB"] * (p["xB"] - xB) ** 2 + \
+        p["mU"] * (p["xU"] - xB) ** 2
+
+    mR, mH, mF = p["mR"], p["mH"], p["mF"]
+    xH, zH = p["xH"], p["zH"]
+    IRxx, IFxx = p["IRxx"], p["IFxx"]
+
+    # the total mass and the front assembly, see Meijaard et al. (A1-A22)
+    mT = mR + mB + mH + mF
+    xT = (xB * mB + xH * mH + w * mF) / mT
+    zT = (-rR * mR + zB * mB + zH * mH - rF * mF) / mT
+
+    ITxx = IRxx + IBxx + p["IHxx"] + IFxx + mR * rR ** 2 + mB * zB ** 2 + \
+        mH * zH ** 2 + mF * rF ** 2
+    ITxz = IBxz + p["IHxz"] - mB * xB * zB - mH * xH * zH + mF * w * rF
+    ITzz = IRxx + IBzz + p["IHzz"] + IFxx + mB * xB ** 2 + mH * xH ** 2 + \
+        mF * w ** 2
+
+    mA = mH + mF
+    xA = (xH * mH + w * mF) / mA
+    zA = (zH * mH - rF * mF) / mA
+
+    IAxx = p["IHxx"] + IFxx + mH * (zH - zA) ** 2 + mF * (rF + zA) ** 2
+    IAxz = p["IHxz"] - mH * (xH - xA) * (zH - zA) + \
+        mF * (w - xA) * (rF + zA)
+    IAzz = p["IHzz"] + IFxx + mH * (xH - xA) ** 2 + mF * (w - xA) ** 2
+
+    uA = (xA - w - c) * cos(tilt) - zA * sin(tilt)
+
+    IAll = mA * uA ** 2 + IAxx * sin(tilt) ** 2 + \
+        2 * IAxz * sin(tilt) * cos(tilt) + IAzz * cos(tilt) ** 2
+    IAlx = -mA * uA * zA + IAxx * sin(tilt) + IAxz * cos(tilt)
+    IAlz = mA * uA * xA + IAxz * sin(tilt) + IAzz * cos(tilt)
+
+    mu = c / w * cos(tilt)
+
+    SR = p["IRyy"] / rR
+    SF = p["IFyy"] / rF
+    ST = SR + SF
+    SA = mA * uA + mu * mT * xT
+
+    # the upper body leans around a joint at height -zJ, its centre of mass is
+    # hU above the joint
+    mU, hU = p["mU"], p["hU"]
+    arm = -zU  # height of the centre of mass of the upper body
+    IU = p["IUxx"]
+
+    M = np.array([
+        [ITxx, IAlx + mu * ITxz, mU * arm * hU + IU],
+        [IAlx + mu * ITxz, IAll + 2 * mu * IAlz + mu ** 2 * ITzz, 0],
+        [mU * arm * hU + IU, 0, mU * hU ** 2 + IU]])
+
+    C1 = np.array([
+        [0, mu * ST + SF * cos(tilt) + ITxz * cos(tilt) / w - mu * mT * zT, 0],
+        [-(mu * ST + SF * cos(tilt)),
+         IAlz * cos(tilt) / w + mu * (SA + ITzz * cos(tilt) / w), 0],
+        [0, mu * mU * hU, 0]])
+
+    K0 = np.array([
+        [mT * zT, -SA, -mU * hU],
+        [-SA, -SA * sin(tilt), 0],
+        [-mU * hU, 0, -mU * hU]])
+
+    K2 = np.array([
+        [0, (ST - mT * zT) * cos(tilt) / w, 0],
+        [0, (SA + SF * sin(tilt)) * cos(tilt) / w, 0],
+        [0, mU * hU * cos(tilt) / w, 0]])
+
+    D = np.zeros((3, 3))
+    D[2, 2] = p["dU"]
+
+    return M, C1, K0, K2, D
+
+
+gym.envs.register(
+    id="SurrogateBicycleEnv-v0",
+    entry_point="bikey.surrogate:SurrogateBicycleEnv"
+)
+
+gym.envs.register(
+    id="BicycleVecEnv-v0",
+    entry_point="bikey.surrogate:BicycleVecEnv"
+)
@@ -0,0 +1,89 @@
+function [stepped, observations, status, sim_time] = bikey_step(model, actions, repeat)
+%BIKEY_STEP Performs one or more steps of a paused bikey simulation.
+%   [stepped, observations, status, sim_time] = BIKEY_STEP(model, actions)
+%   does in a single engine call what SpacarEnv.step() would otherwise do in
+%   many: it updates the actions block, lets the simulation continue for one
+%   step, waits until Simulink has paused (or stopped) again, and reads out
+%   the observations from the base workspace.
+%
+%   BIKEY_STEP(model, actions, repeat) repeats this repeat times with the
+%   same actions, without returning to Python in between. Every row of
+%   observations holds the observations after one of these steps. Fewer rows
+%   are returned if the simulation stops early.
+%
+%   If the simulation is not paused when this function is called, nothing is
+%   changed, stepped is false and observations is empty.
+%
+%   actions is either the text written to the value of the actions block, e.g.
+%   '[0 0 0.1]', or a numeric row vector. A numeric vector is assigned to
+%   the bikey_actions variable in the base workspace, which is read by the
+%   actions block when SpacarEnv is used with native_arrays.
+
+if nargin < 3
+    repeat = 1;
+end
+
+status = get_param(model, 'SimulationStatus');
+observations = [];
+
+if ~strcmp(status, 'paused')
+    stepped = false;
+    sim_time = get_param(model, 'SimulationTime');
+    return
+end
+
+stepped = true;
+
+if ischar(actions)
+    set_param([model '/actions'], 'Value', actions);
+else
+    assignin('base', 'bikey_actions', actions);
+    set_param(model, 'SimulationCommand', 'update');
+end
+
+for i = 1:repeat
+    % allow Simulink to take exactly one more step, see the
+    % check_simulation_time block of the template model
+    sim_time = get_param(model, 'SimulationTime');
+    set_param([model '/simulation_time_python'], 'Value', num2str(sim_time, 17));
+
+    set_param(model, 'SimulationCommand', 'continue');
+    status = wait_for_pause(model);
+
+    tick_observations = read_observations();
+
+    if ~isempty(tick_observations)
+        observations(end + 1, :) = tick_observations(:)';
+    end
+
+    if ~strcmp(status, 'paused')
+        break
+    end
+end
+
+sim_time = get_param(model, 'SimulationTime');
+
+end
+
+
+function status = wait_for_pause(model)
+% Lets Simulink run until it pauses itself or the simulation ends.
+status = get_param(model, 'SimulationStatus');
+
+while any(strcmp(status, {'running', 'updating', 'initializing'}))
+    pause(0.001);
+    status = get_param(model, 'SimulationStatus');
+end
+
+end
+
+
+function observations = read_observations()
+% Reads the latest observations from 'out' in the base workspace.
+if evalin('base', 'exist(''out'', ''var'')')
+    observations = evalin('base', 'out.observations');
+else
+    observations = [];
+end
+
+end
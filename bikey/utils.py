@@ -27,6 +27,8 @@ def set_template_dir(directory=None):
     dir -- the custom template directory. If None the default template
         directory will be used.
     """
+    global _custom_template_dir, _template_dir
+
     if directory is None:
         # fall back to bikey's default template dir
         _custom_template_dir = False
@@ -48,4 +50,4 @@ def find_template_dir():
     else:
         # find the directory where utils.py is located
         package_dir = os.path.dirname(os.path.realpath(__file__))
-        return os.path.join(package_dir, "spacar_templates")
+        return os.path.join(package_dir, "templates")
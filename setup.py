@@ -11,8 +11,9 @@ setuptools.setup(
     long_description = long_description,
     long_description_content_type = "text/markdown",
     packages = setuptools.find_packages(),
+    package_data = {"bikey": ["templates/*"]},
     classifiers = [
 
     ],
-    python_requires = ">=3.5"
+    python_requires = ">=3.8"
 )
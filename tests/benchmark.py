@@ -0,0 +1,270 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# benchmark the bikey of this repository, also when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the fake engine has to replace matlab.engine before bikey.spacar is imported
+from bikey import fake_matlab
+fake_matlab.install()
+
+import gym
+import bikey.bicycle
+from bikey.network import server, server_utils
+from bikey.network.network_env import NetworkEnv
+
+# Measures the time taken by the steps of a BicycleEnv, without Matlab.
+#
+# The Matlab engine is replaced by bikey.fake_matlab, which emulates Simulink
+# and can add a latency to every engine call. The environment is stepped with
+# several combinations of options, both directly and through a NetworkEnv and
+# an environment server. For every combination the number of steps per
+# second, the median and 99th percentile of the step and reset times, and the
+# number of engine calls per step are reported.
+#
+# Example, with 50 microseconds per engine call and a limit for CI:
+#
+#   python tests/benchmark.py --latency 50 --max_p99 5 --json results.json
+
+ACTION = np.array([0.01, 0.0, 0.02])
+
+# the number of seconds the server gets to start and to shut down
+SERVER_TIMEOUT = 30
+
+CASES = {
+    'text': {},
+    # one engine call per step more than text, native arrays only pay off
+    # together with fused_step
+    'native_arrays': {'native_arrays': True},
+    'fused_step': {'fused_step': True},
+    'fused_native': {'fused_step': True, 'native_arrays': True},
+    'fused_native_warm': {'fused_step': True, 'native_arrays': True,
+                          'warm_reset': True},
+}
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the steps of a BicycleEnv on a fake Matlab '
+                    'engine')
+
+    parser.add_argument('-n', '--steps',
+                        help='the number of steps taken in every case',
+                        default=2000,
+                        type=int)
+    parser.add_argument('-l', '--latency',
+                        help='the number of microseconds every engine call '
+                             'takes',
+                        default=0.0,
+                        type=float)
+    parser.add_argument('-p', '--port',
+                        help='the port of the environment server',
+                        default=65431,
+                        type=int)
+    parser.add_argument('-L', '--local_only',
+                        help='do not benchmark the environments behind a '
+                             'server',
+                        action='store_true')
+    parser.add_argument('-m', '--max_p99',
+                        help='fail if the 99th percentile of the step time of '
+                             'any case exceeds this many milliseconds',
+                        default=None,
+                        type=float)
+    parser.add_argument('-j', '--json',
+                        help='also write the results to this file',
+                        default=None)
+
+    return parser.parse_args()
+
+
+def env_config(options):
+    return dict(simulink_file='simulation.slx', copy_simulink=True,
+                copy_spacar=True, headless=True, **options)
+
+
+def run_episodes(env, steps, engine_calls=None):
+    """
+    Takes a number of steps, starting a new episode whenever one ends.
+
+    Arguments:
+    env -- The environment
+    steps -- The number of steps
+    engine_calls -- If not None, a function returning the total number of
+        engine calls made so far.
+
+    Returns:
+    A dictionary with the results.
+    """
+    step_times = []
+    reset_times = []
+
+    start = time.perf_counter()
+    env.reset()
+    reset_times.append(time.perf_counter() - start)
+
+    calls_before = engine_calls() if engine_calls is not None else None
+    total = time.perf_counter()
+
+    for _ in range(steps):
+        start = time.perf_counter()
+        _, _, done, _ = env.step(ACTION)
+        step_times.append(time.perf_counter() - start)
+
+        if done:
+            start = time.perf_counter()
+            env.reset()
+            reset_times.append(time.perf_counter() - start)
+
+    total = time.perf_counter() - total
+
+    results = {
+        'steps_per_second': steps / total,
+        'step_p50_ms': 1000 * np.percentile(step_times, 50),
+        'step_p99_ms': 1000 * np.percentile(step_times, 99),
+        'reset_p50_ms': 1000 * np.percentile(reset_times, 50),
+        'engine_calls_per_step': None,
+    }
+
+    if engine_calls is not None:
+        # the engine calls of resets during the run are included
+        results['engine_calls_per_step'] = \
+            (engine_calls() - calls_before) / steps
+
+    return results
+
+
+def benchmark_local(options, steps):
+    env = gym.make('BicycleEnv-v0', working_dir=tempfile.mkdtemp(),
+                   **env_config(options)).unwrapped
+
+    try:
+        return run_episodes(env, steps, lambda: env.engine_calls)
+    finally:
+        env.close()
+
+
+def run_server(port, server_dir):
+    # the server is rather talkative
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.start_server('127.0.0.1', port, server_dir, 4)
+
+
+def wait_for_server(server_process, port):
+    """
+    Waits until the server answers requests.
+
+    Raises:
+    RuntimeError if the server has exited or does not answer in time.
+    """
+    deadline = time.monotonic() + SERVER_TIMEOUT
+
+    while time.monotonic() < deadline:
+        if not server_process.is_alive():
+            raise RuntimeError(f"The server could not be started on port "
+                               f"{port}, see the error above")
+
+        try:
+            server_utils.request_stats('127.0.0.1', port, timeout=1)
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f"The server did not answer within {SERVER_TIMEOUT} "
+                       f"seconds")
+
+
+def stop_server(server_process, port):
+    if server_process.is_alive():
+        with contextlib.redirect_stdout(io.StringIO()):
+            server_utils.send_shutdown_command('127.0.0.1', port)
+
+    server_process.join(SERVER_TIMEOUT)
+
+    if server_process.is_alive():
+        print("The server did not shut down, terminating it")
+        server_process.terminate()
+        server_process.join()
+
+
+def benchmark_network(options, steps, port):
+    with contextlib.redirect_stdout(io.StringIO()):
+        env = NetworkEnv('127.0.0.1', port, 'BicycleEnv-v0',
+                         **env_config(options))
+
+    try:
+        return run_episodes(env, steps)
+    finally:
+        env.close()
+
+
+def print_results(name, results):
+    calls = results['engine_calls_per_step']
+    calls = '-' if calls is None else f'{calls:.2f}'
+
+    print(f"{name:<28} {results['steps_per_second']:>10.0f} "
+          f"{results['step_p50_ms']:>9.3f} {results['step_p99_ms']:>9.3f} "
+          f"{results['reset_p50_ms']:>9.3f} {calls:>7}")
+
+
+def main():
+    args = parse_cli_args()
+
+    fake_matlab.configure(latency=args.latency / 1e6)
+
+    print(f"{args.steps} steps per case, {args.latency} us per engine call\n")
+    print(f"{'case':<28} {'steps/s':>10} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'reset ms':>9} {'calls':>7}")
+
+    results = {}
+
+    for name, options in CASES.items():
+        results[name] = benchmark_local(options, args.steps)
+        print_results(name, results[name])
+
+    if not args.local_only:
+        # forked, so the server uses the fake engine with the same latency
+        server_process = mp.get_context('fork').Process(
+            target=run_server, args=(args.port, tempfile.mkdtemp()))
+        server_process.start()
+
+        try:
+            wait_for_server(server_process, args.port)
+
+            for name, options in CASES.items():
+                name = 'network/' + name
+                results[name] = benchmark_network(options, args.steps,
+                                                  args.port)
+                print_results(name, results[name])
+
+        except RuntimeError as error:
+            print(error)
+            sys.exit(1)
+
+        finally:
+            stop_server(server_process, args.port)
+
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if args.max_p99 is not None:
+        slow = [name for name, result in results.items()
+                if result['step_p99_ms'] > args.max_p99]
+
+        if slow:
+            print(f"\nThe 99th percentile exceeds {args.max_p99} ms for: "
+                  f"{', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
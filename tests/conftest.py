@@ -0,0 +1,9 @@
+import os
+import sys
+
+# test the bikey of this repository, also when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the fake engine has to replace matlab.engine before bikey.spacar is imported
+from bikey import fake_matlab
+fake_matlab.install()
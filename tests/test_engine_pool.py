@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from bikey import fake_matlab
+from bikey.engine_pool import EnginePool
+
+
+def test_released_session_is_reused_with_a_clean_workspace(tmp_path):
+    pool = EnginePool(engine_module=fake_matlab)
+
+    session = pool.lease(working_dir=str(tmp_path))
+    assert session.current_dir == str(tmp_path)
+
+    (tmp_path / 'model.slx').touch()
+    session.workspace['leftover'] = 1.0
+    session.load_system('model', nargout=0)
+    pool.release(session)
+
+    assert pool.lease() is session
+    assert session.workspace == {}
+    assert session.loaded_models == {}
+    assert pool.size == 1
+
+
+def test_lease_waits_for_a_release_at_max_sessions():
+    pool = EnginePool(max_sessions=1, engine_module=fake_matlab)
+    first = pool.lease()
+    leased = []
+
+    waiter = threading.Thread(target=lambda: leased.append(pool.lease()))
+    waiter.start()
+    waiter.join(0.2)
+
+    # the only session is in use, so no second one is started
+    assert waiter.is_alive()
+    assert pool.size == 1
+
+    pool.release(first)
+    waiter.join(5)
+
+    assert leased == [first]
+
+
+def test_close_shuts_down_owned_sessions_only():
+    shared = fake_matlab.start_matlab()
+    shared.eval("matlab.engine.shareEngine('pool_test')", nargout=0)
+
+    pool = EnginePool(shared_names=['pool_test'], engine_module=fake_matlab)
+    first = pool.lease()
+    second = pool.lease()
+
+    assert first is shared
+
+    pool.release(first)
+    pool.close()
+
+    # leased sessions are shut down once they are released
+    assert second.running
+    pool.release(second)
+
+    assert shared.running
+    assert not second.running
+
+    with pytest.raises(RuntimeError):
+        pool.lease()
@@ -0,0 +1,52 @@
+import multiprocessing as mp
+
+import pytest
+
+from bikey.network.env_process import EnvProcess, EnvProcessPool, \
+    PipeEnvProcess
+
+INIT = {'command': 'init',
+        'data': {'env': 'SurrogateBicycleEnv-v0', 'config': {}}}
+
+
+@pytest.fixture(params=[EnvProcess, PipeEnvProcess],
+                ids=['queues', 'pipes'])
+def pool(request):
+    pool = EnvProcessPool(mp.Queue(), 1, request.param)
+    yield pool
+    pool.close()
+
+
+def test_released_process_is_reused(pool):
+    env_process = pool.acquire()
+    pid = env_process.process.pid
+
+    assert env_process.request(INIT)['command'] == 'confirm'
+    env_process.request({'command': 'reset'})
+
+    assert pool.release(env_process)
+    assert pool.status() == {'idle': 1}
+
+    reused = pool.acquire()
+    assert reused is env_process
+    assert reused.process.pid == pid
+
+    # the environment of the last client has been closed
+    assert reused.request({'command': 'step', 'data': {'action': [0, 0, 0]}}
+                          )['command'] == 'error'
+    assert reused.request(INIT)['command'] == 'confirm'
+
+    assert pool.release(reused)
+
+
+def test_pool_stops_processes_it_does_not_need(pool):
+    kept = pool.acquire()
+    extra = pool.acquire()
+
+    assert extra is not kept
+
+    assert pool.release(kept)
+    assert not pool.release(extra)
+
+    extra.join()
+    assert not extra.process.is_alive()
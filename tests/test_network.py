@@ -0,0 +1,237 @@
+import contextlib
+import io
+import multiprocessing as mp
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+import pytest
+
+from bikey.network import async_server, network_env, server, server_utils
+from bikey.network.network_env import NetworkEnv, ServerError, \
+    VectorNetworkEnv
+
+ENV = 'SurrogateBicycleEnv-v0'
+ACTION = np.array([0.01, 0.0, 0.02])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_server(module, port, server_dir, options):
+    # the server is rather talkative
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.start_server('127.0.0.1', port, server_dir, 4, **options)
+
+
+@pytest.fixture(params=[server, async_server], ids=['threads', 'asyncio'])
+def start(request, tmp_path):
+    processes = []
+
+    def start(**options):
+        port = free_port()
+        process = mp.Process(target=run_server, args=(
+            request.param, port, str(tmp_path), options))
+        process.start()
+        processes.append((process, port))
+
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                server_utils.request_stats('127.0.0.1', port, timeout=1)
+                return port
+            except OSError:
+                if not process.is_alive() or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    yield start
+
+    for process, port in processes:
+        server_utils.send_shutdown_command('127.0.0.1', port)
+        process.join(30)
+
+        if process.is_alive():
+            process.terminate()
+
+
+@pytest.mark.parametrize('server_options, options', [
+    ({}, {'wire_protocol': 'binary'}),
+    ({}, {'wire_protocol': 'json'}),
+    ({'shared_memory': True}, {}),
+    ({}, {'local': False, 'compression': 'zlib', 'compression_threshold': 0,
+          'delta_encoding': True}),
+    ({'shared_memory': True}, {'local': True, 'shared_memory': True}),
+], ids=['binary', 'json', 'shared_memory', 'compression', 'local'])
+def test_network_env_matches_the_local_env(start, server_options, options):
+    port = start(**server_options)
+
+    local = network_env.gym.make(ENV, initial_speed=2.0).unwrapped
+    remote = NetworkEnv('127.0.0.1', port, ENV, initial_speed=2.0, **options)
+
+    try:
+        np.testing.assert_allclose(remote.reset(), local.reset())
+
+        for _ in range(5):
+            expected = local.step(ACTION)
+            result = remote.step(ACTION)
+
+            np.testing.assert_allclose(result[0], expected[0])
+            assert result[1:3] == expected[1:3]
+    finally:
+        remote.close()
+
+
+def test_errors_of_the_environment_are_raised_by_the_client(start):
+    port = start()
+    env = NetworkEnv('127.0.0.1', port, ENV)
+
+    try:
+        with pytest.raises(ServerError, match='not been reset'):
+            env.step(ACTION)
+
+        env.reset()
+        with pytest.raises(ServerError, match='broadcast'):
+            env.step(np.zeros(5))
+
+        # the environment is still usable
+        assert len(env.step(ACTION)[0]) == 6
+    finally:
+        env.close()
+
+    with pytest.raises(ServerError):
+        NetworkEnv('127.0.0.1', port, 'NoSuchEnv-v0')
+
+
+def test_vector_env_stacks_the_environments(start):
+    port = start()
+    env = VectorNetworkEnv('127.0.0.1', port, ENV, num_envs=3)
+
+    try:
+        assert env.reset().shape == (3, 6)
+
+        observations, rewards, dones, infos = env.step(np.tile(ACTION, (3, 1)))
+
+        assert observations.shape == (3, 6)
+        np.testing.assert_array_equal(rewards, [1, 1, 1])
+        assert len(infos) == 3
+    finally:
+        env.close()
+
+
+def test_pipelined_steps_are_answered_in_order(start):
+    port = start()
+    env = NetworkEnv('127.0.0.1', port, ENV)
+
+    try:
+        env.reset()
+        for _ in range(3):
+            env.step_async(ACTION)
+
+        results = [env.step_wait() for _ in range(3)]
+    finally:
+        env.close()
+
+    # the propulsion torque keeps turning the rear wheel faster
+    angles = [result[0][0] for result in results]
+    assert 0 < angles[0] < angles[1] < angles[2]
+
+
+def test_named_session_is_kept_for_the_next_client(start, monkeypatch):
+    monkeypatch.setattr(network_env, 'RESUME_DELAY', 0.1)
+    port = start()
+
+    first = NetworkEnv('127.0.0.1', port, ENV, session='worker')
+    first.reset()
+    observations = first.step(ACTION)[0]
+
+    # the session cannot be picked up while it is in use
+    with pytest.raises(ConnectionError):
+        NetworkEnv('127.0.0.1', port, ENV, session='worker')
+
+    first.close()
+
+    second = NetworkEnv('127.0.0.1', port, ENV, session='worker')
+    try:
+        # the environment carries on where the first client left it
+        assert second.step(ACTION)[0][0] > observations[0]
+    finally:
+        second.close()
+
+
+def test_scheduled_envs_are_stepped_together(start):
+    port = start(envs_per_worker=2)
+    env = VectorNetworkEnv('127.0.0.1', port, ENV, num_envs=3)
+    other = NetworkEnv('127.0.0.1', port, ENV)
+
+    try:
+        env.reset()
+        other.reset()
+
+        observations, rewards, _, _ = env.step(np.tile(ACTION, (3, 1)))
+        assert observations.shape == (3, 6)
+        np.testing.assert_array_equal(rewards, [1, 1, 1])
+
+        # an error is only reported to the client that caused it
+        with pytest.raises(ServerError):
+            other.step(np.zeros(5))
+
+        assert env.step(np.tile(ACTION, (3, 1)))[0].shape == (3, 6)
+        assert len(other.step(ACTION)[0]) == 6
+    finally:
+        env.close()
+        other.close()
+
+
+def test_traced_steps_report_their_stages(start):
+    port = start()
+    env = NetworkEnv('127.0.0.1', port, ENV, trace=True)
+
+    try:
+        env.reset()
+        info = env.step(ACTION)[3]
+    finally:
+        env.close()
+
+    assert {'server', 'env', 'total'} <= set(info['trace'])
+
+    stages = server_utils.request_stats('127.0.0.1', port)['stages']
+    assert stages['env']['count'] >= 2
+
+
+def test_metrics_count_the_steps(start):
+    metrics_port = free_port()
+    port = start(metrics_port=metrics_port)
+    env = NetworkEnv('127.0.0.1', port, ENV)
+
+    try:
+        env.reset()
+        for _ in range(3):
+            env.step(ACTION)
+
+        url = f'http://127.0.0.1:{metrics_port}/metrics'
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+    finally:
+        env.close()
+
+    assert f'bikey_steps_total{{env="{ENV}"}} 3' in text
+    assert 'bikey_connections 1' in text
+
+
+def test_server_does_not_need_matlab():
+    # the fake engine is only installed in this process
+    code = 'import sys, bikey.network.server; print("matlab" in sys.modules)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    result = subprocess.run([sys.executable, '-c', code], cwd=root,
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == 'False'
@@ -0,0 +1,141 @@
+import socket
+
+import numpy as np
+import pytest
+
+from bikey.network import protocol
+from bikey.network.protocol import Compression, MessageReader
+
+
+def step_message(observations):
+    return {'command': 'confirm', 'id': 7,
+            'data': {'observations': observations, 'reward': 1.0,
+                     'done': False, 'info': {}}}
+
+
+@pytest.mark.parametrize('wire_protocol', [protocol.JSON, protocol.BINARY])
+def test_round_trip(wire_protocol):
+    observations = np.arange(6, dtype=np.float32).reshape(2, 3)
+
+    raw = protocol.encode(step_message(observations), wire_protocol)
+    raw_message, rest = protocol.split_message(raw, wire_protocol)
+    message = protocol.decode(raw_message, wire_protocol)
+
+    assert rest == b''
+    assert message['id'] == 7
+    assert message['data']['reward'] == 1.0
+    np.testing.assert_array_equal(message['data']['observations'],
+                                  observations)
+
+
+def test_binary_frames_keep_dtype_and_shape():
+    observations = np.arange(6, dtype='>i4').reshape(3, 2)
+
+    raw = protocol.encode(step_message(observations), protocol.BINARY)
+    message = protocol.decode(raw[4:], protocol.BINARY)
+    decoded = message['data']['observations']
+
+    assert decoded.dtype == np.dtype('<i4')
+    assert decoded.shape == (3, 2)
+    np.testing.assert_array_equal(decoded, observations)
+
+
+def test_split_message_waits_for_a_complete_frame():
+    raw = protocol.encode(step_message(np.zeros(4)), protocol.BINARY)
+
+    assert protocol.split_message(raw[:-1], protocol.BINARY) == \
+        (None, raw[:-1])
+    assert protocol.split_message(raw + raw[:3], protocol.BINARY)[1] == \
+        raw[:3]
+
+
+@pytest.mark.parametrize('wire_protocol', [protocol.JSON, protocol.BINARY])
+def test_message_reader_reassembles_small_chunks(wire_protocol):
+    messages = [step_message(np.full(100, i, dtype=float)) for i in range(3)]
+    stream = b''.join(protocol.encode(message, wire_protocol)
+                      for message in messages)
+
+    # a chunk size that splits frames and delimiters alike
+    reader = MessageReader(wire_protocol, chunk_size=7)
+    received = []
+
+    for start in range(0, len(stream), 7):
+        reader.feed(stream[start:start + 7])
+        received.extend(protocol.decode(raw, wire_protocol)
+                        for raw in reader.messages())
+
+    assert [message['data']['observations'][0] for message in received] == \
+        [0, 1, 2]
+
+
+def test_message_reader_switches_protocol_between_messages():
+    left, right = socket.socketpair()
+
+    with left, right:
+        left.sendall(protocol.encode({'command': 'init'}, protocol.JSON) +
+                     protocol.encode(step_message(np.ones(3)),
+                                     protocol.BINARY))
+
+        reader = MessageReader(protocol.JSON, chunk_size=16)
+
+        while (raw := reader.next_message()) is None:
+            reader.recv_from(right)
+        assert protocol.decode(raw, protocol.JSON) == {'command': 'init'}
+
+        reader.protocol = protocol.BINARY
+
+        while (raw := reader.next_message()) is None:
+            reader.recv_from(right)
+        message = protocol.decode(raw, protocol.BINARY)
+
+    np.testing.assert_array_equal(message['data']['observations'], np.ones(3))
+
+
+@pytest.mark.parametrize('delta', [False, True])
+def test_compression_round_trip(delta):
+    sender = Compression(threshold=0, delta=delta)
+    receiver = Compression(threshold=0, delta=delta)
+
+    observations = np.linspace(0, 1, 500)
+
+    for step in range(3):
+        observations = observations + 0.001 * step
+        raw = protocol.encode(step_message(observations), protocol.BINARY,
+                              sender)
+        header = protocol.decode_json(raw[8:8 + int.from_bytes(raw[4:8],
+                                                               'little')])
+
+        assert header['__compressed__'] == 'zlib'
+        assert ('__delta__' in header) == (delta and step > 0)
+
+        message = protocol.decode(raw[4:], protocol.BINARY, receiver)
+        np.testing.assert_array_equal(message['data']['observations'],
+                                      observations)
+
+
+def test_delta_encoding_is_skipped_when_the_size_changes():
+    sender = Compression(threshold=10 ** 6, delta=True)
+    receiver = Compression(threshold=10 ** 6, delta=True)
+
+    for size in (4, 4, 5):
+        observations = np.arange(size, dtype=float)
+        raw = protocol.encode(step_message(observations), protocol.BINARY,
+                              sender)
+        message = protocol.decode(raw[4:], protocol.BINARY, receiver)
+
+        np.testing.assert_array_equal(message['data']['observations'],
+                                      observations)
+
+
+def test_compressed_frame_without_negotiation_is_rejected():
+    raw = protocol.encode(step_message(np.zeros(500)), protocol.BINARY,
+                          Compression(threshold=0))
+
+    with pytest.raises(ValueError):
+        protocol.decode(raw[4:], protocol.BINARY)
+
+
+def test_negotiate_refuses_unknown_settings():
+    assert Compression.negotiate({'method': 'rot13'}) is None
+    assert Compression.negotiate({'method': 'zlib', 'level': 3}).settings() \
+        == {'method': 'zlib', 'level': 3, 'threshold': 1024, 'delta': False}
@@ -0,0 +1,135 @@
+import gym
+import numpy as np
+import pytest
+
+from bikey.recording import TrajectoryReader, TrajectoryRecorder, \
+    open_trajectories
+from bikey.replay import ReplayEnv
+from bikey.surrogate import SurrogateBicycleEnv
+
+
+class CountingEnv(gym.Env):
+    """
+    Counts from start to 4, one step at a time.
+    """
+
+    def __init__(self, start=0):
+        self.observation_space = gym.spaces.Discrete(5)
+        self.action_space = gym.spaces.Discrete(2)
+        self.start = start
+        self.count = None
+
+    def step(self, action):
+        self.count += 1
+        done = self.count == 4
+        info = {'episode_end_reason': 'end_of_epi'} if done else {}
+
+        return self.count, float(self.count), done, info
+
+    def reset(self):
+        self.count = self.start
+        return self.count
+
+
+def record(directory, episodes, start=0, chunk_size=3):
+    env = TrajectoryRecorder(CountingEnv(start), str(directory), chunk_size)
+
+    for _ in range(episodes):
+        env.reset()
+        done = False
+
+        while not done:
+            done = env.step(1)[2]
+
+    env.close()
+
+
+def test_reader_returns_the_recorded_episodes(tmp_path):
+    record(tmp_path, episodes=2)
+    reader = TrajectoryReader(str(tmp_path))
+
+    assert len(reader) == 8
+    assert reader.num_episodes == 2
+
+    # the second episode spans two chunks
+    episode = reader.episode(1)
+    np.testing.assert_array_equal(episode['observations'], [0, 1, 2, 3])
+    np.testing.assert_array_equal(episode['next_observations'], [1, 2, 3, 4])
+    np.testing.assert_array_equal(episode['dones'],
+                                  [False, False, False, True])
+    assert episode['episode_end_reason'] == 'end_of_epi'
+
+
+def test_recorder_appends_to_an_existing_recording(tmp_path):
+    record(tmp_path, episodes=1)
+    record(tmp_path, episodes=1, start=2)
+    reader = TrajectoryReader(str(tmp_path))
+
+    assert [episode['rewards'].tolist() for episode in reader.episodes()] == \
+        [[1, 2, 3, 4], [3, 4]]
+
+
+def test_recorder_refuses_a_recording_of_another_env(tmp_path):
+    record(tmp_path, episodes=1)
+
+    with pytest.raises(ValueError):
+        TrajectoryRecorder(SurrogateBicycleEnv(), str(tmp_path))
+
+
+def test_batches_cover_every_step_once(tmp_path):
+    record(tmp_path, episodes=3)
+    reader = TrajectoryReader(str(tmp_path))
+
+    for shuffle in (False, True):
+        batches = list(reader.batches(5, columns=['rewards'], shuffle=shuffle,
+                                      seed=1))
+
+        assert [len(batch['rewards']) for batch in batches] == [5, 5, 2]
+        assert sorted(np.concatenate([batch['rewards'] for batch in
+                                      batches])) == [1, 1, 1, 2, 2, 2, 3, 3,
+                                                     3, 4, 4, 4]
+
+
+def test_replay_env_replays_a_recording(tmp_path):
+    record(tmp_path, episodes=2)
+    env = gym.make('ReplayEnv-v0', path=str(tmp_path)).unwrapped
+
+    assert env.observation_space == gym.spaces.Discrete(5)
+    assert env.action_space == gym.spaces.Discrete(2)
+
+    for _ in range(3):
+        # after the last episode the replay starts over
+        observations = [env.reset()]
+        done = False
+
+        while not done:
+            observation, reward, done, info = env.step(0)
+            observations.append(observation)
+
+        assert observations == [0, 1, 2, 3, 4]
+        assert info['episode_end_reason'] == 'end_of_epi'
+        assert env.step(0) is None
+
+
+def test_replay_env_replays_a_log_of_arrays(tmp_path):
+    observations = np.arange(10, dtype=float).reshape(5, 2)
+    np.savez(tmp_path / 'log.npz', observations=observations,
+             actions=np.zeros((5, 1)), rewards=np.ones(5),
+             dones=np.array([False, True, False, False, False]))
+
+    reader = open_trajectories(str(tmp_path / 'log.npz'))
+    env = ReplayEnv(trajectories=reader, logged_actions=True)
+
+    assert env.observation_space.shape == (2,)
+
+    np.testing.assert_array_equal(env.reset(), [0, 1])
+    np.testing.assert_array_equal(env.step(None)[0], [2, 3])
+    assert env.step(None)[2]
+
+    # the last episode of the log never ended
+    env.reset()
+    results = [env.step(None) for _ in range(3)]
+
+    assert results[-1][2]
+    assert results[-1][3]['episode_end_reason'] == 'end_of_log'
+    assert results[-1][3]['logged_action'] == [0.0]
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bikey.network import async_server, server, sessions
+from bikey.network.sessions import Session, SessionRegistry
+
+INIT = {'env': 'SurrogateBicycleEnv-v0', 'config': {}}
+
+
+def parked_session(registry, key='worker'):
+    session = Session(key, INIT, 1)
+    session.env_processes = [object()]
+
+    registry.start(session)
+    registry.park(session)
+
+    return session
+
+
+def test_take_hands_over_a_parked_session():
+    registry = SessionRegistry()
+    session = parked_session(registry)
+
+    assert not registry.in_use(session.token)
+    assert registry.take('worker', INIT) == (session, [])
+    assert registry.in_use(session.token)
+
+    # a session is handed over only once
+    assert registry.take('worker', INIT) == (None, [])
+
+
+def test_take_releases_a_session_for_another_environment():
+    registry = SessionRegistry()
+    session = parked_session(registry)
+
+    other = {'env': 'BicycleEnv-v0', 'config': {}}
+
+    assert registry.take('worker', other) == (None, session.env_processes)
+    assert registry.take('worker', INIT) == (None, [])
+
+
+def test_parking_under_the_same_name_replaces_the_old_session():
+    registry = SessionRegistry()
+    first = parked_session(registry)
+
+    second = Session('worker', INIT, 1)
+    assert registry.park(second) == first.env_processes
+
+
+def test_expired_removes_sessions_parked_too_long():
+    registry = SessionRegistry(timeout=60)
+    old = parked_session(registry, 'old')
+    new = parked_session(registry, 'new')
+
+    old.parked_at -= 120
+
+    assert registry.expired() == old.env_processes
+    assert registry.take('old', INIT) == (None, [])
+    assert registry.take('new', INIT) == (new, [])
+
+
+def test_resume_replays_the_pending_responses():
+    session = Session('', INIT, 1)
+    assert len(session.token) == 32 and not session.named
+
+    init = {'command': 'init', 'id': 0, 'data': INIT}
+    session.record(init, {'command': 'confirm', 'data': {'num_envs': 1}})
+
+    for request_id in range(1, sessions.REPLAY_SIZE + 3):
+        session.record({'command': 'step', 'id': request_id},
+                       {'command': 'confirm', 'id': request_id, 'data': {}})
+
+    last = sessions.REPLAY_SIZE + 2
+    confirmation, replays = session.resume(
+        {'command': 'resume', 'data': {'pending': [1, last - 1, last]}})
+
+    assert confirmation['data']['session'] == session.token
+    assert confirmation['data']['last_id'] == last
+
+    # the oldest responses are no longer kept
+    assert confirmation['data']['replayed'] == [last - 1, last]
+    assert [response['id'] for _, response in replays] == [last - 1, last]
+
+
+class StubProcess:
+    """
+    Records what the server does with an environment process.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        pass
+
+    async def join_async(self):
+        pass
+
+
+class FullPool:
+    """
+    A pool that never keeps released processes.
+    """
+
+    def release(self, env_process):
+        return False
+
+
+def run_reaper(module, registry, stopped):
+    # returns once stopped is set or the reaper has had a few chances
+    if module is server:
+        stop_server = threading.Event()
+        reaper = threading.Thread(target=server.reap_sessions,
+                                  args=(registry, FullPool(), stop_server))
+        reaper.start()
+        stopped.wait(5)
+        stop_server.set()
+        reaper.join()
+        return
+
+    async def reap():
+        stop_server = asyncio.Event()
+        reaper = asyncio.create_task(async_server.reap_sessions(
+            registry, FullPool(), stop_server))
+
+        deadline = time.monotonic() + 5
+        while not stopped.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        stop_server.set()
+        await reaper
+
+    asyncio.run(reap())
+
+
+@pytest.mark.parametrize('module', [server, async_server],
+                         ids=['threads', 'asyncio'])
+def test_server_reaps_expired_sessions(module):
+    registry = SessionRegistry(timeout=0)
+    session = parked_session(registry)
+    env_process = session.env_processes[0] = StubProcess()
+
+    assert registry.reap_interval == 1
+
+    run_reaper(module, registry, env_process.stopped)
+
+    assert env_process.stopped.is_set()
+    assert registry.take('worker', INIT) == (None, [])
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from bikey.network.shared_slots import SlotRing, slot_layout
+
+
+@pytest.fixture
+def ring():
+    ring = SlotRing((3,), np.float64, slots=2)
+    yield ring
+    ring.close()
+
+
+def test_attached_ring_reads_what_the_owner_writes(ring):
+    attached = SlotRing.from_spec(ring.spec())
+
+    try:
+        slot = ring.write(np.array([1.0, 2.0, 3.0]))
+        np.testing.assert_array_equal(attached.read(slot), [1.0, 2.0, 3.0])
+
+        assert not attached.owner
+        assert not attached.read(slot).flags.writeable
+    finally:
+        attached.close()
+
+
+def test_slots_are_used_in_turn(ring):
+    slots = [ring.write(np.full(3, value)) for value in range(3)]
+
+    assert slots == [0, 1, 0]
+    np.testing.assert_array_equal(ring.read(1), np.full(3, 1.0))
+
+
+def test_fits_only_arrays_that_are_stored_without_loss(ring):
+    assert ring.fits(np.zeros(3, dtype=np.float32))
+    assert not ring.fits(np.zeros(4))
+    assert not ring.fits(np.zeros(3, dtype=np.complex128))
+    assert not ring.fits([0.0, 0.0, 0.0])
+
+
+def test_slot_layout():
+    box = {'space': 'gym.spaces.Box', 'shape': [6], 'dtype': 'float32'}
+    discrete = {'space': 'gym.spaces.Discrete', 'n': 3}
+
+    assert slot_layout(box) == ((6,), np.dtype(np.float64))
+    assert slot_layout(discrete) == ((), np.dtype(np.int64))
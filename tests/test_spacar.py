@@ -0,0 +1,153 @@
+import gym
+import matlab
+import numpy as np
+import pytest
+
+import bikey.bicycle
+from bikey import robot
+from bikey.spacar import SpacarEnv, from_matlab_array, to_matlab_array
+
+ACTION = np.array([0.01, 0.0, 0.02])
+
+
+def observation_batch():
+    batch = np.zeros((4, 6))
+    batch[1, 1] = 2 * robot.limits[0]  # steered too far
+    batch[3, 2] = -2 * robot.limits[1]  # leaning too far
+
+    return batch
+
+
+@pytest.fixture(scope='module')
+def make_env(tmp_path_factory):
+    envs = []
+
+    def make(**options):
+        env = gym.make('BicycleEnv-v0',
+                       working_dir=str(tmp_path_factory.mktemp('bicycle')),
+                       simulink_file='simulation.slx', copy_simulink=True,
+                       copy_spacar=True, headless=True, **options).unwrapped
+        envs.append(env)
+        return env
+
+    yield make
+
+    for env in envs:
+        env.close()
+
+
+def test_process_steps_agrees_with_process_step(make_env):
+    env = make_env()
+    batch = observation_batch()
+
+    rewards, dones, _ = env.process_steps(batch)
+    expected = [env.process_step(row) for row in batch]
+
+    np.testing.assert_array_equal(rewards, [reward for reward, _, _ in
+                                            expected])
+    np.testing.assert_array_equal(dones, [done for _, done, _ in expected])
+    np.testing.assert_array_equal(dones, [False, True, False, True])
+
+
+def test_default_process_steps_calls_process_step_per_row():
+    class CountingEnv(SpacarEnv):
+        def __init__(self):
+            self.rows = []
+
+        def process_step(self, observations):
+            self.rows.append(observations)
+            return 2, observations[0] > 0, {'row': len(self.rows)}
+
+    env = CountingEnv()
+    rewards, dones, infos = env.process_steps(np.array([[0.0], [1.0]]))
+
+    assert len(env.rows) == 2
+    np.testing.assert_array_equal(rewards, [2.0, 2.0])
+    np.testing.assert_array_equal(dones, [False, True])
+    assert infos == [{'row': 1}, {'row': 2}]
+
+
+def test_process_block_stops_at_the_first_done(make_env):
+    env = make_env()
+    observations, reward, done, _ = env.process_block(observation_batch())
+
+    assert reward == 2
+    assert done
+    np.testing.assert_array_equal(observations, observation_batch()[1])
+
+
+@pytest.mark.parametrize('options', [
+    {'native_arrays': True},
+    {'fused_step': True},
+    {'fused_step': True, 'native_arrays': True},
+])
+def test_step_options_do_not_change_the_simulation(make_env, options):
+    plain = make_env()
+    other = make_env(**options)
+
+    plain.reset()
+    other.reset()
+
+    for _ in range(5):
+        expected = plain.step(ACTION)
+        result = other.step(ACTION)
+
+        np.testing.assert_allclose(result[0], expected[0])
+        assert result[1:3] == expected[1:3]
+
+    if options.get('fused_step'):
+        assert other.step_engine_calls == 1
+    else:
+        assert other.step_engine_calls >= plain.step_engine_calls
+
+
+def test_action_repeat_steps_the_simulation_in_one_engine_call(make_env):
+    plain = make_env()
+    repeating = make_env(action_repeat=3)
+
+    plain.reset()
+    repeating.reset()
+
+    for _ in range(2):
+        expected = [plain.step(ACTION) for _ in range(3)]
+        observations, reward, done, _ = repeating.step(ACTION)
+
+        np.testing.assert_allclose(observations, expected[-1][0])
+        assert reward == sum(result[1] for result in expected)
+        assert done == expected[-1][2]
+        assert repeating.step_engine_calls == 1
+
+
+def test_warm_reset_keeps_the_model_loaded(make_env):
+    cold = make_env()
+    warm = make_env(warm_reset=True)
+
+    episodes = []
+
+    for env in (cold, warm):
+        env.reset()
+        model = env.session.loaded_models[env.model_name]
+
+        for _ in range(3):
+            env.step(ACTION)
+
+        observations = [env.reset()]
+        observations += [env.step(ACTION)[0] for _ in range(3)]
+        episodes.append(observations)
+
+        assert (env.session.loaded_models[env.model_name] is model) == \
+            (env is warm)
+
+    # the next episode starts from the same initial state
+    np.testing.assert_allclose(episodes[1], episodes[0])
+
+
+def test_matlab_array_conversion():
+    value = matlab.double([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+
+    np.testing.assert_array_equal(from_matlab_array(value),
+                                  [[1, 2, 3], [4, 5, 6]])
+    np.testing.assert_array_equal(
+        from_matlab_array(to_matlab_array(np.arange(3).reshape(3, 1))),
+        [[0, 1, 2]])
+    assert from_matlab_array(2.0) == 2.0
@@ -0,0 +1,78 @@
+import numpy as np
+
+from bikey.surrogate import BicycleModel, BicycleVecEnv, SurrogateBicycleEnv
+
+ACTION = np.array([0.01, 0.0, 0.02])
+
+
+def test_first_observation_is_the_rear_wheel_angle():
+    model = BicycleModel()
+    state = model.initial_state(speed=1.0)
+
+    angles = [model.observe(model.step(state, np.zeros(3), 0.01))[0]
+              for _ in range(3)]
+
+    # rolling at constant speed, the angle grows by the rate times dt
+    rate = 1.0 / model.rear_radius
+    np.testing.assert_allclose(angles, rate * 0.01 * np.arange(1, 4))
+
+
+def test_vector_env_matches_single_envs():
+    single = [SurrogateBicycleEnv(initial_speed=2.0) for _ in range(3)]
+    vector = BicycleVecEnv(3, initial_speed=2.0)
+
+    for env in single:
+        env.reset()
+    vector.reset()
+
+    for _ in range(10):
+        results = [env.step(ACTION) for env in single]
+        observations, rewards, dones, _ = vector.step(np.tile(ACTION, (3, 1)))
+
+        np.testing.assert_allclose(observations,
+                                   [result[0] for result in results])
+        np.testing.assert_array_equal(dones, [result[2] for result in results])
+
+
+def test_vector_env_resets_finished_bicycles():
+    vector = BicycleVecEnv(2, initial_speed=2.0, max_steps=3)
+    first = vector.reset()
+
+    # the first bicycle is about to reach max_steps
+    vector.steps[0] = 2
+
+    observations, _, dones, info = vector.step(np.tile(ACTION, (2, 1)))
+
+    assert dones.tolist() == [True, False]
+    assert info['end_of_sim'].tolist() == [True, False]
+    assert vector.steps.tolist() == [0, 1]
+
+    # the finished bicycle starts over, its last observations are kept
+    np.testing.assert_allclose(observations[0], first[0])
+    assert not np.allclose(info['terminal_observation'][0], first[0])
+    np.testing.assert_allclose(info['terminal_observation'][1],
+                               observations[1])
+
+
+def test_process_steps_agrees_with_process_step():
+    env = SurrogateBicycleEnv()
+    batch = np.zeros((3, 6))
+    batch[2, 3] = 10.0  # the upper body leans too far
+
+    rewards, dones, _ = env.process_steps(batch)
+
+    np.testing.assert_array_equal(rewards, [1, 1, 1])
+    np.testing.assert_array_equal(
+        dones, [env.process_step(row)[1] for row in batch])
+    assert dones.tolist() == [False, False, True]
+
+
+def test_episode_ends_at_max_steps():
+    env = SurrogateBicycleEnv(max_steps=3)
+    env.reset()
+
+    results = [env.step(np.zeros(3)) for _ in range(4)]
+
+    assert [result[2] for result in results[:3]] == [False, False, True]
+    assert results[2][3]['episode_end_reason'] == 'end_of_sim'
+    assert results[3] is None
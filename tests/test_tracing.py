@@ -0,0 +1,61 @@
+import math
+
+from bikey.network import tracing
+from bikey.network.tracing import StageHistograms
+
+
+def test_histograms_count_durations_in_buckets():
+    histograms = StageHistograms(buckets=(0.001, 0.01, 0.1))
+
+    for duration in (0.0005, 0.001, 0.005, 0.05, 1.0):
+        histograms.record({'env': duration})
+
+    snapshot = histograms.snapshot()
+    env = snapshot['stages']['env']
+
+    assert env['counts'] == [2, 1, 1, 1]
+    assert env['count'] == 5
+    assert math.isclose(env['sum'], 1.0565)
+
+    assert tracing.quantile(snapshot, 'env', 0.4) == 0.001
+    assert tracing.quantile(snapshot, 'env', 0.8) == 0.1
+    assert tracing.quantile(snapshot, 'env', 1.0) == float('inf')
+    assert tracing.quantile(snapshot, 'server', 0.5) is None
+
+
+def test_engine_durations_only_mention_functions_that_were_called():
+    before = {'set_param': (2, 0.5), 'get_param': (1, 0.25)}
+    after = {'set_param': (4, 1.5), 'get_param': (1, 0.25),
+             'eval': (1, 0.25)}
+
+    assert tracing.engine_durations(before, after) == {
+        'engine.set_param': 1.0, 'engine.eval': 0.25, 'engine': 1.25,
+        'engine_calls': 3}
+    assert tracing.engine_durations(after, after) == {}
+
+
+def test_a_request_is_traced_from_client_to_env_and_back():
+    message = {'command': 'step', 'trace': True}
+    durations = tracing.begin(message, received_at=tracing.stamp())
+
+    response = {'command': 'confirm',
+                'trace': tracing.env_trace(message['trace'], tracing.stamp(),
+                                           {'engine': 0.0})}
+    tracing.finish(durations, response, received_at=message['trace'])
+
+    server = response['trace']
+    assert {'server_decode', 'to_env', 'env', 'from_env', 'server',
+            'engine'} <= set(server)
+
+    durations = tracing.client_durations(server, (0.0, 0.25, 0.25), 2.0,
+                                         0.5)
+
+    assert durations['total'] == 2.0
+    assert math.isclose(durations['network'], 1.0 - server['server'])
+
+
+def test_untraced_requests_are_left_alone():
+    message = {'command': 'step'}
+
+    assert tracing.begin(message, tracing.stamp()) is None
+    assert 'trace' not in message